@@ -25,6 +25,13 @@ def dropbox_post_factory(request):
     except Exception:
         max_age = 300
 
+    # resuming an upload may take considerably longer than filling out the form
+    if request.method in ('HEAD', 'PATCH') and 'upload' in request.GET:
+        try:
+            max_age = int(request.registry.settings.get('upload_token_max_age_seconds'))
+        except Exception:
+            max_age = 24 * 60 * 60
+
     try:
         drop_id = parse_post_token(
             token=request.matchdict['token'],
@@ -82,10 +89,12 @@ def configure(global_config, **settings):
     config.add_translation_dirs('briefkasten:locale')
     app_route = settings.get('appserver_root_url', '/')
     config.add_static_view('%sstatic' % app_route, 'briefkasten:static')
-    config.add_renderer('.pt', 'pyramid_chameleon.zpt.renderer_factory')
+    config.include('briefkasten.theming')
     config.add_route('fingerprint', '%sfingerprint' % app_route)
+    config.add_route('dropbox_token', '%stoken' % app_route)
     config.add_route('dropbox_form_submit', '%s{token}/submit' % app_route, factory=dropbox_post_factory)
     config.add_route('dropbox_fileupload', '%s{token}/upload' % app_route, factory=dropbox_post_factory)
+    config.add_route('dropbox_fileupload_stream', '%s{token}/upload/{filename}' % app_route, factory=dropbox_post_factory)
     config.add_route('dropbox_editor', '%sdropbox/{drop_id}/{editor_token}' % app_route, factory=dropbox_editor_factory)
     config.add_route('dropbox_view', '%sdropbox/{drop_id}' % app_route, factory=dropbox_factory)
     config.add_route('dropbox_form', app_route)
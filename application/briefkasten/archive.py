@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+""" helpers for creating (encrypted) zip archives of drops without writing a plaintext
+copy of the archive to disk.
+
+`ZipFile` needs to seek back to each member's header once the member has been written,
+which makes it unsuitable for writing into a pipe. instead each member's header announces
+a data descriptor (flag bit 3) holding its checksum and size, which is written right after
+the member's data, so the archive is written strictly sequentially and each member is
+read only once.
+"""
+from binascii import crc32
+from fcntl import fcntl, F_GETFD, F_SETFD, FD_CLOEXEC
+from os import fdopen, fstat, pipe
+from threading import Thread
+from time import localtime
+from zipfile import (
+    LargeZipFile,
+    ZIP64_LIMIT,
+    ZIP_STORED,
+    stringCentralDir,
+    stringEndArchive,
+    stringFileHeader,
+    structCentralDir,
+    structEndArchive,
+    structFileHeader,
+)
+import struct
+
+chunk_size = 64 * 1024
+
+
+def _dos_datetime(timestamp):
+    dt = localtime(timestamp)
+    return (
+        (dt.tm_year - 1980) << 9 | dt.tm_mon << 5 | dt.tm_mday,
+        dt.tm_hour << 11 | dt.tm_min << 5 | dt.tm_sec // 2)
+
+
+def _encode_name(arcname):
+    """ returns the encoded name and the flag bits to use for it"""
+    if isinstance(arcname, unicode):
+        try:
+            return arcname.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return arcname.encode('utf-8'), 0x800
+    return arcname, 0
+
+
+# the (optional) signature and format of the data descriptors following the members
+stringDataDescriptor = b'PK\x07\x08'
+structDataDescriptor = '<4sLLL'
+
+
+def write_zip(out, members):
+    """ writes an uncompressed zip archive to the (not necessarily seekable) file like `out`.
+
+    `members` is a list of `(arcname, source)` tuples where `source` is either the path to
+    a file or a file object opened for reading in binary mode. returns the number of bytes
+    written."""
+    central_directory = []
+    offset = 0
+    for arcname, source in members:
+        if isinstance(source, basestring):
+            fileobj = open(source, 'rb')
+        else:
+            fileobj = source
+        try:
+            fs_stat = fstat(fileobj.fileno())
+            if fs_stat.st_size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+                raise LargeZipFile('drop archive would require ZIP64 extensions')
+            name, flag_bits = _encode_name(arcname)
+            flag_bits |= 0x08
+            date, time = _dos_datetime(fs_stat.st_mtime)
+            header = struct.pack(
+                structFileHeader, stringFileHeader, 20, 0, flag_bits, ZIP_STORED,
+                time, date, 0, 0, 0, len(name), 0)
+            out.write(header)
+            out.write(name)
+            crc = 0
+            size = 0
+            for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                crc = crc32(chunk, crc)
+                size += len(chunk)
+                out.write(chunk)
+            crc &= 0xffffffff
+            if size > ZIP64_LIMIT:
+                raise LargeZipFile('drop archive would require ZIP64 extensions')
+            descriptor = struct.pack(structDataDescriptor, stringDataDescriptor, crc, size, size)
+            out.write(descriptor)
+        finally:
+            if fileobj is not source:
+                fileobj.close()
+        central_directory.append(struct.pack(
+            structCentralDir, stringCentralDir, 20, 3, 20, 0, flag_bits, ZIP_STORED,
+            time, date, crc, size, size, len(name), 0, 0, 0, 0,
+            (fs_stat.st_mode & 0xFFFF) << 16, offset) + name)
+        offset += len(header) + len(name) + size + len(descriptor)
+
+    cd_size = 0
+    for entry in central_directory:
+        out.write(entry)
+        cd_size += len(entry)
+    out.write(struct.pack(
+        structEndArchive, stringEndArchive, 0, 0,
+        len(central_directory), len(central_directory), cd_size, offset, 0))
+    return offset + cd_size + struct.calcsize(structEndArchive)
+
+
+def encrypt_zip(gpg_context, members, recipients, output):
+    """ streams an uncompressed zip archive of the given members through gpg into `output`.
+
+    the archive is written into a pipe that gpg reads from, so it is created in a single
+    pass with constant memory and never touches the disk unencrypted."""
+    read_fd, write_fd = pipe()
+    # gpg must not inherit the write end of the pipe, otherwise it would never see EOF
+    for fd in (read_fd, write_fd):
+        fcntl(fd, F_SETFD, fcntl(fd, F_GETFD) | FD_CLOEXEC)
+    errors = []
+
+    def writer():
+        try:
+            with fdopen(write_fd, 'wb') as archive:
+                write_zip(archive, members)
+        except Exception as exc:
+            errors.append(exc)
+
+    thread = Thread(target=writer)
+    thread.start()
+    try:
+        with fdopen(read_fd, 'rb') as archive:
+            result = gpg_context.encrypt_file(
+                archive,
+                recipients,
+                always_trust=True,
+                output=output)
+    finally:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return result
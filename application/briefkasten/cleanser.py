@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+""" a python driver for cleansing the attachments of a drop locally.
+
+it mirrors what `process-attachments.sh` does on the cleanser host, but instead of
+processing one attachment after the other it hands each attachment to its own cleanser
+process, so drops with many attachments keep all available cores busy.
+
+the pool itself consists of threads that merely wait for their cleanser processes, since
+drops are processed inside (daemonic) worker processes which can't have process pools.
+
+note that the cleansers then run on the worker itself, i.e. outside of any jail, and need
+the same tools as the cleanser hosts. the driver is therefore never used if
+`briefkasten.conf` configures a remote cleanser (see `remote_cleanser`).
+
+images of the given `native_types` (i.e. jpeg and png) are cleansed by the pool's threads
+themselves, removing their metadata without converting them (see `images`). this works
+independently of the driver: with `cleanser_native_types` only those images are cleansed
+in-process, all other attachments still go through `process-attachments.sh` (which skips
+attachments that have already been cleansed). like the driver it is never used if a remote
+cleanser is configured, so untrusted files are never parsed by the worker in that case.
+"""
+import re
+import shutil
+from multiprocessing.pool import ThreadPool
+from os import chmod, mkdir
+from os.path import basename, exists
+from subprocess import call
+
+from .filetypes import detect_type
+from .images import InvalidImage, cleanse_image, strippers
+
+
+# a variable assignment in a shell script
+assignment = re.compile(r'^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*)$')
+
+
+def read_config(fs_config):
+    """ returns the values assigned in the given shell config (i.e. `briefkasten.conf`),
+    as far as they can be told without running it"""
+    config = dict()
+    try:
+        with open(fs_config) as lines:
+            for line in lines:
+                match = assignment.match(line)
+                if match is not None:
+                    name, value = match.groups()
+                    config[name] = value.split('#')[0].strip().strip('"\'')
+    except IOError:
+        pass
+    return config
+
+
+def remote_cleanser(config):
+    """ returns whether `process-attachments.sh` cleanses the attachments on a remote host
+    (or a jail claimed from jdispatch) given its config"""
+    return bool(config.get('the_cleanser') or config.get('the_jdispatcher_dir'))
+
+
+def cleanse_file(fs_attachment, fs_target, env=None, the_type=None, native_types=()):
+    """ cleanses a single attachment into the target directory using the same cleanser
+    scripts as `process-attachments.sh`, or in-process if its mime type is one of the given
+    `native_types` (and supported by `images`). unless its type is given it is detected first.
+
+    returns a tuple of the resulting status code and message, the code is 299 if the file
+    has been cleansed, 800 if its type is not supported and 540 if cleansing failed."""
+    if the_type is None:
+        try:
+            the_type = detect_type(fs_attachment)
+        except Exception:
+            return 540, u'Error while detecting file type'
+    mime_type = the_type.split(';')[0]
+
+    if mime_type in native_types and mime_type in strippers:
+        try:
+            cleanse_image(fs_attachment, fs_target, mime_type)
+        except (InvalidImage, IOError, OSError):
+            return 540, u'Error while cleansing file of type %s' % mime_type
+        return 299, u'Cleansed'
+
+    if mime_type == 'text/plain':
+        command = None
+    elif mime_type == 'application/msword':
+        command = ['process-msword.sh', fs_attachment, fs_target]
+    elif mime_type == 'application/pdf':
+        command = ['process-pdf.sh', fs_attachment, fs_target]
+    elif mime_type.startswith('image/'):
+        command = ['process-image.sh', fs_attachment, fs_target, the_type]
+    else:
+        # every unknown format is just copied, this means that the server tried its best
+        # and is at least not worse than plain email
+        shutil.copy(fs_attachment, fs_target)
+        return 800, u'Not cleansible'
+
+    try:
+        if command is None:
+            shutil.copy(fs_attachment, fs_target)
+            returncode = 0
+        else:
+            returncode = call(command, env=env, close_fds=True)
+    except (IOError, OSError):
+        returncode = -1
+    if returncode != 0:
+        return 540, u'Error while cleansing file of type %s' % mime_type
+    return 299, u'Cleansed'
+
+
+def split_native(fs_attachments, types, native_types):
+    """ splits the given attachments into those that can be cleansed in-process according
+    to their (known) types and the rest"""
+    native, others = [], []
+    for fs_attachment in fs_attachments:
+        mime_type = (types.get(basename(fs_attachment)) or '').split(';')[0]
+        if mime_type in native_types and mime_type in strippers:
+            native.append(fs_attachment)
+        else:
+            others.append(fs_attachment)
+    return native, others
+
+
+def _cleanse_file(args):
+    return cleanse_file(*args)
+
+
+def aggregate_status(results):
+    """ combines the results of the individual attachments into a single status.
+    any failure takes precedence over unsupported file types, which in turn take
+    precedence over success."""
+    status = u'299 Cleansed'
+    for code, message in results:
+        if 500 <= code < 600:
+            return u'%d %s' % (code, message)
+        elif code == 800:
+            status = u'%d %s' % (code, message)
+    return status
+
+
+def cleanse_attachments(fs_attachments, fs_target, processes=None, env=None, types=None, native_types=()):
+    """ cleanses the given attachments into the target directory running up to `processes`
+    cleansers at a time and returns the resulting status. the types of the attachments may
+    be given by file name (see `filetypes.read_manifest`), those of the given `native_types`
+    are cleansed in-process."""
+    if not exists(fs_target):
+        mkdir(fs_target)
+        chmod(fs_target, 0770)
+    if not fs_attachments:
+        return aggregate_status([])
+    pool = ThreadPool(processes=min(processes or 1, len(fs_attachments)))
+    try:
+        types = types or dict()
+        results = pool.map(_cleanse_file, [
+            (fs_attachment, fs_target, env, types.get(basename(fs_attachment)), native_types)
+            for fs_attachment in fs_attachments])
+    finally:
+        pool.close()
+        pool.join()
+    return aggregate_status(results)
@@ -1,25 +1,37 @@
 import click
+from humanfriendly import format_size
 from os import path, listdir, rename, remove
 from datetime import datetime
 from sys import exit
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
 from signal import signal, SIGINT
+from threading import Thread
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from threading import Condition
+from time import time
+import traceback
 
 from .dropbox import DropboxContainer
+from .janitor import expire_uploads, sweep
+from .leases import LeaseManager
+from .metrics import WorkerMetrics, format_timings
+from .scheduler import Scheduler
 
 
-class MyHandler(FileSystemEventHandler):
+class SubmissionHandler(FileSystemEventHandler):
+    """ adds new entries of the submission queue to the scheduler"""
 
-    def __init__(self, main_loop_cond):
-        self.main_loop_cond = main_loop_cond
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
 
-    def on_modified(self, event):
-        self.main_loop_cond.acquire()
-        self.main_loop_cond.notify()
-        self.main_loop_cond.release()
+    def on_created(self, event):
+        if not event.is_directory:
+            self.scheduler.add(path.basename(event.src_path))
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.scheduler.add(path.basename(event.dest_path))
 
 
 def keyboard_interrupt_handler(signal, frame):
@@ -49,22 +61,109 @@ def process_drop(drop):
     remove(path.join(drop.container.fs_scratch, drop.drop_id))
 
 
+# the long-lived container of a pool worker process, see `init_worker`
+worker_container = None
+
+
+def init_worker(root, settings=None):
+    """ initializes a pool worker process with its own container (and thus its own gpg
+    context and smtp session), so only drop ids need to be passed to it.
+    a persistent smtp session is ended when the worker exits (workers killed by
+    `Pool.terminate` simply abandon it, though)."""
+    global worker_container
+    worker_container = DropboxContainer(root=root, settings=settings)
+    shutdown = getattr(worker_container.settings['smtp'], 'shutdown', None)
+    if shutdown is not None:
+        # forked workers don't run `atexit` handlers, but they do run these finalizers
+        Finalize(worker_container, shutdown, exitpriority=10)
+
+
+def process_drop_id(drop_id, fs_dispatcher=None):
+    """ processes the drop with the given id inside a pool worker process, optionally using
+    the cleanser jail that has been leased for it. just like `process_scheduled_drop` it
+    always returns the id, so the scheduler is notified about its completion"""
+    try:
+        drop = worker_container.get_dropbox(drop_id)
+        drop.cleanser_dispatcher = fs_dispatcher
+        process_drop(drop)
+    except Exception:
+        traceback.print_exc()
+    return drop_id
+
+
+def scheduler_limits(num_workers, overrides=None):
+    """ returns the concurrency limits of the classes of drops processed by the given number
+    of workers. large drops can't take up all workers and watchdog drops never use more than
+    one, so that small tips always get through quickly; drops that have been waiting for long
+    are promoted, though. a single worker can't be reserved for small drops, of course, so
+    `num_workers` should be at least 2."""
+    limits = dict(
+        small=num_workers,
+        large=max(1, num_workers - 1),
+        watchdog=1)
+    limits.update(overrides or {})
+    return limits
+
+
+def record_completion(drop_root, metrics, drop_id):
+    """ adds the status and timings of the given (processed) drop to the metrics"""
+    try:
+        timings = metrics.completed(drop_root.get_dropbox(drop_id))
+    except Exception:
+        return None
+    if timings:
+        print('Processed drop %s in %s' % (drop_id, format_timings(timings)))
+    return timings
+
+
+def process_scheduled_drop(drop):
+    """ processes the given drop and returns its id, even if processing fails, so the
+    scheduler is always notified about its completion"""
+    try:
+        process_drop(drop)
+    except Exception:
+        traceback.print_exc()
+    return drop.drop_id
+
+
 @click.command(help='performs sanity and config checks and cleans up old drops')
 @click.option(
     '--root',
     '-r',
     default='var/drop_root/',
     help='''location of the dropbox container directory''')
-def janitor(root):     # pragma: no cover
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help='''only report how many expired drops would be removed''')
+@click.option(
+    '--threads',
+    default=4,
+    help='''number of threads removing drops''')
+@click.option(
+    '--batch-size',
+    default=100,
+    help='''number of drops to remove at a time''')
+@click.option(
+    '--max-rate',
+    default=0.0,
+    help='''maximum number of drops to remove per second (0 for no limit)''')
+@click.option(
+    '--max-upload-age',
+    default=None,
+    type=int,
+    help='''seconds after which abandoned resumable uploads are removed (defaults to the
+    `upload_token_max_age_seconds` setting or a day)''')
+def janitor(root, dry_run=False, threads=4, batch_size=100, max_rate=0.0, max_upload_age=None):     # pragma: no cover
     drop_root = root = DropboxContainer(root=root)
 
     # Scan pub keys for expired or soon to expired ones
-    allkeys = root.gpg_context.list_keys()
     now = datetime.utcnow()
     report = ''
 
     for editor in drop_root.settings['editors']:
-        key = [k for k in allkeys if editor in ', '.join(k['uids'])]
+        key = drop_root.keyring.lookup(editor)
         if not bool(key):
             report = report + 'Editor %s does not have a public key in keyring.\n' % editor
             continue
@@ -82,14 +181,64 @@ def janitor(root):     # pragma: no cover
         elif delta.days < 60:
             report = report + 'Editor ' + editor + ' has a key that will expire in %d days.\n' % delta.days
 
-    for drop in drop_root:
-        age = now - drop.last_changed()
-        max_age = 365 if not drop.from_watchdog else 1
-
-        if age.days > max_age:
-            if not drop.from_watchdog:
-                print('drop %s is expired. Removing it.' % drop)
-            drop.destroy()
+    # drops expire after a year, watchdog drops after a day
+    for from_watchdog, max_age in [(False, 365), (True, 1)]:
+        expired_before = time() - (max_age + 1) * 24 * 60 * 60
+        expired = drop_root.index.expired(expired_before, from_watchdog=from_watchdog)
+        if not from_watchdog:
+            for drop_id in expired:
+                print('drop %s is expired. %s it.' % (drop_id, 'Would remove' if dry_run else 'Removing'))
+        num_removed, size_removed = sweep(
+            drop_root,
+            expired,
+            dry_run=dry_run,
+            threads=threads,
+            batch_size=batch_size,
+            max_rate=max_rate)
+        print('%s %d expired %sdrops (%s)' % (
+            'Would remove' if dry_run else 'Removed',
+            num_removed,
+            'watchdog ' if from_watchdog else '',
+            format_size(size_removed)))
+
+    # resumable uploads can't be resumed once their token has expired
+    if max_upload_age is None:
+        max_upload_age = int(drop_root.settings.get('upload_token_max_age_seconds', 24 * 60 * 60))
+    num_drops, size_removed = expire_uploads(drop_root, max_upload_age, dry_run=dry_run)
+    print('%s abandoned uploads of %d drops (%s)' % (
+        'Would remove' if dry_run else 'Removed',
+        num_drops,
+        format_size(size_removed)))
+
+
+def render_static_form(app, url):
+    """ renders the submission form at the given url without a token using the given
+    (i.e. themed) wsgi application and returns the resulting page"""
+    from webob import Request
+    request = Request.blank(url, environ={'briefkasten.static_form': True})
+    response = request.get_response(app)
+    if response.status_int != 200:
+        raise click.ClickException('rendering the form failed with status %s' % response.status)
+    return response.body
+
+
+@click.command(help='renders the (themed) submission form into a static file')
+@click.option(
+    '--config',
+    '-c',
+    default='development.ini',
+    help='''paste deploy configuration of the application''')
+@click.option(
+    '--url',
+    '-u',
+    default='http://localhost:6543/briefkasten/',
+    help='''public url of the submission form''')
+@click.argument('output')
+def render_form(config, url, output):     # pragma: no cover
+    from paste.deploy import loadapp
+    app = loadapp('config:%s' % path.abspath(config))
+    with open(output, 'w') as fs_output:
+        fs_output.write(render_static_form(app, url))
 
 
 @click.command(help='debug processing of drops')
@@ -149,42 +298,130 @@ def debug_worker(root):     # pragma: no cover
 def worker(root, async=True):     # pragma: no cover
     drop_root = DropboxContainer(root=root)
     settings = drop_root.settings
+    num_workers = settings.get('num_workers', 1)
+    reconcile_interval = float(settings.get('queue_reconcile_interval', 60))
+
+    def classify(drop_id):
+        drop = drop_root.get_dropbox(drop_id)
+        if not async or drop.num_attachments == 0:
+            return 'text'
+        if drop.from_watchdog:
+            return 'watchdog'
+        if drop.size_dirty_attachments >= settings['large_drop_threshold']:
+            return 'large'
+        return 'small'
+
+    # drops without attachments are processed synchronously, drops with attachments
+    # asynchronously by as many workers as there are worker jails, see `scheduler_limits`
+    limits = scheduler_limits(num_workers, settings.get('scheduler_limits'))
+    if async and limits['large'] >= num_workers:
+        print('Warning: with %d worker(s) large drops can hold up drops with small attachments, '
+            'at least 2 are needed to reserve one for them' % num_workers)
+    scheduler = Scheduler(
+        drop_root.fs_submission_queue,
+        classify=classify,
+        classes=['text', 'small', 'large', 'watchdog'],
+        limits=limits,
+        max_in_flight=num_workers,
+        promote_after=float(settings.get('scheduler_promote_after', 300)))
+
+    # with `cleanser_leases` the worker claims the remote cleanser jails from the jdispatch
+    # directory configured in briefkasten.conf for the drops instead of
+    # process-attachments.sh, see `leases`
+    leases = None
+    fs_dispatcher = drop_root.cleanser_config.get('the_jdispatcher_dir')
+    if async and settings.get('cleanser_leases') and fs_dispatcher:
+        leases = LeaseManager(
+            fs_dispatcher,
+            lease_timeout=float(settings.get('cleanser_lease_timeout', 900)),
+            poll_interval=float(settings.get('cleanser_poll_interval', 0.5)),
+            health_check=settings.get('cleanser_health_check', False))
+    lease_wait_timeout = float(settings.get('cleanser_wait_timeout', 300))
+
+    # queue depths, completions and the timings of all processed drops, which are written
+    # to `metrics_textfile` periodically, see `metrics`
+    metrics = WorkerMetrics(drop_root, scheduler, slots=num_workers, leases=leases)
+    fs_metrics = settings.get('metrics_textfile')
+    metrics_interval = float(settings.get('metrics_interval', 15))
+
+    def completed(drop_id):
+        scheduler.done(drop_id)
+        record_completion(drop_root, metrics, drop_id)
+
+    def dispatch(drop_id):
+        """ waits for a cleanser jail and hands the drop to the pool. the scheduler is
+        notified about the completion of the drop even if that fails"""
+        lease = None
+        try:
+            lease = leases.acquire(timeout=lease_wait_timeout)
+            if lease is None:
+                # fall back to process-attachments.sh claiming a jail by itself
+                print('No cleanser available for drop %s after %d seconds' % (drop_id, lease_wait_timeout))
+            else:
+                print('Leased cleanser %s for drop %s after %.2f seconds' % (lease.name, drop_id, lease.waited))
+
+            def done(drop_id):
+                try:
+                    leases.release(lease)
+                finally:
+                    completed(drop_id)
+            workers.apply_async(process_drop_id, [drop_id, lease and lease.fs_path], callback=done)
+        except Exception:
+            traceback.print_exc()
+            try:
+                leases.release(lease)
+            finally:
+                completed(drop_id)
 
     # Setup multiprocessing pool with that amount of workers as
     # implied by the amount of worker jails
     if async:
-        workers = Pool(processes=settings.get('num_workers', 1))
-
-    # Setup the condition object that we will wait for, it
-    # signals changes in the directory
-    condition = Condition()
+        workers = Pool(processes=num_workers, initializer=init_worker, initargs=(root,))
 
     # Setup and run the actual file system event watcher
-    event_handler = MyHandler(condition)
+    event_handler = SubmissionHandler(scheduler)
     observer = Observer()
     observer.schedule(event_handler, drop_root.fs_submission_queue, recursive=False)
     observer.start()
 
     signal(SIGINT, keyboard_interrupt_handler)
 
-    # grab lock, scan submission dir for jobs and process them
-    condition.acquire()
+    # pick up all drops submitted while we weren't running
+    scheduler.reconcile()
+    last_reconciled = time()
+    last_written = 0
     while True:
-        for drop_id in listdir(drop_root.fs_submission_queue):
-            print(drop_id)
-            drop = drop_root.get_dropbox(drop_id)
-
-            # Only look at drops that actually are for us
-            if drop.status_int == 20:
-                # process drops without attachments synchronously
-                if async and drop.num_attachments > 0:
-                    workers.map_async(process_drop, [drop])
-                else:
-                    process_drop(drop)
-            else:
-                print('Not processing drop %s with status %d ' % (drop.drop_id, drop.status_int))
-
-        # Wait for directory content to change
-        condition.wait()
+        drop_id, klass = scheduler.next(
+            timeout=min(reconcile_interval, metrics_interval) if fs_metrics else reconcile_interval)
+
+        # periodically rescan the submission queue in case we missed an event
+        if time() - last_reconciled >= reconcile_interval:
+            scheduler.reconcile()
+            last_reconciled = time()
+
+        if fs_metrics and time() - last_written >= metrics_interval:
+            try:
+                metrics.write(fs_metrics)
+            except (IOError, OSError) as exc:
+                print('Writing metrics to %s failed: %s' % (fs_metrics, exc))
+            last_written = time()
+
+        if drop_id is None:
+            continue
 
-    condition.release()
+        print(drop_id)
+        drop = drop_root.get_dropbox(drop_id)
+
+        # Only look at drops that actually are for us
+        if drop.status_int != 20:
+            print('Not processing drop %s with status %d ' % (drop.drop_id, drop.status_int))
+            scheduler.done(drop_id)
+        elif klass != 'text' and leases is not None:
+            # wait for the cleanser in the background, so other drops aren't held up
+            dispatcher = Thread(target=dispatch, args=(drop_id,))
+            dispatcher.daemon = True
+            dispatcher.start()
+        elif klass != 'text':
+            workers.apply_async(process_drop_id, [drop_id], callback=completed)
+        else:
+            completed(process_scheduled_drop(drop))
@@ -1,18 +1,31 @@
 # -*- coding: utf-8 -*-
 import gnupg
 import shutil
+import sqlite3
 import yaml
 from humanfriendly import parse_size
 from jinja2 import Environment, PackageLoader
+from fcntl import flock, LOCK_EX, LOCK_NB
+from hashlib import sha256
 from json import load, dumps
-from os import makedirs, mkdir, chmod, environ, listdir, remove, stat
+from os import O_RDONLY, makedirs, mkdir, chmod, environ, fdopen, fstat, fsync, listdir, remove, rename, stat
+from os import close as close_fd, open as open_fd
 from os.path import exists, isdir, join, splitext, getmtime, split
 from datetime import datetime
 from random import SystemRandom
-from zipfile import ZipFile, ZIP_STORED
 from subprocess import call
-
+from sys import exc_info
+from tempfile import mkstemp
+from threading import Thread
+from time import time
+
+from .archive import chunk_size, encrypt_zip
+from .cleanser import aggregate_status, cleanse_attachments, read_config, remote_cleanser, split_native
+from .filetypes import detect_types, read_manifest, write_manifest
+from .index import DropIndex
+from .metrics import Counted, DropTimings
 from .notifications import (
+    Keyring,
     checkRecipient,
     sendMultiPart,
     setup_smtp_factory
@@ -41,6 +54,42 @@ def sanitize_filename(filename):
         return token
 
 
+class QuotaExceeded(Exception):
+    """ raised when an attachment is larger than a single attachment or all attachments
+    of a drop may be"""
+
+
+class UploadConflict(Exception):
+    """ raised when a chunk of a resumable upload doesn't fit its current state"""
+
+
+class BackgroundTask(Thread):
+    """ calls the given function in a separate thread and keeps its return value
+    (or exception) until `result` is called"""
+
+    def __init__(self, func, *args, **kwargs):
+        Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.return_value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.return_value = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self.exc_info = exc_info()
+
+    def result(self):
+        """ waits for the function to return and returns its result or re-raises its exception"""
+        self.join()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.return_value
+
+
 class DropboxContainer(object):
 
     def __init__(self, root=None, settings=None):
@@ -54,6 +103,9 @@ class DropboxContainer(object):
         # which in turn take precedence over default values
         self.settings = dict(
             attachment_size_threshold=u'2Mb',
+            large_drop_threshold=u'10Mb',
+            max_attachment_size=None,
+            max_drop_size=None,
         )
 
         self.settings.update(**self.parse_settings())
@@ -77,9 +129,27 @@ class DropboxContainer(object):
             gnupghome=self.settings['fs_pgp_pubkeys'],
             gpgbinary=self.settings.get('fs_gpg_path', 'gpg'),
         )
+        self.keyring = Keyring(self.gpg_context)
 
         # convert human readable size to bytes
         self.settings['attachment_size_threshold'] = parse_size(self.settings['attachment_size_threshold'])
+        self.settings['large_drop_threshold'] = parse_size(self.settings['large_drop_threshold'])
+        for quota in ['max_attachment_size', 'max_drop_size']:
+            if self.settings[quota] is not None:
+                self.settings[quota] = parse_size(self.settings[quota])
+        # attachments are never cleansed on the worker itself, if they are meant to be
+        # cleansed on a remote host (or in a jail)
+        self.cleanser_config = dict()
+        if self.settings.get('fs_bin_path'):
+            self.cleanser_config = read_config(join(self.settings['fs_bin_path'], 'briefkasten.conf'))
+        for setting in ['cleanser_processes', 'cleanser_native_types']:
+            if self.settings.get(setting) and remote_cleanser(self.cleanser_config):
+                print('Ignoring %s, briefkasten.conf configures a remote cleanser' % setting)
+                self.settings[setting] = None
+
+        # the mime types of the images to cleanse in-process may be given as a single string
+        if isinstance(self.settings.get('cleanser_native_types'), basestring):
+            self.settings['cleanser_native_types'] = self.settings['cleanser_native_types'].split()
 
         # ensure directories exist
         for directory in [
@@ -92,6 +162,13 @@ class DropboxContainer(object):
             if not exists(directory):
                 makedirs(directory)
 
+        # setup the drop index, building it from scratch if there is none yet
+        fs_index = self.settings.get('fs_drop_index', join(root, 'drops.sqlite'))
+        needs_reindex = not exists(fs_index)
+        self.index = DropIndex(fs_index)
+        if needs_reindex:
+            self.reindex()
+
     def parse_settings(self):
         fs_settings = join(self.fs_root, 'settings.yaml')
         if exists(fs_settings):
@@ -108,6 +185,13 @@ class DropboxContainer(object):
         will be created and returned"""
         return Dropbox(self, drop_id=drop_id)
 
+    def reindex(self):
+        """ rebuilds the drop index from the metadata records of all drops"""
+        self.index.clear()
+        for candidate in listdir(self.fs_path):
+            if isdir(join(self.fs_path, candidate)):
+                self.index.update(candidate, self.get_dropbox(candidate).metadata)
+
     def destroy(self):
         shutil.rmtree(self.fs_root)
 
@@ -115,9 +199,10 @@ class DropboxContainer(object):
         return exists(join(self.fs_path, drop_id))
 
     def __iter__(self):
-        for candidate in listdir(self.fs_path):
-            if isdir(join(self.fs_path, candidate)):
-                yield self.get_dropbox(candidate)
+        for drop_id in self.index:
+            # don't resurrect drops that have been removed behind our back
+            if drop_id in self:
+                yield self.get_dropbox(drop_id)
 
 
 class Dropbox(object):
@@ -136,21 +221,29 @@ class Dropbox(object):
         self.fs_path = fs_dropbox_path = join(container.fs_path, drop_id)
         self.fs_attachment_container = join(self.fs_path, 'attach')
         self.fs_cleansed_attachment_container = join(self.fs_path, 'clean')
+        self.fs_types_manifest = join(self.fs_attachment_container, '.types')
         self.fs_replies_path = join(self.fs_path, 'replies')
+        self.fs_metadata = join(self.fs_path, 'metadata.json')
+        self._metadata = None
         self.gpg_context = self.container.gpg_context
+        self.keyring = self.container.keyring
+        self.timings = DropTimings()
+        # the jdispatch directory of the cleanser jail leased for this drop, see `leases`
+        self.cleanser_dispatcher = None
         self.admins = self.settings['admins']
 
         if not exists(fs_dropbox_path):
             mkdir(fs_dropbox_path)
             chmod(fs_dropbox_path, 0770)
             self.paths_created.append(fs_dropbox_path)
-            self.status = u'010 created'
-            # create an editor token
-            self.editor_token = editor_token = generate_drop_id()
-            self._write_message(fs_dropbox_path, 'editor_token', editor_token)
-            self.from_watchdog = from_watchdog
-        else:
-            self.editor_token = open(join(self.fs_path, 'editor_token')).readline()
+            # create the metadata record including an editor token
+            self._update_metadata(
+                status=u'010 created',
+                created=time(),
+                status_changed=time(),
+                editor_token=generate_drop_id(),
+                from_watchdog=bool(from_watchdog))
+            self.paths_created.append(self.fs_metadata)
 
         # set recipients of email depending on watchdog status
         if self.from_watchdog:
@@ -173,76 +266,290 @@ class Dropbox(object):
     # top level methods that govern the life cycle of a dropbox:
 
     def add_attachment(self, attachment):
-        fs_attachment_container = self.fs_attachment_container
-        if not exists(fs_attachment_container):
-            mkdir(fs_attachment_container)
-            chmod(fs_attachment_container, 0770)
-            self.paths_created.append(fs_attachment_container)
-        sanitized_filename = sanitize_filename(attachment.filename)
-        fs_attachment_path = join(fs_attachment_container, sanitized_filename)
-        with open(fs_attachment_path, 'w') as fs_attachment:
-            shutil.copyfileobj(attachment.file, fs_attachment)
-        fs_attachment.close()
-        chmod(fs_attachment_path, 0660)
+        return self.add_attachment_stream(attachment.file, attachment.filename)
+
+    def add_attachment_stream(self, fileobj, filename, length=None):
+        """ copies an attachment from the given file like into the drop in chunks, reading
+        at most `length` bytes (if given), and returns its new name.
+
+        raises `QuotaExceeded` as soon as the attachment turns out to be too large, if
+        `length` is given even before reading anything."""
+        if length is not None:
+            self.check_quota(length)
+        self._ensure_attachment_container()
+        sanitized_filename = sanitize_filename(filename)
+        fs_attachment_path = join(self.fs_attachment_container, sanitized_filename)
+        checksum = sha256()
+        try:
+            with open(fs_attachment_path, 'w') as fs_attachment:
+                chmod(fs_attachment_path, 0660)
+                size = self._copy_chunks(fileobj, fs_attachment, length, checksum=checksum)
+            self._register_attachment(sanitized_filename, size, checksum.hexdigest())
+        except Exception:
+            if exists(fs_attachment_path):
+                remove(fs_attachment_path)
+            raise
         self.paths_created.append(fs_attachment_path)
         return sanitized_filename
 
+    def create_upload(self, filename, length):
+        """ starts a resumable upload of an attachment of `length` bytes and returns its id.
+
+        the attachment is received in chunks (see `append_upload`) into a hidden partial
+        file, which is only turned into a proper attachment once it is complete."""
+        self.check_quota(length)
+        self._ensure_attachment_container()
+        upload_id = generate_drop_id(16)
+        fs_upload = join(self.fs_attachment_container, '.upload-%s' % upload_id)
+        open(fs_upload, 'w').close()
+        chmod(fs_upload, 0660)
+
+        def add(metadata):
+            metadata.setdefault('uploads', {})[upload_id] = dict(filename=filename, length=length)
+        self._update_metadata(update=add)
+        return upload_id
+
+    def upload_offset(self, upload_id):
+        """ returns how many bytes of the given upload have been received and how many
+        there are in total. raises `KeyError` for unknown uploads."""
+        upload = self.metadata.get('uploads', {})[upload_id]
+        try:
+            return stat(join(self.fs_attachment_container, '.upload-%s' % upload_id)).st_size, upload['length']
+        except OSError:
+            raise KeyError(upload_id)
+
+    def append_upload(self, upload_id, fileobj, offset, length):
+        """ appends `length` bytes from the given file like to the upload, which must have
+        received exactly `offset` bytes so far.
+
+        returns the new offset and, once the upload is complete, the name of the resulting
+        attachment (`None` before). raises `UploadConflict` if the offset doesn't match
+        or another chunk of the same upload is being received."""
+        received, total = self.upload_offset(upload_id)
+        if offset + length > total:
+            raise UploadConflict(u'chunk exceeds the announced length of the upload')
+        fs_upload = join(self.fs_attachment_container, '.upload-%s' % upload_id)
+        with open(fs_upload, 'a') as fs_attachment:
+            try:
+                flock(fs_attachment.fileno(), LOCK_EX | LOCK_NB)
+            except IOError:
+                raise UploadConflict(u'upload is busy')
+            received = fstat(fs_attachment.fileno()).st_size
+            if received != offset:
+                raise UploadConflict(u'upload is at offset %d' % received)
+            try:
+                received += self._copy_chunks(fileobj, fs_attachment, length, offset=offset)
+            finally:
+                # keep what we've got, so the client can resume from there
+                fs_attachment.flush()
+        if received < total:
+            return received, None
+        return received, self._finish_upload(upload_id)
+
+    def expire_uploads(self, max_age, dry_run=False):
+        """ removes the resumable uploads that haven't received anything for `max_age`
+        seconds (their tokens have expired, so they can't be resumed anymore) as well as
+        partial files without an upload. returns the number of bytes that were (or would
+        have been) reclaimed."""
+        uploads = self.metadata.get('uploads', {})
+        expired = [upload_id for upload_id in uploads if not exists(
+            join(self.fs_attachment_container, '.upload-%s' % upload_id))]
+        size = 0
+        if exists(self.fs_attachment_container):
+            for name in listdir(self.fs_attachment_container):
+                if not name.startswith('.upload-'):
+                    continue
+                fs_upload = join(self.fs_attachment_container, name)
+                try:
+                    upload_stat = stat(fs_upload)
+                except OSError:
+                    continue
+                if time() - upload_stat.st_mtime <= max_age:
+                    continue
+                size += upload_stat.st_size
+                expired.append(name[len('.upload-'):])
+                if not dry_run:
+                    remove(fs_upload)
+
+        def forget(metadata):
+            for upload_id in expired:
+                metadata.get('uploads', {}).pop(upload_id, None)
+        if not dry_run and set(expired) & set(uploads):
+            self._update_metadata(update=forget)
+        return size
+
+    def _finish_upload(self, upload_id):
+        upload = self.metadata['uploads'][upload_id]
+        fs_upload = join(self.fs_attachment_container, '.upload-%s' % upload_id)
+        checksum = sha256()
+        with open(fs_upload, 'rb') as fs_attachment:
+            for chunk in iter(lambda: fs_attachment.read(chunk_size), b''):
+                checksum.update(chunk)
+        sanitized_filename = sanitize_filename(upload['filename'])
+        fs_attachment_path = join(self.fs_attachment_container, sanitized_filename)
+        rename(fs_upload, fs_attachment_path)
+        try:
+            self._register_attachment(sanitized_filename, upload['length'], checksum.hexdigest(), upload_id=upload_id)
+        except Exception:
+            remove(fs_attachment_path)
+            raise
+        self.paths_created.append(fs_attachment_path)
+        return sanitized_filename
+
+    def _ensure_attachment_container(self):
+        if not exists(self.fs_attachment_container):
+            mkdir(self.fs_attachment_container)
+            chmod(self.fs_attachment_container, 0770)
+            self.paths_created.append(self.fs_attachment_container)
+
+    def _copy_chunks(self, fileobj, fs_attachment, length=None, offset=0, checksum=None):
+        """ copies (at most `length` bytes) from `fileobj` to `fs_attachment`, which already
+        contains `offset` bytes, and returns the number of bytes copied. the data is synced
+        to disk once at the end."""
+        size = 0
+        while length is None or size < length:
+            chunk = fileobj.read(chunk_size if length is None else min(chunk_size, length - size))
+            if not chunk:
+                break
+            size += len(chunk)
+            self.check_quota(offset + size)
+            if checksum is not None:
+                checksum.update(chunk)
+            fs_attachment.write(chunk)
+        fs_attachment.flush()
+        fsync(fs_attachment.fileno())
+        if length is not None and size < length:
+            raise IOError('upload ended after %d of %d bytes' % (size, length))
+        return size
+
+    def _register_attachment(self, filename, size, checksum, upload_id=None):
+        def add(metadata):
+            # check again, other attachments may have been added in the meantime
+            self.check_quota(size, metadata.get('size', 0))
+            metadata['size'] = metadata.get('size', 0) + size
+            metadata.setdefault('attachments', {})[filename] = dict(size=size, sha256=checksum)
+            if upload_id is not None:
+                metadata.get('uploads', {}).pop(upload_id, None)
+        self._update_metadata(update=add)
+
+    def check_quota(self, size, size_attachments=None):
+        """ raises `QuotaExceeded` if an attachment of the given size can't be added to the
+        attachments of the drop, which take up `size_attachments` bytes"""
+        if size_attachments is None:
+            size_attachments = self.metadata.get('size', 0)
+        max_attachment_size = self.settings.get('max_attachment_size')
+        if max_attachment_size and size > max_attachment_size:
+            raise QuotaExceeded(u'attachments may not be larger than %d bytes' % max_attachment_size)
+        max_drop_size = self.settings.get('max_drop_size')
+        if max_drop_size and size_attachments + size > max_drop_size:
+            raise QuotaExceeded(u'all attachments may not be larger than %d bytes' % max_drop_size)
+
     def submit(self):
+        # the worker picks up the drop as soon as it shows up in the queue, so it has to
+        # have its status by then
+        self.status = u'020 submitted'
         with open(join(self.container.fs_submission_queue, self.drop_id), 'w'):
             pass
-        self.status = u'020 submitted'
 
     def process(self):
         """ Calls the external cleanser scripts to (optionally) purge the meta data and then
             send the contents of the dropbox via email.
+
+            The duration of each stage is recorded along with the number of gpg and smtp
+            calls and kept in the metadata record as `timings` (see `metrics`).
         """
+        self.timings = DropTimings()
+        self.gpg_context = Counted(self.container.gpg_context, self.timings, 'gpg', ('encrypt', 'encrypt_file'))
+        try:
+            return self._process()
+        finally:
+            self.gpg_context = self.container.gpg_context
+            self.timings.close()
+            self._update_metadata(timings=self.timings.as_dict())
 
-        if self.num_attachments > 0:
-            self.status = u'100 processor running'
-            fs_dirty_archive = self._create_backup()
-            # calling _process_attachments has the side-effect of updating `send_attachments`
-            self._process_attachments()
-            if self.status_int < 500 and not self.send_attachments:
-                    self._create_archive()
-
-        if self.status_int >= 500 and self.status_int < 600:
-            # cleansing failed
-            # if configured, we need to move the uncleansed archive to
-            # the appropriate folder and notify the editors
-            if 'dropbox_dirty_archive_url_format' in self.settings:
-                # create_archive
-                shutil.move(
-                    fs_dirty_archive,
-                    '%s/%s.zip.pgp' % (self.container.fs_archive_dirty, self.drop_id))
-                # update status
-                # it's now considered 'successful-ish' again
-                self.status = '490 cleanser failure but notify success'
-
-        if self.status_int == 800:
-            # at least one attachment was not supported
-            # if configured, we need to move the uncleansed archive to
-            # the appropriate folder and notify the editors
-            if 'dropbox_dirty_archive_url_format' in self.settings:
-                # create_archive
-                shutil.move(
-                    fs_dirty_archive,
-                    '%s/%s.zip.pgp' % (self.container.fs_archive_dirty, self.drop_id))
-
-        if self.status_int < 500 or self.status_int == 800:
-            try:
-                if self._notify_editors() > 0:
-                    if self.status_int < 500:
+    def _process(self):
+        pipelined = self.settings.get('pipelined_processing', False)
+        cleansed_archive = None
+
+        try:
+            if self.num_attachments > 0:
+                self.status = u'100 processor running'
+                if pipelined:
+                    fs_dirty_archive = self._create_backup_while_processing()
+                else:
+                    fs_dirty_archive = self._create_backup()
+                    # calling _process_attachments has the side-effect of updating `send_attachments`
+                    self._process_attachments()
+                if self.status_int < 500 and not self.send_attachments:
+                    if pipelined:
+                        cleansed_archive = self._create_archive(background=True)
+                    else:
+                        self._create_archive()
+
+            if self.status_int >= 500 and self.status_int < 600:
+                # cleansing failed
+                # if configured, we need to move the uncleansed archive to
+                # the appropriate folder and notify the editors
+                if 'dropbox_dirty_archive_url_format' in self.settings:
+                    # create_archive
+                    shutil.move(
+                        fs_dirty_archive,
+                        '%s/%s.zip.pgp' % (self.container.fs_archive_dirty, self.drop_id))
+                    # update status
+                    # it's now considered 'successful-ish' again
+                    self.status = '490 cleanser failure but notify success'
+
+            if self.status_int == 800:
+                # at least one attachment was not supported
+                # if configured, we need to move the uncleansed archive to
+                # the appropriate folder and notify the editors
+                if 'dropbox_dirty_archive_url_format' in self.settings:
+                    # create_archive
+                    shutil.move(
+                        fs_dirty_archive,
+                        '%s/%s.zip.pgp' % (self.container.fs_archive_dirty, self.drop_id))
+
+            if self.status_int < 500 or self.status_int == 800:
+                try:
+                    sent = self._notify_editors()
+                except Exception:
+                    import traceback
+                    tb = traceback.format_exc()
+                    sent = None
+                archive_error = None
+                if isinstance(cleansed_archive, BackgroundTask):
+                    # the cleansed archive has been created while notifying the editors
+                    archive_error = self._wait_for_archive(
+                        cleansed_archive,
+                        join(self.container.fs_archive_cleansed, '%s.zip.pgp' % self.drop_id))
+                if sent is None:
+                    self.status = '610 smtp error (%s)' % tb
+                elif sent > 0:
+                    if archive_error is not None:
+                        self.status = '615 archive error (%s)' % archive_error
+                    elif self.status_int < 500:
                         self.status = '900 success'
                 else:
                     self.status = '605 smtp failure'
-            except Exception:
-                import traceback
-                tb = traceback.format_exc()
-                self.status = '610 smtp error (%s)' % tb
-
-        self.cleanup()
+        finally:
+            # whatever happened, no data may leak from the drop
+            if isinstance(cleansed_archive, BackgroundTask):
+                cleansed_archive.join()
+            self.cleanup()
         return self.status
 
+    def _wait_for_archive(self, task, fs_archive):
+        """ waits for the archive created by the given background task and returns `None`
+        or the error it failed with, in which case the partial archive is removed"""
+        try:
+            task.result()
+        except Exception as exc:
+            print('Creating the archive of drop %s failed: %s' % (self.drop_id, exc))
+            if exists(fs_archive):
+                remove(fs_archive)
+            return exc
+        self.timings.finish('archive')
+
     def cleanup(self):
         """ ensures that no data leaks from drop after processing by
         removing all data except the status file"""
@@ -260,15 +567,18 @@ class Dropbox(object):
             :param reply: the message, must conform to  :class:`views.DropboxReplySchema`
 
         """
-        self._write_message(self.fs_replies_path, 'message_001.txt', dumps(reply))
+        self._update_metadata(replies=[reply])
 
     #
     # "private" helper methods for processing a drop
 
-    def _create_encrypted_zip(self, source='dirty', fs_target_dir=None):
+    def _create_encrypted_zip(self, source='dirty', fs_target_dir=None, background=False):
         """ creates a zip file from the drop and encrypts it to the editors.
-        the encrypted archive is created inside fs_target_dir"""
-        backup_recipients = [r for r in self.editors if checkRecipient(self.gpg_context, r)]
+        the encrypted archive is created inside fs_target_dir
+
+        with `background` the archive is created in a separate thread and the
+        `BackgroundTask` is returned instead of the path to the archive"""
+        backup_recipients = [r for r in self.editors if checkRecipient(self.keyring, r)]
 
         # this will be handled by watchdog, no need to send for each drop
         if not backup_recipients:
@@ -276,7 +586,6 @@ class Dropbox(object):
             return self.status
 
         # calculate paths
-        fs_backup = join(self.fs_path, '%s.zip' % source)
         if fs_target_dir is None:
             fs_backup_pgp = join(self.fs_path, '%s.zip.pgp' % source)
         else:
@@ -286,29 +595,66 @@ class Dropbox(object):
             clean=self.fs_cleansed_attachments
         )
 
-        # create archive
-        with ZipFile(fs_backup, 'w', ZIP_STORED) as backup:
-            if exists(join(self.fs_path, 'message')):
-                backup.write(join(self.fs_path, 'message'), arcname='message')
-            for fs_attachment in fs_source[source]:
-                backup.write(fs_attachment, arcname=split(fs_attachment)[-1])
-
-        # encrypt archive
-        with open(fs_backup, "rb") as backup:
-            self.gpg_context.encrypt_file(
-                backup,
-                backup_recipients,
-                always_trust=True,
-                output=fs_backup_pgp
-            )
+        # stream the archive straight into gpg
+        members = []
+        if exists(join(self.fs_path, 'message')):
+            members.append(('message', join(self.fs_path, 'message')))
+        for fs_attachment in fs_source[source]:
+            members.append((split(fs_attachment)[-1], fs_attachment))
+
+        if background:
+            # open all files upfront, so they can be moved or removed in the meantime
+            members = [(arcname, open(fs_member, 'rb')) for arcname, fs_member in members]
+            task = BackgroundTask(self._encrypt_members, members, backup_recipients, fs_backup_pgp)
+            task.start()
+            return task
+
+        encrypt_zip(self.gpg_context, members, backup_recipients, fs_backup_pgp)
+        return fs_backup_pgp
 
-        # cleanup
-        remove(fs_backup)
+    def _encrypt_members(self, members, recipients, fs_backup_pgp):
+        try:
+            encrypt_zip(self.gpg_context, members, recipients, fs_backup_pgp)
+        finally:
+            for arcname, fileobj in members:
+                fileobj.close()
         return fs_backup_pgp
 
     def _create_backup(self):
         self.status = u'101 creating initial encrypted backup'
-        return self._create_encrypted_zip(source='dirty')
+        with self.timings.stage('backup', size=self.size_dirty_attachments):
+            return self._create_encrypted_zip(source='dirty')
+
+    def _create_backup_while_processing(self):
+        """ creates the initial encrypted backup in the background while the attachments are
+        being cleansed. returns the path to the backup just like `_create_backup`.
+
+        the backup is staged in the scratch directory, because a remote cleanser copies the
+        whole drop directory back and forth in the meantime."""
+        self.status = u'101 creating initial encrypted backup'
+        self.timings.start('backup', size=self.size_dirty_attachments)
+        backup = self._create_encrypted_zip(
+            source='dirty',
+            fs_target_dir=self.container.fs_scratch,
+            background=True)
+        if not isinstance(backup, BackgroundTask):
+            self._process_attachments()
+            self.timings.finish('backup')
+            return backup
+        fs_staged = join(self.container.fs_scratch, '%s.zip.pgp' % self.drop_id)
+        try:
+            # calling _process_attachments has the side-effect of updating `send_attachments`
+            self._process_attachments()
+            fs_backup_pgp = join(self.fs_path, 'dirty.zip.pgp')
+            shutil.move(backup.result(), fs_backup_pgp)
+        except Exception:
+            # never leave the backup running or staged behind
+            backup.join()
+            if exists(fs_staged):
+                remove(fs_staged)
+            raise
+        self.timings.finish('backup')
+        return fs_backup_pgp
 
     def _process_attachments(self):
         self.status = u'105 processing attachments'
@@ -316,10 +662,45 @@ class Dropbox(object):
         fs_config = join(self.settings['fs_bin_path'], 'briefkasten.conf')
         shellenv = environ.copy()
         shellenv['PATH'] = '%s:%s:/usr/local/bin/:/usr/local/sbin/' % (shellenv['PATH'], self.settings['fs_bin_path'])
-        call(
-            "%s -d %s -c %s" % (fs_process, self.fs_path, fs_config),
-            shell=True,
-            env=shellenv)
+        if self.cleanser_dispatcher is not None:
+            # the worker has already claimed a cleanser jail for us
+            shellenv['the_dispatcher'] = self.cleanser_dispatcher
+        self._detect_types()
+        self.timings.start('cleanser', size=self.size_dirty_attachments)
+        processes = int(self.settings.get('cleanser_processes') or 1)
+        native_types = self.settings.get('cleanser_native_types') or ()
+        types = self.attachment_types
+        fs_native, fs_others = split_native(self.fs_dirty_attachments, types, native_types)
+        statuses = []
+        if fs_native:
+            # cleanse the images of the `cleanser_native_types` in-process
+            statuses.append(cleanse_attachments(
+                fs_native,
+                self.fs_cleansed_attachment_container,
+                processes=processes,
+                types=types,
+                native_types=native_types))
+        if fs_others or not fs_native:
+            if self.settings.get('cleanser_processes'):
+                # cleanse locally, running up to `cleanser_processes` cleansers in parallel
+                statuses.append(cleanse_attachments(
+                    fs_others,
+                    self.fs_cleansed_attachment_container,
+                    processes=processes,
+                    env=shellenv,
+                    types=types))
+            else:
+                # attachments that have already been cleansed are skipped by the script
+                call(
+                    "%s -d %s -c %s" % (fs_process, self.fs_path, fs_config),
+                    shell=True,
+                    close_fds=True,
+                    env=shellenv)
+                self._import_cleanser_status()
+                statuses.append(self.status)
+        self.status = statuses[0] if len(statuses) == 1 else aggregate_status(
+            [(int(status.split()[0]), status.split(None, 1)[-1]) for status in statuses])
+        self.timings.finish('cleanser')
         # status is now < 500 if cleansing was successful or >= 500 && < 600 if cleansing failed
         # or 800 if cleansing was not supported
         # update the decision whether to include attachments in email or not based on size of cleansed attachments:
@@ -332,26 +713,42 @@ class Dropbox(object):
         else:
             self.send_attachments = False
 
-    def _create_archive(self):
+    def _detect_types(self):
+        """ sniffs the types of all attachments and records them in the manifest for the
+        cleanser and the notification of the editors"""
+        with self.timings.stage('types'):
+            write_manifest(self.fs_types_manifest, detect_types(self.fs_dirty_attachments))
+
+    def _create_archive(self, background=False):
         """ creates an encrypted archive of the dropbox outside of the drop directory.
         """
         self.status = u'270 creating final encrypted backup of cleansed attachments'
-        return self._create_encrypted_zip(source='clean', fs_target_dir=self.container.fs_archive_cleansed)
+        self.timings.start('archive', size=self.size_attachments)
+        archive = self._create_encrypted_zip(
+            source='clean',
+            fs_target_dir=self.container.fs_archive_cleansed,
+            background=background)
+        if not isinstance(archive, BackgroundTask):
+            self.timings.finish('archive')
+        return archive
 
     def _notify_editors(self):
         if self.send_attachments:
             attachments = self.fs_cleansed_attachments
         else:
             attachments = []
-        return sendMultiPart(
-            self.settings['smtp'],
-            self.gpg_context,
-            self.settings['mail.default_sender'],
-            self.editors,
-            u'Drop %s' % self.drop_id,
-            self._notification_text,
-            attachments
-        )
+        with self.timings.stage('notification', size=sum([stat(attachment).st_size for attachment in attachments])):
+            return sendMultiPart(
+                Counted(self.settings['smtp'], self.timings, 'smtp', ('sendmail',)),
+                self.gpg_context,
+                self.settings['mail.default_sender'],
+                self.editors,
+                u'Drop %s' % self.drop_id,
+                self._notification_text,
+                attachments,
+                keyring=self.keyring,
+                encrypt_once=self.settings.get('mail.encrypt_once', False),
+            )
 
     #
     # helper properties:
@@ -359,10 +756,13 @@ class Dropbox(object):
     @property
     def num_attachments(self):
         """returns the current number of uploaded attachments in the filesystem"""
-        if exists(self.fs_attachment_container):
-            return len(listdir(self.fs_attachment_container))
-        else:
-            return 0
+        return len(self.fs_dirty_attachments)
+
+    @property
+    def attachment_types(self):
+        """ returns the types of the (uploaded) attachments by file name as recorded in the
+        manifest, i.e. `{u'TUP59D2f.png': 'image/png; charset=binary'}`"""
+        return read_manifest(self.fs_types_manifest)
 
     @property
     def size_attachments(self):
@@ -372,14 +772,15 @@ class Dropbox(object):
                 total_size += stat(attachment).st_size
         return total_size
 
+    @property
+    def size_dirty_attachments(self):
+        """returns the number of bytes that the uploaded attachments take up on disk"""
+        return sum([stat(attachment).st_size for attachment in self.fs_dirty_attachments])
+
     @property
     def replies(self):
         """ returns a list of strings """
-        fs_reply_path = join(self.fs_replies_path, 'message_001.txt')
-        if exists(fs_reply_path):
-            return [load(open(fs_reply_path, 'r'))]
-        else:
-            return []
+        return self.metadata.get('replies', [])
 
     @property
     def message(self):
@@ -398,29 +799,26 @@ class Dropbox(object):
 
     @property
     def from_watchdog(self):
-        try:
-            with open(join(self.fs_path, u'from_watchdog')):
-                return True
-        except IOError:
-            return False
+        return self.metadata.get('from_watchdog', False)
 
     @from_watchdog.setter
     def from_watchdog(self, value):
-        fs_path = join(self.fs_path, u'from_watchdog')
-        if value:
-            with open(fs_path, 'w') as status_file:
-                status_file.write('True')
-        else:
-            if exists(fs_path):
-                remove(fs_path)
+        self._update_metadata(from_watchdog=bool(value))
+
+    @property
+    def editor_token(self):
+        return self.metadata.get('editor_token')
 
     @property
     def status(self):
-        try:
-            with open(join(self.fs_path, u'status')) as status_file:
-                return status_file.readline()
-        except IOError:
+        status = self.metadata.get('status')
+        if status is None:
             return u'000 no status file'
+        if 100 <= int(status.split()[0]) < 200:
+            # while the attachments are being processed the cleanser reports its progress
+            # in a separate status file
+            return self._read_cleanser_status() or status
+        return status
 
     @property
     def status_int(self):
@@ -429,8 +827,98 @@ class Dropbox(object):
 
     @status.setter
     def status(self, state):
-        with open(join(self.fs_path, u'status'), 'w') as status_file:
-            status_file.write(state)
+        self._update_metadata(status=state, status_changed=time())
+
+    #
+    # the metadata record:
+
+    @property
+    def metadata(self):
+        """ returns the metadata record of the drop (its status, editor token, replies etc.)
+        it is read from disk only once per instance and kept up to date by all setters."""
+        if self._metadata is None:
+            metadata = self._read_metadata()
+            if metadata is None:
+                # drops created by earlier versions keep each property in a separate file
+                metadata = self._read_legacy_metadata()
+                if metadata:
+                    self._migrate_metadata(metadata)
+            self._metadata = metadata
+        return self._metadata
+
+    def _read_metadata(self):
+        try:
+            with open(self.fs_metadata) as fs_metadata:
+                return load(fs_metadata)
+        except IOError:
+            return None
+
+    def _update_metadata(self, update=None, **changes):
+        """ applies the given changes to the metadata record. `update` may be a callable
+        that changes the (current) record in place.
+
+        the record is read again while holding a lock on the drop directory, so that
+        concurrent changes of other properties (i.e. by the web application and the worker)
+        aren't lost, and it is replaced atomically, so readers never see a partial record."""
+        fd_dropbox = open_fd(self.fs_path, O_RDONLY)
+        try:
+            flock(fd_dropbox, LOCK_EX)
+            metadata = self._read_metadata() or dict()
+            metadata.update(changes)
+            if update is not None:
+                update(metadata)
+            fd_metadata, fs_tmp = mkstemp(prefix='.metadata', dir=self.fs_path)
+            with fdopen(fd_metadata, 'w') as fs_metadata:
+                fs_metadata.write(dumps(metadata))
+            chmod(fs_tmp, 0660)
+            rename(fs_tmp, self.fs_metadata)
+            try:
+                self.container.index.update(self.drop_id, metadata)
+            except (sqlite3.Error, ValueError) as exc:
+                # the index is only a cache, it's fixed by the next update or a `reindex`
+                print('Updating the index for drop %s failed: %s' % (self.drop_id, exc))
+        finally:
+            close_fd(fd_dropbox)
+        self._metadata = metadata
+
+    def _read_legacy_metadata(self):
+        metadata = dict()
+        fs_status = join(self.fs_path, u'status')
+        if exists(fs_status):
+            metadata['status'] = open(fs_status).readline().decode('utf-8')
+            metadata['status_changed'] = getmtime(fs_status)
+        if exists(join(self.fs_path, u'editor_token')):
+            metadata['editor_token'] = open(join(self.fs_path, u'editor_token')).readline().decode('utf-8')
+            # the token is written when the drop is created and never changed
+            metadata['created'] = getmtime(join(self.fs_path, u'editor_token'))
+        if exists(join(self.fs_path, u'from_watchdog')):
+            metadata['from_watchdog'] = True
+        if exists(join(self.fs_replies_path, u'message_001.txt')):
+            metadata['replies'] = [load(open(join(self.fs_replies_path, u'message_001.txt')))]
+        return metadata
+
+    def _migrate_metadata(self, metadata):
+        """ writes the metadata of a drop created by an earlier version into a record
+        and removes the separate files"""
+        self._update_metadata(**metadata)
+        for fs_name in [u'status', u'editor_token', u'from_watchdog']:
+            if exists(join(self.fs_path, fs_name)):
+                remove(join(self.fs_path, fs_name))
+        shutil.rmtree(self.fs_replies_path, ignore_errors=True)
+
+    def _read_cleanser_status(self):
+        try:
+            with open(join(self.fs_path, u'status')) as status_file:
+                return status_file.readline().decode('utf-8') or None
+        except IOError:
+            return None
+
+    def _import_cleanser_status(self):
+        """ moves the final status reported by the cleanser into the metadata record"""
+        status = self._read_cleanser_status()
+        if status is not None:
+            self.status = status
+            remove(join(self.fs_path, u'status'))
 
     def _write_message(self, fs_container, fs_name, message):
         if message is None:
@@ -448,6 +936,7 @@ class Dropbox(object):
     def _notification_text(self):
         return jinja_env.get_template('editor_email.j2').render(
             num_attachments=self.num_attachments,
+            attachment_types=sorted([(name, the_type.split(';')[0]) for name, the_type in self.attachment_types.items()]),
             dropbox=self)
 
     @property
@@ -458,8 +947,10 @@ class Dropbox(object):
     def fs_dirty_attachments(self):
         """ returns a list of absolute paths to the attachements"""
         if exists(self.fs_attachment_container):
+            # hidden files are incomplete uploads
             return [join(self.fs_attachment_container, attachment)
-                    for attachment in listdir(self.fs_attachment_container)]
+                    for attachment in listdir(self.fs_attachment_container)
+                    if not attachment.startswith('.')]
         else:
             return []
 
@@ -467,8 +958,10 @@ class Dropbox(object):
     def fs_cleansed_attachments(self):
         """ returns a list of absolute paths to the cleansed attachements"""
         if exists(self.fs_cleansed_attachment_container):
+            # hidden files are no attachments (i.e. the types manifest)
             return [join(self.fs_cleansed_attachment_container, attachment)
-                    for attachment in listdir(self.fs_cleansed_attachment_container)]
+                    for attachment in listdir(self.fs_cleansed_attachment_container)
+                    if not attachment.startswith('.')]
         else:
             return []
 
@@ -494,13 +987,11 @@ class Dropbox(object):
 
     def last_changed(self):
         # TODO: maybe use last reply from editor
-        if exists(join(self.fs_path, u'status')):
-            mtime = getmtime(join(self.fs_path, u'status'))
-            return datetime.utcfromtimestamp(mtime)
-        return datetime.utcfromtimestamp(0)
+        return datetime.utcfromtimestamp(self.metadata.get('status_changed', 0))
 
     def destroy(self):
         shutil.rmtree(self.fs_path)
+        self.container.index.remove(self.drop_id)
 
     def __repr__(self):
         return u'Dropbox %s (%s) at %s' % (
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+""" detection of the mime types of attachments by their magic bytes.
+
+instead of running `file -bi` for each attachment (once in the cleanser and possibly again
+elsewhere) the types of all attachments of a drop are sniffed in a single pass when it is
+processed and recorded in a manifest next to the attachments (`attach/.types`, one
+tab-separated line of file name and type per attachment). `process-attachments.sh`, the
+python cleanser driver and the notification of the editors all read the manifest.
+
+the types are reported like `file -bi` does (i.e. `image/png; charset=binary` or
+`text/plain; charset=us-ascii`). the signatures only cover the formats that matter to the
+cleansers, everything else is reported as `application/octet-stream` which is treated as
+not cleansible, so an unknown format never ends up being handled as plain text.
+"""
+import re
+from os import chmod, fdopen, rename
+from os.path import basename, dirname
+from struct import error as struct_error, unpack_from
+from tempfile import mkstemp
+from unicodedata import category
+
+
+# how many bytes of each file are inspected
+sniff_size = 65536
+
+# signatures of binary formats, matched against the start of the file in order. types
+# without a charset are reported as binary
+binary_signatures = [
+    (r'%PDF-', 'application/pdf'),
+    (r'\x89PNG\r\n\x1a\n', 'image/png'),
+    (r'\xff\xd8\xff', 'image/jpeg'),
+    (r'GIF8[79]a', 'image/gif'),
+    (r'II\*\x00|MM\x00\*', 'image/tiff'),
+    (r'BM.{4}\x00\x00\x00\x00', 'image/bmp'),
+    (r'RIFF.{4}WEBP', 'image/webp'),
+    (r'RIFF.{4}WAVE', 'audio/x-wav'),
+    (r'RIFF.{4}AVI ', 'video/x-msvideo'),
+    (r'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/CDFV2'),
+    (r'PK\x03\x04', 'application/zip'),
+    (r'\x1f\x8b', 'application/gzip'),
+    (r'BZh[1-9]', 'application/x-bzip2'),
+    (r'\xfd7zXZ\x00', 'application/x-xz'),
+    (r'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (r'Rar!\x1a\x07', 'application/x-rar'),
+    (r'.{257}ustar', 'application/x-tar'),
+    (r'\xff\xfe', 'text/plain; charset=utf-16le'),
+    (r'\xfe\xff', 'text/plain; charset=utf-16be'),
+    (r'ID3|\xff[\xe2-\xff]', 'audio/mpeg'),
+    (r'OggS', 'audio/ogg'),
+    (r'fLaC', 'audio/flac'),
+    (r'.{4}ftyp(?:qt  )', 'video/quicktime'),
+    (r'.{4}ftyp', 'video/mp4'),
+    (r'\x1aE\xdf\xa3', 'video/webm'),
+    (r'\x7fELF', 'application/x-executable'),
+    (r'MZ', 'application/x-dosexec'),
+]
+
+# signatures of textual formats (other than plain text)
+text_signatures = [
+    (r'\s*<!doctype\s+html', 'text/html'),
+    (r'\s*<(?:html|head|body|script|iframe|frameset|title|style|table|div|h1|font|br|p|a)[\s>]', 'text/html'),
+    (r'\s*<\?xml', 'text/xml'),
+    (r'\s*<svg', 'image/svg+xml'),
+    (r'\{\\rtf', 'text/rtf'),
+    (r'#!', 'text/x-shellscript'),
+    (r'%!', 'application/postscript'),
+    (r'-----BEGIN PGP', 'application/pgp'),
+    (r'(?:From |Return-Path:|Received:|Message-ID:)', 'message/rfc822'),
+    (r'BEGIN:VCARD', 'text/vcard'),
+    (r'BEGIN:VCALENDAR', 'text/calendar'),
+]
+
+
+def compile_signatures(signatures, flags=0):
+    """ compiles the given signatures into a single expression, each signature becomes a
+    group of its own so the matching one can be looked up by `match.lastindex`"""
+    expression = re.compile('|'.join(['(%s)' % pattern for pattern, mime_type in signatures]), flags)
+    return expression, [None] + [mime_type for pattern, mime_type in signatures]
+
+
+binary_table = compile_signatures(binary_signatures, re.DOTALL)
+text_table = compile_signatures(text_signatures, re.IGNORECASE)
+
+# bytes that don't occur in text (everything below 0x20 except BEL, BS, TAB, LF, VT, FF, CR and ESC)
+binary_chars = re.compile(r'[\x00-\x06\x0e-\x1a\x1c-\x1f\x7f]')
+c1_chars = re.compile(r'[\x80-\x9f]')
+# the same (as well as the c1 control characters) for decoded text
+unicode_binary_chars = re.compile(u'[\x00-\x06\x0e-\x1a\x1c-\x1f\x7f-\x9f\ufffe\uffff]')
+
+# the mime types stored in the `mimetype` member of opendocument (and epub) files
+zip_mimetype = re.compile(r'application/(?:vnd\.oasis\.opendocument\.[a-z-]+(?:\.[a-z-]+)*|epub\+zip)(?=PK|$)')
+
+
+def match_signature(table, head):
+    expression, mime_types = table
+    match = expression.match(head)
+    if match is not None:
+        return mime_types[match.lastindex]
+
+
+def text_charset(head, truncated=False):
+    """ returns the charset of the given text or `None` if it isn't text"""
+    if binary_chars.search(head):
+        return None
+    try:
+        head.decode('ascii')
+        return 'us-ascii'
+    except UnicodeDecodeError:
+        pass
+    try:
+        head.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as error:
+        # the head may end in the middle of a character
+        if truncated and error.start >= len(head) - 3:
+            return 'utf-8'
+    if not c1_chars.search(head):
+        return 'iso-8859-1'
+
+
+def _utf16_type(fileobj, head):
+    """ makes sure that a file starting with a utf-16 byte order mark actually is text"""
+    the_type = 'text/plain; charset=utf-16%s' % ('le' if head.startswith('\xff\xfe') else 'be')
+    text = head[2:len(head) - len(head) % 2]
+    try:
+        text = text.decode(the_type[-8:])
+    except UnicodeDecodeError as error:
+        # the head may end in the middle of a surrogate pair
+        if len(head) < sniff_size or error.start < len(text) - 2:
+            return 'application/octet-stream'
+        text = text[:error.start].decode(the_type[-8:])
+    if unicode_binary_chars.search(text):
+        return 'application/octet-stream'
+    # unassigned, private and surrogate code points don't occur in text either
+    if set(map(category, set(text))) & set(['Cn', 'Co', 'Cs']):
+        return 'application/octet-stream'
+    return the_type
+
+
+def _compound_document_type(fileobj, head):
+    """ tells apart word, excel and powerpoint files (as `file` does) by looking at the
+    names in the first sector of the directory of the compound document"""
+    if len(head) < 0x34:
+        return 'application/CDFV2'
+    sector_shift = unpack_from('<H', head, 0x1e)[0]
+    if sector_shift not in (9, 12):
+        return 'application/CDFV2'
+    sector_size = 1 << sector_shift
+    fileobj.seek((unpack_from('<I', head, 0x30)[0] + 1) * sector_size)
+    directory = fileobj.read(sector_size)
+    for name, mime_type in [
+            (u'WordDocument', 'application/msword'),
+            (u'Workbook', 'application/vnd.ms-excel'),
+            (u'Book', 'application/vnd.ms-excel'),
+            (u'PowerPoint Document', 'application/vnd.ms-powerpoint')]:
+        if name.encode('utf-16le') in directory:
+            return mime_type
+    return 'application/CDFV2'
+
+
+def _zip_type(fileobj, head):
+    """ recognizes opendocument and office open xml files"""
+    if head[30:38] == 'mimetype':
+        # the first member is stored uncompressed, its contents follow its name
+        match = zip_mimetype.match(head, 38)
+        if match is not None:
+            return match.group()
+    if '[Content_Types].xml' in head:
+        for member, mime_type in [
+                ('word/', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+                ('xl/', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+                ('ppt/', 'application/vnd.openxmlformats-officedocument.presentationml.presentation')]:
+            if member in head:
+                return mime_type
+    return 'application/zip'
+
+
+# further inspection of container formats
+refinements = {
+    'text/plain; charset=utf-16le': _utf16_type,
+    'text/plain; charset=utf-16be': _utf16_type,
+    'application/CDFV2': _compound_document_type,
+    'application/zip': _zip_type,
+}
+
+
+def detect_type(fs_path):
+    """ returns the type of the given file in the format of `file -bi`"""
+    with open(fs_path, 'rb') as fileobj:
+        head = fileobj.read(sniff_size)
+        if not head:
+            return 'inode/x-empty; charset=binary'
+        mime_type = match_signature(binary_table, head)
+        if mime_type in refinements:
+            try:
+                mime_type = refinements[mime_type](fileobj, head)
+            except (struct_error, OverflowError, ValueError, IOError):
+                # a malformed container is reported by its basic type
+                pass
+    if mime_type is not None:
+        return mime_type if ';' in mime_type else '%s; charset=binary' % mime_type
+    charset = text_charset(head, truncated=len(head) == sniff_size)
+    if charset is None:
+        return 'application/octet-stream; charset=binary'
+    return '%s; charset=%s' % (match_signature(text_table, head) or 'text/plain', charset)
+
+
+def detect_types(fs_paths):
+    """ returns a list of `(name, type)` tuples for the given files, files that can't be
+    read are left out and those that can't be parsed are reported as binary"""
+    types = []
+    for fs_path in fs_paths:
+        try:
+            types.append((basename(fs_path), detect_type(fs_path)))
+        except (IOError, OSError):
+            continue
+        except Exception:
+            types.append((basename(fs_path), 'application/octet-stream; charset=binary'))
+    return types
+
+
+def write_manifest(fs_manifest, types):
+    """ (atomically) writes the given `(name, type)` tuples into the given manifest. names
+    that can't be represented in it are left out, their type is detected again by whoever
+    needs it."""
+    fd_manifest, fs_tmp = mkstemp(prefix='.types', dir=dirname(fs_manifest))
+    with fdopen(fd_manifest, 'w') as manifest:
+        for name, the_type in types:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            if '\t' in name or '\n' in name:
+                continue
+            manifest.write('%s\t%s\n' % (name, the_type))
+    chmod(fs_tmp, 0660)
+    rename(fs_tmp, fs_manifest)
+
+
+def read_manifest(fs_manifest):
+    """ returns the types recorded in the given manifest as dictionary by file name"""
+    types = dict()
+    try:
+        with open(fs_manifest) as manifest:
+            for line in manifest:
+                name, sep, the_type = line.rstrip('\n').partition('\t')
+                if sep:
+                    types[name.decode('utf-8', 'replace')] = the_type
+    except IOError:
+        pass
+    return types
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+""" removing the metadata from images without converting them.
+
+`process-image.sh` gets rid of the metadata of an image by converting it to a bitmap and
+back using netpbm, which means decoding (and for jpeg re-encoding at default quality) the
+whole image. jpeg and png files keep their metadata in segments (or chunks) of their own,
+though, so for those it is enough to copy the file leaving out everything but the image
+data:
+
+- from jpeg files all application segments (exif, xmp, iptc, icc profiles, thumbnails...)
+  and comments are removed, only the basic jfif header (without its thumbnail) and the
+  adobe colour transform flags are kept, as is the compressed image data itself.
+- from png files all chunks but the image data and those needed to render it properly
+  (palette, transparency, gamma and colour space, background and animation) are removed,
+  i.e. text, exif and timestamp chunks.
+
+the image data is copied as is, so there is no loss in quality. files that don't parse
+raise an `InvalidImage` error.
+"""
+import re
+from os.path import basename, join
+from struct import pack, unpack, unpack_from
+from zlib import crc32
+
+
+class InvalidImage(ValueError):
+    """ raised when an image can't be parsed"""
+
+
+jpeg_soi = '\xff\xd8'
+jpeg_eoi = '\xff\xd9'
+
+# the start of a marker within the entropy coded data following a SOS segment, i.e. an
+# 0xff which isn't followed by a stuffed zero byte or a restart marker
+jpeg_marker = re.compile(r'\xff[^\x00\xd0-\xd7]')
+
+
+def _jpeg_segment(marker, payload):
+    """ returns the given segment as it should be kept or `None` if it should be removed"""
+    if marker == 0xe0:
+        # keep the jfif header, but without its thumbnail
+        if payload.startswith('JFIF\x00') and len(payload) >= 14:
+            payload = payload[:12] + '\x00\x00'
+        else:
+            return None
+    elif marker == 0xee:
+        # the adobe segment tells how to convert the colours
+        if not payload.startswith('Adobe'):
+            return None
+    elif 0xe1 <= marker <= 0xef or marker == 0xfe:
+        return None
+    return pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+
+
+def strip_jpeg(data):
+    """ returns the given jpeg image without its metadata"""
+    if not data.startswith(jpeg_soi):
+        raise InvalidImage('Not a jpeg image')
+    cleansed = [jpeg_soi]
+    size = len(data)
+    position = 2
+    while True:
+        if data[position:position + 1] != '\xff':
+            raise InvalidImage('Expected a marker at offset %d' % position)
+        # skip fill bytes
+        while data[position:position + 1] == '\xff':
+            position += 1
+        if position >= size:
+            raise InvalidImage('Truncated image')
+        marker = ord(data[position])
+        position += 1
+        if marker == 0xd9:
+            # anything following the end of the image is dropped
+            cleansed.append(jpeg_eoi)
+            return ''.join(cleansed)
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            # markers without a payload
+            cleansed.append(pack('>BB', 0xff, marker))
+            continue
+        if position + 2 > size:
+            raise InvalidImage('Truncated image')
+        length = unpack_from('>H', data, position)[0]
+        if length < 2 or position + length > size:
+            raise InvalidImage('Invalid segment length at offset %d' % position)
+        segment = _jpeg_segment(marker, data[position + 2:position + length])
+        if segment is not None:
+            cleansed.append(segment)
+        position += length
+        if marker == 0xda:
+            # copy the entropy coded data up to the next marker
+            match = jpeg_marker.search(data, position)
+            if match is None:
+                raise InvalidImage('Truncated image')
+            cleansed.append(data[position:match.start()])
+            position = match.start()
+
+
+png_signature = '\x89PNG\r\n\x1a\n'
+
+# the chunks kept in png images
+png_chunks = frozenset([
+    'IHDR', 'PLTE', 'IDAT', 'IEND',
+    'tRNS', 'gAMA', 'cHRM', 'sRGB', 'sBIT', 'bKGD',
+    'acTL', 'fcTL', 'fdAT'])
+
+
+def strip_png(data):
+    """ returns the given png image without its metadata"""
+    if not data.startswith(png_signature):
+        raise InvalidImage('Not a png image')
+    cleansed = [png_signature]
+    size = len(data)
+    position = len(png_signature)
+    while position + 12 <= size:
+        length, kind = unpack_from('>I4s', data, position)
+        end = position + 12 + length
+        if end > size:
+            raise InvalidImage('Truncated image')
+        if crc32(data[position + 4:end - 4]) & 0xffffffff != unpack('>I', data[end - 4:end])[0]:
+            raise InvalidImage('Invalid checksum of %r chunk at offset %d' % (kind, position))
+        if kind in png_chunks:
+            cleansed.append(data[position:end])
+        elif not ord(kind[0]) & 0x20:
+            # an unknown chunk that is critical to the image
+            raise InvalidImage('Unsupported %r chunk at offset %d' % (kind, position))
+        position = end
+        if kind == 'IEND':
+            return ''.join(cleansed)
+    raise InvalidImage('Truncated image')
+
+
+# the image formats that can be cleansed in-process
+strippers = {
+    'image/jpeg': strip_jpeg,
+    'image/png': strip_png,
+}
+
+
+def cleanse_image(fs_image, fs_target, mime_type):
+    """ writes the given image without its metadata into the target directory (under the
+    same name, just like `process-image.sh`) and returns its path"""
+    with open(fs_image, 'rb') as image:
+        cleansed = strippers[mime_type](image.read())
+    fs_cleansed = join(fs_target, basename(fs_image))
+    with open(fs_cleansed, 'wb') as image:
+        image.write(cleansed)
+    return fs_cleansed
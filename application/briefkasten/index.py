@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+""" a persistent index of all drops of a container.
+
+it maps each drop id to the key facts of its metadata record (status code, creation and
+last change, whether it is a watchdog drop and the size of its attachments), so that
+listing drops or finding expired ones doesn't have to open every drop directory.
+
+the index is only a cache: `Dropbox` keeps it up to date whenever its metadata record
+changes and it can be rebuilt from the drop directories at any time.
+"""
+import sqlite3
+from os import getpid
+from threading import local
+
+
+schema = '''
+    create table if not exists drops (
+        drop_id text primary key,
+        status_int integer,
+        created real,
+        last_changed real,
+        from_watchdog integer not null default 0,
+        size integer not null default 0);
+    create index if not exists drops_last_changed on drops (from_watchdog, last_changed);
+'''
+
+
+class DropIndex(object):
+
+    def __init__(self, fs_index):
+        self.fs_index = fs_index
+        self.connections = local()
+
+    @property
+    def connection(self):
+        """ returns the connection of the current thread. connections aren't shared between
+        threads and are re-opened after a fork."""
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None or self.connections.pid != getpid():
+            connection = sqlite3.connect(self.fs_index, timeout=30)
+            # the index can always be rebuilt, so there's no need to wait for the disk
+            connection.execute('pragma journal_mode=wal')
+            connection.execute('pragma synchronous=normal')
+            connection.executescript(schema)
+            self.connections.connection = connection
+            self.connections.pid = getpid()
+        return connection
+
+    def update(self, drop_id, metadata):
+        """ stores the given metadata record of a drop. (legacy) records without a time of
+        their last change are treated as unchanged since the epoch, like `Dropbox.last_changed`
+        does."""
+        status = metadata.get('status')
+        with self.connection as connection:
+            connection.execute(
+                'insert or replace into drops values (?, ?, ?, ?, ?, ?)', (
+                    drop_id,
+                    int(status.split()[0]) if status else None,
+                    metadata.get('created'),
+                    metadata.get('status_changed') or 0,
+                    bool(metadata.get('from_watchdog')),
+                    metadata.get('size', 0)))
+
+    def remove(self, *drop_ids):
+        with self.connection as connection:
+            connection.executemany('delete from drops where drop_id = ?', [(drop_id,) for drop_id in drop_ids])
+
+    def clear(self):
+        with self.connection as connection:
+            connection.execute('delete from drops')
+
+    def get(self, drop_id):
+        """ returns the indexed facts of the given drop as a dictionary or `None`"""
+        cursor = self.connection.execute(
+            'select drop_id, status_int, created, last_changed, from_watchdog, size '
+            'from drops where drop_id = ?', (drop_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(
+            ['drop_id', 'status_int', 'created', 'last_changed', 'from_watchdog', 'size'], row))
+
+    def expired(self, before, from_watchdog=False):
+        """ returns the ids of all (watchdog) drops that haven't changed since `before`
+        (a unix timestamp), oldest first"""
+        cursor = self.connection.execute(
+            'select drop_id from drops where from_watchdog = ? and last_changed <= ? '
+            'order by last_changed', (bool(from_watchdog), before))
+        return [row[0] for row in cursor]
+
+    def unprocessed(self):
+        """ returns the ids of all drops that haven't been processed (yet), oldest first"""
+        cursor = self.connection.execute(
+            'select drop_id from drops where status_int < 100 order by created')
+        return [row[0] for row in cursor]
+
+    def __iter__(self):
+        cursor = self.connection.execute('select drop_id from drops order by created')
+        return iter([row[0] for row in cursor])
+
+    def __len__(self):
+        return self.connection.execute('select count(*) from drops').fetchone()[0]
+
+    def __contains__(self, drop_id):
+        return self.get(drop_id) is not None
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" removes expired drops (and abandoned uploads) from a container.
+
+drops are removed in batches: the directories of each batch are removed by a small pool
+of threads (so slow disks don't serialize the whole sweep) and afterwards the batch is
+removed from the drop index in a single transaction. an optional rate limit keeps a large
+sweep (i.e. after an outage) from starving the I/O of the running application.
+"""
+import shutil
+from multiprocessing.pool import ThreadPool
+from os import lstat, walk
+from os.path import exists, join
+from time import sleep, time
+
+
+def disk_usage(fs_path):
+    """ returns the number of bytes taken up by the files below the given directory"""
+    total_size = 0
+    for fs_dir, dirnames, filenames in walk(fs_path):
+        for filename in filenames:
+            try:
+                total_size += lstat(join(fs_dir, filename)).st_size
+            except OSError:
+                pass
+    return total_size
+
+
+def _remove_drop(args):
+    """ removes the given drop directory and returns whether it is gone (or would be) and
+    the number of bytes that were (or would have been) reclaimed"""
+    fs_drop, dry_run = args
+    if not exists(fs_drop):
+        return True, 0
+    size = disk_usage(fs_drop)
+    if not dry_run:
+        shutil.rmtree(fs_drop, ignore_errors=True)
+        if exists(fs_drop):
+            print('Could not remove %s' % fs_drop)
+            return False, 0
+    return True, size
+
+
+def expire_uploads(drop_root, max_age, dry_run=False):
+    """ removes the abandoned resumable uploads of all drops that haven't been processed.
+    returns the number of drops that had any and the number of bytes that were (or would
+    have been) reclaimed."""
+    num_drops = 0
+    size_removed = 0
+    for drop_id in drop_root.index.unprocessed():
+        if drop_id not in drop_root:
+            continue
+        drop = drop_root.get_dropbox(drop_id)
+        if not drop.metadata.get('uploads') and not exists(drop.fs_attachment_container):
+            continue
+        size = drop.expire_uploads(max_age, dry_run=dry_run)
+        if size:
+            num_drops += 1
+            size_removed += size
+    return num_drops, size_removed
+
+
+def sweep(drop_root, drop_ids, dry_run=False, threads=4, batch_size=100, max_rate=None):
+    """ removes the given drops from the container and its index.
+
+    at most `max_rate` drops are removed per second, with `dry_run` nothing is removed at
+    all. drops whose directories can't be removed are kept in the index. returns the number
+    of drops and the number of bytes that were (or would have been) reclaimed."""
+    drop_ids = list(drop_ids)
+    if max_rate:
+        # a single batch shouldn't exceed a second's worth of deletions
+        batch_size = max(1, min(batch_size, int(max_rate)))
+    num_processed = 0
+    num_removed = 0
+    size_removed = 0
+    started = time()
+    pool = ThreadPool(processes=max(1, threads))
+    try:
+        for offset in range(0, len(drop_ids), batch_size):
+            batch = drop_ids[offset:offset + batch_size]
+            results = pool.map(_remove_drop, [(join(drop_root.fs_path, drop_id), dry_run) for drop_id in batch])
+            removed = [drop_id for drop_id, (gone, size) in zip(batch, results) if gone]
+            if removed and not dry_run:
+                drop_root.index.remove(*removed)
+            num_processed += len(batch)
+            num_removed += len(removed)
+            size_removed += sum([size for gone, size in results])
+            if max_rate and not dry_run:
+                # wait until we're back within the allowed rate
+                ahead = num_processed / float(max_rate) - (time() - started)
+                if ahead > 0:
+                    sleep(ahead)
+    finally:
+        pool.close()
+        pool.join()
+    return num_removed, size_removed
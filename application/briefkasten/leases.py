@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+""" leases on the remote cleanser jails managed by jdispatch.
+
+jdispatch provides a directory per cleanser jail in its dispatch directory (i.e.
+`/var/run/jdispatch/cleanser_01`) containing the jail's address (`ip`) and a `release`
+script. the `claim` script at the top of the dispatch directory (the `the_jdispatcher_dir`
+of `briefkasten.conf`) takes a free jail and prints its directory. a jail is taken while
+its `token/taken` file exists, releasing it makes jdispatch roll the jail back and offer it
+again.
+
+instead of letting each `process-attachments.sh` try to claim a jail three times with ten
+seconds of sleep in between, the worker acquires a lease on a jail for each drop up front
+and passes it to the script (see `Dropbox.cleanser_dispatcher`). drops waiting for a jail
+are served first come, first served; whenever a lease is released the next waiter is
+woken right away, otherwise the dispatch directory is checked every `poll_interval`
+seconds. optionally each jail is health checked (by connecting to its ssh port) before it
+is handed out, unhealthy jails are released again (and thus recycled by jdispatch).
+"""
+from collections import deque
+from os import listdir
+from os.path import basename, exists, isdir, isfile, join
+from socket import create_connection, error as socket_error
+from subprocess import CalledProcessError, call, check_output
+from threading import Condition
+from time import time
+
+from .metrics import StageHistograms
+
+
+class Lease(object):
+    """ a claimed cleanser jail"""
+
+    def __init__(self, fs_path, address, waited=0):
+        self.fs_path = fs_path
+        self.address = address
+        self.waited = waited
+        self.acquired = time()
+
+    @property
+    def name(self):
+        return basename(self.fs_path)
+
+    def __repr__(self):
+        return '<Lease %s (%s)>' % (self.name, self.address)
+
+
+class LeaseManager(object):
+    """ hands out leases on the jails in the given jdispatch directory.
+
+    leases that haven't been released after `lease_timeout` seconds are forgotten (jdispatch
+    reaps such jails by itself). the time each acquisition had to wait is kept in
+    `wait_times`."""
+
+    wait_buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self, fs_dispatcher, lease_timeout=None, poll_interval=0.5, health_check=False,
+            health_timeout=2):
+        self.fs_dispatcher = fs_dispatcher
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.health_check = health_check
+        self.health_timeout = health_timeout
+        self.leases = dict()
+        self.waiters = deque()
+        self.wait_times = StageHistograms(buckets=self.wait_buckets)
+        self.timeouts = 0
+        self.expired = 0
+        self.unhealthy = 0
+        # the lock only guards the bookkeeping, claiming, health checking and releasing
+        # jails happens outside of it. `generation` is increased whenever a lease is released
+        # or a waiter leaves the queue, so waiters don't miss that while they are claiming
+        self.condition = Condition()
+        self.generation = 0
+
+    def jails(self):
+        """ returns the paths of all jails offered by jdispatch"""
+        if not isdir(self.fs_dispatcher):
+            return []
+        return [join(self.fs_dispatcher, name) for name in sorted(listdir(self.fs_dispatcher))
+            if isfile(join(self.fs_dispatcher, name, 'ip'))]
+
+    def address(self, fs_jail):
+        """ returns the `(host, port)` of the given jail or `None` if it isn't configured
+        (properly) or fails the health check"""
+        try:
+            with open(join(fs_jail, 'ip')) as ip:
+                host, port = ip.read().strip().rsplit(':', 1)
+            address = (host, int(port or 22))
+        except (IOError, ValueError):
+            return None
+        if self.health_check:
+            try:
+                create_connection(address, timeout=self.health_timeout).close()
+            except (socket_error, IOError):
+                self.unhealthy += 1
+                return None
+        return address
+
+    def _claim(self):
+        """ claims jails until one of them is usable and returns a lease on it or `None` if
+        there is no (usable) jail left. the unusable ones are released afterwards, so they
+        aren't claimed over and over again."""
+        unusable = []
+        try:
+            while True:
+                try:
+                    fs_jail = check_output([join(self.fs_dispatcher, 'claim')], close_fds=True).strip()
+                except (CalledProcessError, OSError):
+                    return None
+                if not fs_jail or fs_jail in unusable:
+                    return None
+                address = self.address(fs_jail)
+                if address is not None:
+                    return Lease(fs_jail, address)
+                print('Releasing unusable cleanser %s' % basename(fs_jail))
+                unusable.append(fs_jail)
+        finally:
+            for fs_jail in unusable:
+                call([join(fs_jail, 'release')], close_fds=True)
+
+    def expire(self):
+        """ forgets about leases that have been held for longer than `lease_timeout`"""
+        if not self.lease_timeout:
+            return
+        with self.condition:
+            for name, lease in self.leases.items():
+                if time() - lease.acquired > self.lease_timeout:
+                    print('Lease on cleanser %s expired after %d seconds' % (name, self.lease_timeout))
+                    del self.leases[name]
+                    self.expired += 1
+
+    def acquire(self, timeout=None):
+        """ waits up to `timeout` seconds for a jail and returns a lease on it or `None`"""
+        started = time()
+        waiter = object()
+        with self.condition:
+            self.waiters.append(waiter)
+        try:
+            while True:
+                self.expire()
+                with self.condition:
+                    # only the longest waiting caller may claim a jail
+                    first = self.waiters[0] is waiter
+                    generation = self.generation
+                if first:
+                    lease = self._claim()
+                    if lease is not None:
+                        lease.waited = time() - started
+                        with self.condition:
+                            self.leases[lease.name] = lease
+                            self.wait_times.observe_duration('wait', lease.waited)
+                        return lease
+                with self.condition:
+                    wait = self.poll_interval
+                    if timeout is not None:
+                        remaining = started + timeout - time()
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            self.wait_times.observe_duration('wait', time() - started)
+                            return None
+                        wait = min(wait, remaining)
+                    if self.generation == generation:
+                        self.condition.wait(wait)
+        finally:
+            with self.condition:
+                self.waiters.remove(waiter)
+                self.generation += 1
+                self.condition.notify_all()
+
+    def release(self, lease):
+        """ returns the given lease. the jail is released unless that has already been
+        done (i.e. by `process-attachments.sh`)"""
+        if lease is None:
+            return
+        with self.condition:
+            self.leases.pop(lease.name, None)
+        fs_token = join(lease.fs_path, 'token')
+        if exists(join(fs_token, 'taken')) and not exists(join(fs_token, 'done')):
+            call([join(lease.fs_path, 'release')], close_fds=True)
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    @property
+    def num_waiting(self):
+        return len(self.waiters)
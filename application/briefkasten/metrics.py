@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+""" timing of the processing stages of a drop.
+
+`Dropbox.process` records when each of its stages (the initial backup, the cleanser, the
+archive of the cleansed attachments and the notification of the editors) started and
+finished, how many bytes they dealt with and how often gpg and the smtp server were called.
+the result is kept in the drop's metadata record next to its status, i.e.::
+
+    "timings": {
+        "started": 1520000000.0, "finished": 1520000012.5, "duration": 12.5,
+        "stages": {"backup": {"started": ..., "finished": ..., "duration": 0.4, "size": 2048}, ...},
+        "counts": {"gpg": 4, "smtp": 1}}
+
+the worker aggregates these records into histograms per stage and, along with its queue
+and completion counters (see `WorkerMetrics`), periodically writes them into a text file
+in the prometheus exposition format (i.e. for the node exporter's textfile collector).
+"""
+from collections import deque
+from contextlib import contextmanager
+from os import chmod, fdopen, listdir, remove, rename
+from os.path import dirname
+from tempfile import mkstemp
+from threading import Lock, RLock
+from time import time
+
+
+class DropTimings(object):
+    """ the timings of processing a single drop"""
+
+    def __init__(self):
+        self.started = time()
+        self.finished = None
+        self.stages = dict()
+        self.counts = dict(gpg=0, smtp=0)
+        self.lock = Lock()
+
+    def start(self, stage, size=None):
+        self.stages[stage] = dict(started=time(), finished=None, duration=None, size=size)
+
+    def finish(self, stage):
+        """ marks the given stage as finished (only once, stages that weren't started
+        are ignored)"""
+        timing = self.stages.get(stage)
+        if timing is None or timing['finished'] is not None:
+            return
+        timing['finished'] = time()
+        timing['duration'] = timing['finished'] - timing['started']
+
+    @contextmanager
+    def stage(self, stage, size=None):
+        self.start(stage, size=size)
+        try:
+            yield
+        finally:
+            self.finish(stage)
+
+    def count(self, name, increment=1):
+        # gpg may be called from background threads
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + increment
+
+    def close(self):
+        self.finished = time()
+
+    def as_dict(self):
+        return dict(
+            started=self.started,
+            finished=self.finished,
+            duration=None if self.finished is None else self.finished - self.started,
+            stages=self.stages,
+            counts=self.counts)
+
+
+class Counted(object):
+    """ a proxy for the given object (i.e. a gpg context or an smtp session) that counts
+    the calls of the given methods as `name` in the given timings"""
+
+    def __init__(self, obj, timings, name, methods):
+        self._obj = obj
+        self._timings = timings
+        self._name = name
+        self._methods = methods
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if attr not in self._methods:
+            return value
+
+        def counted(*args, **kwargs):
+            self._timings.count(self._name)
+            return value(*args, **kwargs)
+        return counted
+
+
+class StageHistograms(object):
+    """ aggregates the timings of processed drops into (cumulative) histograms of the
+    duration of each stage and of processing as a whole (`total`). also sums up the bytes
+    handled by each stage and the gpg and smtp calls."""
+
+    default_buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.stages = dict()
+        self.counts = dict()
+        self.lock = RLock()
+
+    def observe(self, timings):
+        """ adds the given timings record (as stored in the metadata)"""
+        stages = dict(timings.get('stages') or {})
+        stages['total'] = dict(duration=timings.get('duration'))
+        with self.lock:
+            for stage, timing in stages.items():
+                self.observe_duration(stage, timing.get('duration'), size=timing.get('size'))
+            for name, count in (timings.get('counts') or {}).items():
+                self.counts[name] = self.counts.get(name, 0) + count
+
+    def observe_duration(self, stage, duration, size=None):
+        """ adds a single duration of the given stage"""
+        if duration is None:
+            return
+        with self.lock:
+            histogram = self.stages.setdefault(stage, dict(
+                buckets=[0] * len(self.buckets), count=0, sum=0.0, size=0))
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += duration
+            histogram['size'] += size or 0
+
+    def snapshot(self):
+        """ returns a copy of the histograms per stage (sorted by stage) and of the counts"""
+        with self.lock:
+            stages = sorted([(stage, dict(histogram, buckets=list(histogram['buckets'])))
+                for stage, histogram in self.stages.items()])
+            return stages, sorted(self.counts.items())
+
+    def samples(self, stages=None):
+        """ returns the samples of the histograms in the form expected by `WorkerMetrics.render`"""
+        if stages is None:
+            stages = self.snapshot()[0]
+        samples = []
+        for stage, histogram in stages:
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                samples.append(('_bucket', dict(stage=stage, le=format_value(bound)), count))
+            samples.append(('_bucket', dict(stage=stage, le='+Inf'), histogram['count']))
+            samples.append(('_sum', dict(stage=stage), histogram['sum']))
+            samples.append(('_count', dict(stage=stage), histogram['count']))
+        return samples
+
+
+def format_timings(timings):
+    """ returns a one-line summary of the given timings record"""
+    stages = sorted(
+        [(timing['started'], stage, timing['duration']) for stage, timing in timings['stages'].items()
+            if timing.get('duration') is not None])
+    return '%.2fs (%s; %s)' % (
+        timings.get('duration') or 0,
+        ', '.join(['%s %.2fs' % (stage, duration) for started, stage, duration in stages]),
+        ', '.join(['%d %s' % (count, name) for name, count in sorted(timings['counts'].items())]))
+
+
+class WorkerMetrics(object):
+    """ the live metrics of a worker: the depth of the submission queue and the scratch
+    directory, the drops pending and in flight per scheduler class, completions per status
+    code and the throughput over the last `window` seconds, as well as the stage histograms
+    and the occupancy of the cleanser jails (if their `leases` are managed by the worker).
+    """
+
+    def __init__(self, drop_root, scheduler, slots=None, histograms=None, window=900, leases=None):
+        self.drop_root = drop_root
+        self.scheduler = scheduler
+        self.slots = slots
+        self.leases = leases
+        self.histograms = histograms or StageHistograms()
+        self.window = window
+        self.started = time()
+        self.completions = dict()
+        self.recent = deque()
+        self.lock = Lock()
+
+    def completed(self, drop):
+        """ records the completion of the given (processed) drop"""
+        timings = drop.metadata.get('timings')
+        if timings:
+            self.histograms.observe(timings)
+        with self.lock:
+            self.completions[drop.status_int] = self.completions.get(drop.status_int, 0) + 1
+            self.recent.append(time())
+        return timings
+
+    def throughput(self, now=None):
+        """ returns the number of drops completed per minute during the last `window` seconds"""
+        now = now or time()
+        with self.lock:
+            while self.recent and self.recent[0] < now - self.window:
+                self.recent.popleft()
+            completed = len(self.recent)
+        return completed * 60.0 / min(self.window, max(now - self.started, 1))
+
+    def render(self):
+        """ returns the metrics in the prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            """ adds a metric, its samples are `(suffix, labels, value)` tuples"""
+            lines.append('# HELP briefkasten_%s %s' % (name, help))
+            lines.append('# TYPE briefkasten_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append('briefkasten_%s%s%s %s' % (name, suffix, format_labels(labels), format_value(value)))
+
+        scheduler = self.scheduler
+        with scheduler.condition:
+            pending = [('', {'class': klass}, len(drops)) for klass, drops in sorted(scheduler.pending.items())]
+            in_flight = [('', {'class': klass}, count) for klass, count in sorted(scheduler.counts.items())]
+        with self.lock:
+            completions = sorted(self.completions.items())
+        metric('submission_queue_depth', 'gauge', 'Entries in the submission queue.',
+            [('', {}, len(listdir(self.drop_root.fs_submission_queue)))])
+        # the scratch directory also holds the backups staged while a drop is being cleansed
+        scratch = [name for name in listdir(self.drop_root.fs_scratch) if not name.endswith('.zip.pgp')]
+        metric('scratch_depth', 'gauge', 'Drops being processed according to the scratch directory.',
+            [('', {}, len(scratch))])
+        metric('worker_pending', 'gauge', 'Drops waiting in the scheduler per class.', pending)
+        metric('worker_in_flight', 'gauge', 'Drops being processed per class.', in_flight)
+        if self.slots is not None:
+            metric('worker_slots', 'gauge', 'Number of worker processes.', [('', {}, self.slots)])
+        metric('worker_drops_completed_total', 'counter', 'Processed drops per resulting status code.',
+            [('', dict(status=str(status)), count) for status, count in completions])
+        metric('worker_drops_failed_total', 'counter', 'Drops whose processing failed.',
+            [('', {}, sum([count for status, count in completions if 500 <= status < 800]))])
+        metric('worker_throughput_per_minute', 'gauge', 'Drops completed per minute recently.',
+            [('', {}, self.throughput())])
+        metric('worker_uptime_seconds', 'gauge', 'Seconds since the worker started.',
+            [('', {}, time() - self.started)])
+
+        stages, counts = self.histograms.snapshot()
+        metric('drop_stage_duration_seconds', 'histogram', 'Duration of the processing stages of drops.',
+            self.histograms.samples(stages))
+        metric('drop_stage_bytes_total', 'counter', 'Bytes handled by the processing stages of drops.',
+            [('', dict(stage=stage), histogram['size']) for stage, histogram in stages])
+        metric('drop_calls_total', 'counter', 'Calls of external services while processing drops.',
+            [('', dict(service=name), count) for name, count in counts])
+
+        leases = self.leases
+        if leases is not None:
+            num_jails = len(leases.jails())
+            with leases.condition:
+                num_leases = len(leases.leases)
+                num_waiting = leases.num_waiting
+            metric('cleanser_jails', 'gauge', 'Cleanser jails offered by jdispatch.', [('', {}, num_jails)])
+            metric('cleanser_leases', 'gauge', 'Cleanser jails leased by the worker.', [('', {}, num_leases)])
+            metric('cleanser_lease_waiters', 'gauge', 'Drops waiting for a cleanser jail.', [('', {}, num_waiting)])
+            metric('cleanser_lease_wait_seconds', 'histogram', 'Time drops waited for a cleanser jail.',
+                [(suffix, dict((k, v) for k, v in labels.items() if k != 'stage'), value)
+                    for suffix, labels, value in leases.wait_times.samples()])
+            metric('cleanser_lease_timeouts_total', 'counter', 'Drops that gave up waiting for a cleanser jail.',
+                [('', {}, leases.timeouts)])
+            metric('cleanser_leases_expired_total', 'counter', 'Leases that were never released.',
+                [('', {}, leases.expired)])
+            metric('cleanser_unhealthy_total', 'counter', 'Failed health checks of cleanser jails.',
+                [('', {}, leases.unhealthy)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, fs_metrics):
+        """ (atomically) replaces the given file with the current metrics. no temporary
+        file is left behind if that fails."""
+        rendered = self.render()
+        fd_metrics, fs_tmp = mkstemp(prefix='.metrics', dir=dirname(fs_metrics) or '.')
+        try:
+            with fdopen(fd_metrics, 'w') as metrics:
+                metrics.write(rendered)
+            chmod(fs_tmp, 0644)
+            rename(fs_tmp, fs_metrics)
+        except Exception:
+            remove(fs_tmp)
+            raise
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, value) for name, value in sorted(labels.items())])
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -2,8 +2,10 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.Utils import formatdate
-from os.path import basename
-from smtplib import SMTP
+from os import listdir, stat
+from os.path import basename, join
+from smtplib import SMTP, SMTPServerDisconnected
+from socket import error as socket_error
 
 
 class CustomSMTP(SMTP):
@@ -23,9 +25,74 @@ class CustomSMTP(SMTP):
             self.login(self.user, self.password)
 
 
+class PooledSMTP(CustomSMTP):
+    """ a `CustomSMTP` that keeps its (authenticated) session open between messages, so
+    all messages sent by a worker process share a single connection.
+
+    `begin` only connects if there is no open session or if the open session fails a `NOOP`
+    health check, `quit` keeps the session open (`shutdown` really ends it) and `sendmail`
+    reconnects once if the server has dropped the connection in the meantime.
+    """
+
+    # `smtplib.SMTP` only sets this once connected, but `close` expects it
+    sock = None
+
+    def __init__(self, *args, **kwargs):
+        CustomSMTP.__init__(self, *args, **kwargs)
+        self.connected = False
+
+    def begin(self):
+        if self.connected:
+            try:
+                if self.noop()[0] == 250:
+                    return
+            except (SMTPServerDisconnected, socket_error):
+                pass
+            self.close()
+        try:
+            CustomSMTP.begin(self)
+        except Exception:
+            self.close()
+            raise
+        self.connected = True
+
+    def sendmail(self, *args, **kwargs):
+        try:
+            return CustomSMTP.sendmail(self, *args, **kwargs)
+        except (SMTPServerDisconnected, socket_error):
+            self.close()
+            self.begin()
+            return CustomSMTP.sendmail(self, *args, **kwargs)
+
+    def quit(self):
+        """ keeps the session open for the next message."""
+        pass
+
+    def shutdown(self):
+        """ ends the session."""
+        if self.connected:
+            try:
+                CustomSMTP.quit(self)
+            except (SMTPServerDisconnected, socket_error):
+                self.close()
+
+    def close(self):
+        CustomSMTP.close(self)
+        # forget about the session (like `SMTP.quit` does), so the next one starts with EHLO
+        self.ehlo_resp = self.helo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = 0
+        self.connected = False
+
+
 def setup_smtp_factory(**settings):
-    """ expects a dictionary with 'mail.' keys to create an appropriate smtplib.SMTP instance"""
-    return CustomSMTP(
+    """ expects a dictionary with 'mail.' keys to create an appropriate smtplib.SMTP instance.
+    if `mail.persistent` is set, the instance keeps its session open between messages."""
+    if settings.get('mail.persistent'):
+        factory = PooledSMTP
+    else:
+        factory = CustomSMTP
+    return factory(
         host=settings.get('mail.host', 'localhost'),
         port=int(settings.get('mail.port', 25)),
         user=settings.get('mail.user'),
@@ -34,44 +101,152 @@ def setup_smtp_factory(**settings):
     )
 
 
-def checkRecipient(gpg_context, uid):
-    valid_key = bool([k for k in gpg_context.list_keys() if uid in ', '.join(k['uids']) and k['trust'] in 'ofqmu-'])
+def parse_email(uid):
+    """ returns the lower cased email address of the given uid,
+    i.e. `Jane Doe <Jane@example.com>` -> `jane@example.com`"""
+    if '<' in uid:
+        uid = uid[uid.rfind('<') + 1:]
+    return uid.strip().rstrip('>').strip().lower()
+
+
+class Keyring(object):
+    """ an in-memory index of the public keys of a gpg context, keyed by email address.
+
+    the index is built lazily on first access and rebuilt whenever one of the keyring
+    files in the gpg home directory changes on disk, so a long running process only needs
+    to call `list_keys` once per keyring modification instead of once per lookup.
+    """
+
+    trust_valid = 'ofqmu-'
+
+    def __init__(self, gpg_context):
+        self.gpg_context = gpg_context
+        self._keys = None
+        self._index = None
+        self._signature = None
+
+    def _keyring_signature(self):
+        """ returns a tuple describing the current state of the keyring files on disk"""
+        fs_gpghome = self.gpg_context.gnupghome
+        signature = []
+        try:
+            candidates = sorted(listdir(fs_gpghome))
+        except (OSError, TypeError):
+            return None
+        for name in candidates:
+            if not (name.startswith('pubring') or name.startswith('trustdb')):
+                continue
+            try:
+                fs_stat = stat(join(fs_gpghome, name))
+            except OSError:
+                continue
+            signature.append((name, fs_stat.st_mtime, fs_stat.st_size))
+        return tuple(signature)
+
+    def refresh(self):
+        """ (re-)reads the keyring and rebuilds the index"""
+        self._signature = self._keyring_signature()
+        self._keys = list(self.gpg_context.list_keys())
+        self._index = dict()
+        for key in self._keys:
+            for key_uid in key['uids']:
+                self._index.setdefault(parse_email(key_uid), []).append(key)
+
+    def invalidate(self):
+        self._keys = None
+
+    @property
+    def keys(self):
+        """ returns the list of all public keys in the keyring"""
+        if self._keys is None or self._signature != self._keyring_signature():
+            self.refresh()
+        return self._keys
+
+    def lookup(self, uid):
+        """ returns a list of all keys matching the given uid or email address"""
+        keys = self.keys
+        matches = self._index.get(parse_email(uid))
+        if matches is not None:
+            return list(matches)
+        # fall back to the substring match for anything that isn't an address
+        return [k for k in keys if uid in ', '.join(k['uids'])]
+
+    def is_valid(self, uid):
+        return bool([k for k in self.lookup(uid) if k['trust'] in self.trust_valid])
+
+
+def checkRecipient(keyring, uid):
+    if not isinstance(keyring, Keyring):
+        keyring = Keyring(keyring)
+    valid_key = keyring.is_valid(uid)
     if not valid_key:
         print('Invalid recipient %s' % uid)
     return valid_key
 
 
-def sendMultiPart(smtp, gpg_context, sender, recipients, subject, text, attachments):
+def encryptParts(gpg_context, uids, text, attachments):
+    """ encrypts the text and each of the given attachments to the given uid(s).
+    returns the ciphertext of the text and a list of `(filename, ciphertext)` tuples"""
+    encrypted_text = str(gpg_context.encrypt(text.encode('utf-8'), uids, always_trust=True))
+    encrypted_attachments = []
+    for attachment in attachments:
+        with open(attachment, 'rb') as fp:
+            encrypted_attachments.append((
+                basename('%s.pgp' % attachment),
+                str(gpg_context.encrypt_file(fp, uids, always_trust=True))))
+    return encrypted_text, encrypted_attachments
+
+
+def composeMessage(sender, to, subject, encrypted_text, encrypted_attachments):
+    """ returns a multipart message containing the given, already encrypted parts"""
+    msg = MIMEMultipart()
+
+    msg['From'] = sender
+    msg['To'] = to
+    msg['Subject'] = subject
+    msg["Date"] = formatdate(localtime=True)
+    msg.preamble = u'This is an email in encrypted multipart format.'
+
+    attach = MIMEText(encrypted_text)
+    attach.set_charset('UTF-8')
+    msg.attach(attach)
+
+    for filename, payload in encrypted_attachments:
+        attach = MIMEBase('application', 'octet-stream')
+        attach.set_payload(payload)
+        attach.add_header('Content-Disposition', 'attachment', filename=filename)
+        msg.attach(attach)
+    return msg
+
+
+def sendMultiPart(smtp, gpg_context, sender, recipients, subject, text, attachments, keyring=None, encrypt_once=False):
     """ a helper method that composes and sends an email with attachments
-    requires a pre-configured smtplib.SMTP instance"""
-    sent = 0
+    requires a pre-configured smtplib.SMTP instance
+
+    by default the text and each attachment are encrypted separately for each recipient,
+    with `encrypt_once` they are encrypted once to all valid recipients and the resulting
+    ciphertext is shared between all outgoing messages."""
+    if keyring is None:
+        keyring = Keyring(gpg_context)
+
+    valid_recipients = []
     for to in recipients:
         if not to.startswith('<'):
             uid = '<%s>' % to
         else:
             uid = to
 
-        if not checkRecipient(gpg_context, uid):
-            continue
-
-        msg = MIMEMultipart()
+        if checkRecipient(keyring, uid):
+            valid_recipients.append((to, uid))
 
-        msg['From'] = sender
-        msg['To'] = to
-        msg['Subject'] = subject
-        msg["Date"] = formatdate(localtime=True)
-        msg.preamble = u'This is an email in encrypted multipart format.'
+    if encrypt_once and valid_recipients:
+        parts = encryptParts(gpg_context, [recipient[1] for recipient in valid_recipients], text, attachments)
 
-        attach = MIMEText(str(gpg_context.encrypt(text.encode('utf-8'), uid, always_trust=True)))
-        attach.set_charset('UTF-8')
-        msg.attach(attach)
-
-        for attachment in attachments:
-            with open(attachment, 'rb') as fp:
-                attach = MIMEBase('application', 'octet-stream')
-                attach.set_payload(str(gpg_context.encrypt_file(fp, uid, always_trust=True)))
-            attach.add_header('Content-Disposition', 'attachment', filename=basename('%s.pgp' % attachment))
-            msg.attach(attach)
+    sent = 0
+    for to, uid in valid_recipients:
+        if not encrypt_once:
+            parts = encryptParts(gpg_context, uid, text, attachments)
+        msg = composeMessage(sender, to, subject, *parts)
 
         # TODO: need to catch exception?
         # yes :-) we need to adjust the status accordingly (>500 so it will be destroyed)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+""" an in-process job queue for the drops in the submission queue.
+"""
+from collections import OrderedDict
+from os import listdir
+from threading import Condition
+from time import time
+
+
+class Scheduler(object):
+    """ keeps track of the drops waiting in the submission queue and hands them out for
+    processing with a bounded concurrency.
+
+    drops are added individually (i.e. when the file system watcher reports a new
+    submission) or via `reconcile`, which scans the submission queue for any entries
+    that may have been missed. a drop is pending or in flight at most once, no matter
+    how often it is added.
+
+    each drop is assigned a class by the `classify` callable. `classes` lists them in
+    the order in which they are served, `limits` optionally maps a class to the maximum
+    number of its drops that may be in flight at the same time and `max_in_flight` limits
+    the total number of in flight drops of all classes that have a limit.
+
+    drops within a class are served first come, first served. with `promote_after` a drop
+    that has been waiting for that many seconds is served as if it belonged to the next
+    higher class (and so on), so drops of lower classes can't be starved.
+    """
+
+    def __init__(self, fs_queue, classify=None, classes=('default',), limits=None,
+            max_in_flight=None, promote_after=None):
+        self.fs_queue = fs_queue
+        self.classify = classify or (lambda drop_id: 'default')
+        self.classes = list(classes)
+        self.limits = dict(limits or {})
+        self.max_in_flight = max_in_flight
+        self.promote_after = promote_after
+        self.pending = dict((klass, OrderedDict()) for klass in self.classes)
+        self.queued = dict()
+        self.in_flight = dict()
+        self.counts = dict((klass, 0) for klass in self.classes)
+        self.condition = Condition()
+
+    def __contains__(self, drop_id):
+        return drop_id in self.queued or drop_id in self.in_flight
+
+    def add(self, drop_id):
+        """ adds the given drop, returns whether it was new"""
+        with self.condition:
+            if drop_id in self:
+                return False
+        klass = self.classify(drop_id)
+        with self.condition:
+            if drop_id in self:
+                return False
+            self.pending[klass][drop_id] = time()
+            self.queued[drop_id] = klass
+            self.condition.notify()
+        return True
+
+    def reconcile(self):
+        """ adds all entries of the submission queue, returns the number of new ones"""
+        return len([drop_id for drop_id in listdir(self.fs_queue) if self.add(drop_id)])
+
+    @property
+    def num_pending(self):
+        return len(self.queued)
+
+    def _has_capacity(self, klass):
+        limit = self.limits.get(klass)
+        if limit is None:
+            return True
+        if self.counts[klass] >= limit:
+            return False
+        if self.max_in_flight is None:
+            return True
+        return sum([self.counts[k] for k in self.limits]) < self.max_in_flight
+
+    def _next_drop_id(self):
+        now = time()
+        candidates = []
+        for rank, klass in enumerate(self.classes):
+            if not self.pending[klass] or not self._has_capacity(klass):
+                continue
+            # the oldest drop of each class is the only candidate of that class
+            drop_id, added = next(self.pending[klass].iteritems())
+            if self.promote_after:
+                rank = max(0, rank - int((now - added) / self.promote_after))
+            candidates.append((rank, added, drop_id))
+        if candidates:
+            return min(candidates)[2]
+
+    def next(self, timeout=None):
+        """ waits up to `timeout` seconds for a drop that may be processed now, marks it as
+        in flight and returns its id and class. returns `(None, None)` on timeout."""
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            drop_id = self._next_drop_id()
+            while drop_id is None:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return None, None
+                    self.condition.wait(remaining)
+                drop_id = self._next_drop_id()
+            klass = self.queued.pop(drop_id)
+            del self.pending[klass][drop_id]
+            self.in_flight[drop_id] = klass
+            self.counts[klass] += 1
+            return drop_id, klass
+
+    def done(self, drop_id):
+        """ marks the given drop as no longer in flight"""
+        with self.condition:
+            klass = self.in_flight.pop(drop_id, None)
+            if klass is not None:
+                self.counts[klass] -= 1
+            self.condition.notify()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+""" a serving profile for the application that copes with many slow (i.e. anonymised)
+clients.
+
+it uses waitress, which receives all requests including their bodies in a single
+asynchronous I/O loop (spooling large bodies into temporary files) and only hands
+complete requests to its small pool of worker threads. a client that takes an hour to
+upload its attachment thus only takes up a socket and some buffer space, but never
+blocks a thread that could serve other clients in the meantime.
+
+use it in a paste deploy configuration like so::
+
+    [server:main]
+    use = egg:briefkasten#waitress
+    host = 0.0.0.0
+    port = 6543
+
+all of waitress' options can be given, the defaults below are tuned for our use case.
+"""
+from humanfriendly import parse_size
+import waitress
+
+
+defaults = dict(
+    # requests are only dispatched once they have been received completely, so only a few
+    # threads are needed for the actual (short-lived) processing
+    threads=4,
+    # how many clients can be connected at the same time, including the slow ones
+    connection_limit=500,
+    backlog=1024,
+    # select() can't handle more than 1024 file descriptors
+    asyncore_use_poll=True,
+    # give up on clients that didn't send anything for five minutes
+    channel_timeout=300,
+    # spool request bodies larger than this to disk
+    inbuf_overflow=512 * 1024,
+    # the same limit as configured for the web server
+    max_request_body_size=2 * 1024 * 1024 * 1024,
+)
+
+size_options = ['inbuf_overflow', 'outbuf_overflow', 'max_request_body_size', 'max_request_header_size']
+
+
+def create_server(app, **settings):
+    """ returns a waitress server for the given application with our defaults, which
+    are overridden by the given settings"""
+    options = dict(defaults)
+    options.update(settings)
+    for option in size_options:
+        if isinstance(options.get(option), basestring):
+            options[option] = parse_size(options[option])
+    return waitress.create_server(app, **options)
+
+
+def server_runner(app, global_conf, **settings):     # pragma: no cover
+    """ the paste deploy entry point"""
+    server = create_server(app, **settings)
+    server.print_listen('Serving on http://{}:{}')
+    server.run()
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
+import json
 import shutil
 from cgi import FieldStorage
+from math import ceil
 from jinja2 import Environment, PackageLoader
+from os import chmod, makedirs
 from os.path import abspath, dirname, join
 from mock import Mock
+from pkg_resources import get_distribution
+from platform import python_version
 from pyramid.testing import DummyRequest, setUp, tearDown
-from pytest import fixture
+from pytest import fixture, skip
+from time import time
 from urllib import unquote
 from webtest import TestApp
 
@@ -13,6 +19,13 @@ from webtest import TestApp
 jinja_env = Environment(loader=PackageLoader('briefkasten', 'tests'))
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+        help='run the benchmarks (which are skipped otherwise)')
+    parser.addoption('--benchmark-json', action='store', default=None, metavar='PATH',
+        help='write the results of the benchmarks to the given file')
+
+
 def asset_path(*parts):
     return abspath(join(dirname(__file__), 'tests', *parts))
 
@@ -99,3 +112,117 @@ def attachment_factory(**kwargs):
     for key, value in kwargs.items():
         setattr(a, key, value)
     return a
+
+
+def percentile(timings, percent):
+    """ returns the given percentile (nearest rank) of the sorted timings"""
+    rank = int(ceil(len(timings) * percent / 100.0))
+    return timings[min(max(rank, 1), len(timings)) - 1]
+
+
+def summarize(timings, size=None):
+    """ returns latency percentiles (in seconds) and throughput of the sorted timings, the
+    latter also in bytes per second if each call processed `size` bytes"""
+    total = sum(timings) or 1e-9
+    summary = dict(
+        rounds=len(timings),
+        min=timings[0],
+        max=timings[-1],
+        mean=total / len(timings),
+        median=percentile(timings, 50),
+        p90=percentile(timings, 90),
+        p99=percentile(timings, 99),
+        calls_per_second=len(timings) / total)
+    if size is not None:
+        summary.update(size=size, bytes_per_second=size * len(timings) / total)
+    return summary
+
+
+class Benchmark(object):
+    """ times repeated calls of a function, see the `benchmark` fixture"""
+
+    def __init__(self, rounds=200, results=None):
+        self.rounds = rounds
+        self.results = dict() if results is None else results
+
+    def __call__(self, name, func, *args, **kwargs):
+        """ calls `func` repeatedly and returns the timings of the calls in seconds"""
+        return self.measure(name, func, args, kwargs)
+
+    def measure(self, name, func, args=(), kwargs=None, rounds=None, size=None, setup=None):
+        """ like calling the benchmark, but the number of `rounds` can be given as well as
+        the `size` of the data processed per call.
+
+        `setup` is called before each round (without being timed) and returns the
+        positional arguments for `func`, i.e. to give it a fresh drop each time."""
+        kwargs = kwargs or {}
+        rounds = rounds or self.rounds
+        func(*(setup() if setup else args), **kwargs)   # warm up
+        timings = []
+        for i in range(rounds):
+            if setup is not None:
+                args = setup()
+            started = time()
+            func(*args, **kwargs)
+            timings.append(time() - started)
+        timings.sort()
+        self.results[name] = summary = summarize(timings, size=size)
+        print('%s: median %.3fms, p90 %.3fms, min %.3fms (%d rounds)' % (
+            name, summary['median'] * 1000, summary['p90'] * 1000, summary['min'] * 1000, rounds))
+        return timings
+
+
+def pytest_configure(config):
+    config.benchmark_results = dict()
+
+
+def pytest_unconfigure(config):
+    """ writes the results of all benchmarks to the file given via `--benchmark-json`"""
+    fs_results = config.getoption('benchmark_json', None)
+    if not fs_results or not getattr(config, 'benchmark_results', None):
+        return
+    with open(fs_results, 'w') as results:
+        json.dump(dict(
+            version=get_distribution('briefkasten').version,
+            python=python_version(),
+            created=time(),
+            benchmarks=config.benchmark_results), results, indent=2, sort_keys=True)
+
+
+def make_jdispatch(fs_dispatcher, addresses):
+    """ creates a stand-in for a jdispatch directory offering a jail for each of the given
+    addresses. like jdispatch's own, the `claim` script takes the first free jail and prints
+    its directory. releasing a jail makes it available again right away."""
+    makedirs(fs_dispatcher)
+    with open(join(fs_dispatcher, 'claim'), 'w') as fs_script:
+        fs_script.write('#!/bin/sh\nfor worker in "%s"/*/claim; do\n'
+            '  [ -x "${worker}" ] && /bin/sh "${worker}" && dirname "${worker}" && exit 0\n'
+            'done\nexit 1\n' % fs_dispatcher)
+    chmod(join(fs_dispatcher, 'claim'), 0755)
+    for index, address in enumerate(addresses):
+        fs_jail = join(fs_dispatcher, 'cleanser_%02d' % (index + 1))
+        makedirs(join(fs_jail, 'token'))
+        with open(join(fs_jail, 'ip'), 'w') as ip:
+            ip.write('%s\n' % address)
+        for name, script in [
+                ('claim', 'set -C\n: > "%s/token/taken" 2> /dev/null\n'),
+                ('release', 'rm -f "%s/token/taken"\n')]:
+            with open(join(fs_jail, name), 'w') as fs_script:
+                fs_script.write('#!/bin/sh\n' + script % fs_jail)
+            chmod(join(fs_jail, name), 0755)
+    return fs_dispatcher
+
+
+@fixture
+def jdispatch(tmpdir):
+    """ returns a stand-in for the jdispatch directory with two cleanser jails"""
+    return make_jdispatch(join(tmpdir.strpath, 'jdispatch'), ['127.0.0.1:2201', '127.0.0.1:2202'])
+
+
+@fixture
+def benchmark(request):
+    """ returns a `Benchmark` instance, but only if benchmarks have been requested using
+    the `--benchmark` option. the results of all benchmarks are collected per session."""
+    if not request.config.getoption('benchmark'):
+        skip('benchmarks are only run with --benchmark')
+    return Benchmark(results=request.config.benchmark_results)
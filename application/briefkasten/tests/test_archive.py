@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from os import listdir
+from zipfile import ZipFile
+from pytest import fixture
+
+
+@fixture
+def members(testing):
+    return [
+        (u'attachment.txt', testing.asset_path('attachment.txt')),
+        (u'Ümläut.png', open(testing.asset_path('attachment.png'), 'rb')),
+    ]
+
+
+def test_write_zip_is_readable(members, testing):
+    from briefkasten.archive import write_zip
+    out = BytesIO()
+    size = write_zip(out, members)
+    assert size == len(out.getvalue())
+    archive = ZipFile(out)
+    assert archive.testzip() is None
+    assert archive.namelist() == [u'attachment.txt', u'Ümläut.png']
+    assert archive.read(u'attachment.txt') == open(testing.asset_path('attachment.txt'), 'rb').read()
+    assert archive.read(u'Ümläut.png') == open(testing.asset_path('attachment.png'), 'rb').read()
+
+
+def test_write_zip_without_members():
+    from briefkasten.archive import write_zip
+    out = BytesIO()
+    write_zip(out, [])
+    assert ZipFile(out).namelist() == []
+
+
+class StreamingGPG(object):
+    """ a stand-in for `gnupg.GPG` that copies its (unencrypted) input to the output"""
+
+    def encrypt_file(self, fileobj, recipients, always_trust=False, output=None):
+        with open(output, 'wb') as fs_output:
+            for chunk in iter(lambda: fileobj.read(1024), b''):
+                fs_output.write(chunk)
+        return True
+
+
+def test_encrypt_zip_streams_archive(members, tmpdir, testing):
+    from briefkasten.archive import encrypt_zip
+    fs_output = tmpdir.join('archive.zip.pgp').strpath
+    encrypt_zip(StreamingGPG(), members, ['editor@briefkasten.dtfh.de'], fs_output)
+    archive = ZipFile(fs_output)
+    assert archive.read(u'attachment.txt') == open(testing.asset_path('attachment.txt'), 'rb').read()
+    assert listdir(tmpdir.strpath) == ['archive.zip.pgp']
+
+
+def test_encrypt_zip_raises_archive_errors(tmpdir):
+    from briefkasten.archive import encrypt_zip
+    from pytest import raises
+    with raises(IOError):
+        encrypt_zip(StreamingGPG(), [('foo', tmpdir.join('missing').strpath)], [], tmpdir.join('out').strpath)
+
+
+def test_backup_has_no_plaintext_archive(dropbox):
+    dropbox._create_backup()
+    assert 'dirty.zip' not in listdir(dropbox.fs_path)
+    assert 'dirty.zip.pgp' in listdir(dropbox.fs_path)
+
+
+def test_write_zip_reads_members_once(testing):
+    from briefkasten.archive import write_zip
+
+    class ReadOnce(file):
+        def seek(self, *args):
+            raise AssertionError('members are read only once')
+    out = BytesIO()
+    write_zip(out, [(u'attachment.png', ReadOnce(testing.asset_path('attachment.png'), 'rb'))])
+    archive = ZipFile(out)
+    assert archive.testzip() is None
+    assert archive.read(u'attachment.png') == open(testing.asset_path('attachment.png'), 'rb').read()
+    # the checksum and size follow the data
+    assert archive.getinfo(u'attachment.png').flag_bits & 0x08
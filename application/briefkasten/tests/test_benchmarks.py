@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+""" micro benchmarks, run them using `py.test --benchmark -s briefkasten/tests/test_benchmarks.py`
+
+add `--benchmark-json=benchmarks.json` to keep the latency percentiles and throughput of all
+of them for comparing releases.
+"""
+from StringIO import StringIO
+from pytest import fixture, mark
+
+
+def median(timings):
+    return timings[len(timings) // 2]
+
+
+@fixture
+def registry(config):
+    from briefkasten import configure
+    return configure({}, **config.registry.settings).registry
+
+
+@fixture
+def form_request(registry):
+    from pyramid.request import Request
+    request = Request.blank('/briefkasten/', base_url='http://example.com')
+    request.registry = registry
+    return request
+
+
+def test_defaults(benchmark, registry, form_request):
+    from briefkasten.views import defaults
+    registry.settings['pyramid.reload_templates'] = False
+    cached = benchmark('defaults (cached)', defaults, form_request)
+    registry.settings['pyramid.reload_templates'] = True
+    uncached = benchmark('defaults (uncached)', defaults, form_request)
+    assert median(cached) < median(uncached)
+
+
+def test_form(benchmark, browser):
+    benchmark('form', browser.get, '/briefkasten/')
+
+
+def test_defaults_are_cached(registry, form_request):
+    from briefkasten.views import defaults
+    registry.settings['pyramid.reload_templates'] = False
+    assert defaults(form_request)['master'] is defaults(form_request)['master']
+    assert defaults(form_request)['static_url'] == 'http://example.com/briefkasten/static/'
+    registry.settings['pyramid.reload_templates'] = True
+    assert defaults(form_request)['master'] is not defaults(form_request)['master']
+
+
+def test_themed_form(benchmark, config):
+    from diazo.wsgi import DiazoMiddleware
+    from webtest import TestApp
+    from os.path import dirname, join
+    from briefkasten import configure
+    fs_rules = join(dirname(__file__), '..', '..', 'themes', 'fileuploader', 'rules.xml')
+    settings = dict(config.registry.settings, static_form='true')
+    filtered = TestApp(DiazoMiddleware(configure({}, **settings).make_wsgi_app(), {}, rules=fs_rules))
+    themed = TestApp(configure({}, theme_rules=fs_rules, **settings).make_wsgi_app())
+    middleware = benchmark('form (diazo filter)', filtered.get, '/briefkasten/')
+    renderer = benchmark('form (themed renderer)', themed.get, '/briefkasten/')
+    assert median(renderer) < median(middleware)
+
+
+def test_post_tokens(benchmark):
+    from briefkasten import generate_post_token, parse_post_token
+    token = generate_post_token(u's3cr3t')
+    benchmark('generate_post_token', generate_post_token, u's3cr3t')
+    benchmark('parse_post_token', parse_post_token, token, u's3cr3t')
+
+
+def test_form_submission(benchmark, testing, browser, config):
+    from briefkasten import generate_post_token
+    secret = config.registry.settings['post_secret']
+
+    def submit_url():
+        return (testing.route_url('dropbox_form_submit', token=generate_post_token(secret)),)
+    benchmark.measure('form submission', browser.post, kwargs=dict(params=dict(message=u'Hallo'), status=302),
+        setup=submit_url, rounds=50)
+
+
+@mark.parametrize('size', [1024, 1024 * 1024, 16 * 1024 * 1024])
+def test_add_attachment(benchmark, testing, dropbox_without_attachment, size):
+    data = b'x' * size
+
+    def attachment():
+        return (testing.attachment_factory(filename=u'attachment.bin', file=StringIO(data)),)
+    benchmark.measure('add_attachment (%d bytes)' % size, dropbox_without_attachment.add_attachment,
+        setup=attachment, rounds=max(5, min(100, 2 ** 26 // size)), size=size)
+
+
+def test_process(benchmark, testing, dropbox_container, attachment):
+    from briefkasten import generate_drop_id
+
+    def dropbox():
+        attachment.file.seek(0)
+        return (dropbox_container.add_dropbox(generate_drop_id(), message=u'Hallo', attachments=[attachment]),)
+    benchmark.measure('process', lambda dropbox: dropbox.process(), setup=dropbox, rounds=10)
+
+
+def test_create_encrypted_zip(benchmark, dropbox):
+    benchmark.measure('_create_encrypted_zip', dropbox._create_encrypted_zip, rounds=20,
+        size=dropbox.size_dirty_attachments)
+
+
+def test_detect_types(benchmark, testing):
+    from subprocess import check_output
+    from briefkasten.filetypes import detect_types
+    fs_attachments = [testing.asset_path(name) for name in ['attachment.txt', 'attachment.png', 'unicode.txt']] * 10
+    sniffed = benchmark.measure('detect_types (30 files)', detect_types, args=(fs_attachments,), rounds=20)
+    forked = benchmark.measure('file -bi (30 files)', lambda: [check_output(['file', '-bi', fs_attachment])
+        for fs_attachment in fs_attachments], rounds=20)
+    assert median(sniffed) < median(forked)
+
+
+def large_png(fs_png, width=1024, height=1024):
+    """ writes a (valid) png image of random pixels with some metadata"""
+    from os import urandom
+    from struct import pack
+    from zlib import compress, crc32
+
+    def chunk(kind, data):
+        return pack('>I', len(data)) + kind + data + pack('>I', crc32(kind + data) & 0xffffffff)
+    pixels = ''.join(['\x00' + urandom(width * 3) for row in range(height)])
+    with open(fs_png, 'wb') as png:
+        png.write('\x89PNG\r\n\x1a\n' + chunk('IHDR', pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk('tEXt', 'Author\x00Jane Doe') + chunk('IDAT', compress(pixels)) + chunk('IEND', ''))
+    return fs_png
+
+
+def large_jpeg(fs_jpeg, size=4 * 1024 * 1024):
+    """ writes a jpeg file with an exif segment and `size` bytes of (random) scan data"""
+    from os import urandom
+    from struct import pack
+
+    def segment(marker, payload):
+        return pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+    scan = urandom(size).replace('\xff', '\xff\x00')
+    with open(fs_jpeg, 'wb') as jpeg:
+        jpeg.write('\xff\xd8' + segment(0xe1, 'Exif\x00\x00' + urandom(8192)) +
+            segment(0xc0, '\x08\x04\x00\x04\x00\x01\x01\x11\x00') +
+            segment(0xda, '\x01\x01\x00\x00\x3f\x00') + scan + '\xff\xd9')
+    return fs_jpeg
+
+
+def test_cleanse_image(benchmark, tmpdir):
+    from distutils.spawn import find_executable
+    from os.path import abspath, dirname, getsize, join
+    from subprocess import check_call
+    from pytest import skip
+    from briefkasten.images import cleanse_image
+    fs_target = tmpdir.mkdir('clean').strpath
+    fs_png = large_png(tmpdir.join('large.png').strpath)
+    fs_jpeg = large_jpeg(tmpdir.join('large.jpg').strpath)
+    benchmark.measure('cleanse_image (jpeg)', cleanse_image, args=(fs_jpeg, fs_target, 'image/jpeg'),
+        rounds=20, size=getsize(fs_jpeg))
+    native = benchmark.measure('cleanse_image (png)', cleanse_image, args=(fs_png, fs_target, 'image/png'),
+        rounds=20, size=getsize(fs_png))
+    if find_executable('anytopnm') is None:
+        skip('netpbm is not installed')
+    fs_script = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts', 'process-image.sh'))
+    shell = benchmark.measure('process-image.sh (png)', check_call,
+        args=([fs_script, fs_png, fs_target, 'image/png; charset=binary'],), rounds=5, size=getsize(fs_png))
+    assert median(native) < median(shell)
+
+
+@mark.parametrize('encrypt_once', [False, True])
+@mark.parametrize('num_editors', [1, 5, 10])
+def test_send_multipart(benchmark, dropbox, num_editors, encrypt_once):
+    from mock import Mock
+    from briefkasten.notifications import sendMultiPart
+    editors = (dropbox.editors + dropbox.admins) * num_editors
+    benchmark.measure(
+        'sendMultiPart (%d editors%s)' % (num_editors, ', encrypted once' if encrypt_once else ''),
+        sendMultiPart,
+        args=(Mock(), dropbox.gpg_context, u'noreply@briefkasten', editors[:num_editors], u'Drop',
+            u'Hallo', dropbox.fs_dirty_attachments),
+        kwargs=dict(keyring=dropbox.keyring, encrypt_once=encrypt_once),
+        rounds=10)
+
+
+def test_summary():
+    from briefkasten.testing import summarize
+    timings = [0.001 * i for i in range(1, 101)]
+    summary = summarize(timings, size=1000)
+    assert summary['rounds'] == 100
+    assert summary['median'] == 0.05
+    assert summary['p90'] == 0.09
+    assert summary['p99'] == 0.099
+    assert summary['max'] == 0.1
+    assert round(summary['calls_per_second'], 3) == round(100 / sum(timings), 3)
+    assert round(summary['bytes_per_second']) == round(100 * 1000 / sum(timings))
+
+
+def test_results_are_written_as_json(tmpdir):
+    from json import load
+    from mock import Mock
+    from briefkasten.testing import Benchmark, pytest_unconfigure
+    config = Mock(benchmark_results=dict())
+    config.getoption.return_value = tmpdir.join('results.json').strpath
+    Benchmark(rounds=5, results=config.benchmark_results)('noop', lambda: None)
+    pytest_unconfigure(config)
+    results = load(tmpdir.join('results.json'))
+    assert results['benchmarks']['noop']['rounds'] == 5
+    assert 'p99' in results['benchmarks']['noop']
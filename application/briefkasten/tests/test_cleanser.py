@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import shutil
+from os import listdir
+from os.path import join
+from pytest import fixture
+
+
+@fixture
+def fs_target(tmpdir):
+    return join(tmpdir.strpath, 'clean')
+
+
+@fixture
+def unsupported_file(tmpdir):
+    fs_unsupported = join(tmpdir.strpath, 'unsupported.bin')
+    with open(fs_unsupported, 'wb') as unsupported:
+        unsupported.write(b'\x00\x01\x02\x03' * 64)
+    return fs_unsupported
+
+
+def test_cleanse_text_file(testing, fs_target):
+    from briefkasten.cleanser import cleanse_attachments
+    assert cleanse_attachments([testing.asset_path('attachment.txt')], fs_target) == u'299 Cleansed'
+    assert listdir(fs_target) == ['attachment.txt']
+
+
+def test_cleanse_unsupported_file(unsupported_file, testing, fs_target):
+    from briefkasten.cleanser import cleanse_attachments
+    status = cleanse_attachments([testing.asset_path('attachment.txt'), unsupported_file], fs_target, processes=2)
+    assert status == u'800 Not cleansible'
+    assert sorted(listdir(fs_target)) == ['attachment.txt', 'unsupported.bin']
+
+
+def test_cleanse_failure_takes_precedence(unsupported_file, testing, fs_target):
+    from briefkasten.cleanser import cleanse_attachments
+    # there is no image cleanser in our test setup
+    status = cleanse_attachments([
+        unsupported_file,
+        testing.asset_path('attachment.png'),
+        testing.asset_path('attachment.txt')], fs_target, processes=3)
+    assert status == u'540 Error while cleansing file of type image/png'
+
+
+def test_cleanse_nothing(fs_target):
+    from briefkasten.cleanser import cleanse_attachments
+    assert cleanse_attachments([], fs_target) == u'299 Cleansed'
+
+
+def test_cleanse_many_files(tmpdir, testing, fs_target):
+    from briefkasten.cleanser import cleanse_attachments
+    fs_attachments = []
+    for i in range(20):
+        fs_attachments.append(join(tmpdir.strpath, '%02d.txt' % i))
+        shutil.copy(testing.asset_path('attachment.txt'), fs_attachments[-1])
+    assert cleanse_attachments(fs_attachments, fs_target, processes=4) == u'299 Cleansed'
+    assert len(listdir(fs_target)) == 20
+
+
+@fixture
+def parallel_cleanser(dropbox_container):
+    dropbox_container.settings['cleanser_processes'] = 2
+    return dropbox_container
+
+
+def test_dropbox_uses_parallel_cleanser(parallel_cleanser, dropbox):
+    dropbox._process_attachments()
+    assert dropbox.status == u'299 Cleansed'
+    assert len(dropbox.fs_cleansed_attachments) == 1
+
+
+def test_dropbox_process_with_parallel_cleanser(parallel_cleanser, dropbox):
+    assert dropbox.process() == u'900 success'
+
+
+fake_ssh = """#!/bin/sh
+# runs the given command in $FAKE_SSH_HOME instead of on the given host
+while [ "${1#-}" != "$1" ]; do shift 2; done; shift
+cd "$FAKE_SSH_HOME" && exec sh -c "$*"
+"""
+
+
+fake_scp = """#!/bin/sh
+# copies the given files, looking up those on any host in $FAKE_SSH_HOME
+while [ "${1#-}" != "$1" ]; do [ "$1" = -r ] && shift || shift 2; done
+for arg; do shift; case "$arg" in *:*) arg="$FAKE_SSH_HOME/${arg#*:}";; esac; set -- "$@" "$arg"; done
+exec cp -R "$@"
+"""
+
+
+@fixture
+def fs_remote_cleanser(tmpdir, monkeypatch):
+    fs_home = tmpdir.mkdir('cleanser')
+    fs_ssh = tmpdir.join('ssh')
+    fs_ssh.write(fake_ssh)
+    fs_ssh.chmod(0755)
+    fs_config = tmpdir.join('briefkasten.conf')
+    fs_config.write('the_cleanser=cleanser\nthe_transfer_mode=stream\nthe_ssh=%s\n' % fs_ssh.strpath)
+    monkeypatch.setenv('FAKE_SSH_HOME', fs_home.strpath)
+    return fs_home.strpath, fs_config.strpath
+
+
+def test_stream_attachments_to_remote_cleanser(fs_remote_cleanser, testing, dropbox):
+    from os import environ
+    from os.path import abspath, dirname, exists
+    from subprocess import call
+    fs_home, fs_config = fs_remote_cleanser
+    fs_scripts = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts'))
+    env = dict(environ, PATH='%s:%s' % (fs_scripts, environ['PATH']))
+    assert call([join(fs_scripts, 'process-attachments.sh'), '-d', dropbox.fs_path, '-c', fs_config], env=env) == 0
+    # the status is reported by the remote cleanser
+    assert dropbox._read_cleanser_status().startswith(u'204')
+    assert listdir(join(dropbox.fs_path, 'clean')) == listdir(join(dropbox.fs_path, 'attach'))
+    # the remote directory is gone
+    assert listdir(fs_home) == []
+    assert not exists(join(dropbox.fs_path, '.transfer'))
+
+
+def test_copy_attachments_to_remote_cleanser(fs_remote_cleanser, tmpdir, testing, dropbox):
+    from os import environ
+    from os.path import abspath, dirname
+    from subprocess import call
+    fs_home, fs_config = fs_remote_cleanser
+    fs_scp = tmpdir.join('scp')
+    fs_scp.write(fake_scp)
+    fs_scp.chmod(0755)
+    # record the files on the cleanser whenever it is told to do something
+    fs_log = tmpdir.join('remote.log')
+    fs_ssh = tmpdir.join('logging-ssh')
+    fs_ssh.write('#!/bin/sh\nfind "$FAKE_SSH_HOME" >> "%s"\nexec "%s" "$@"\n' % (
+        fs_log.strpath, tmpdir.join('ssh').strpath))
+    fs_ssh.chmod(0755)
+    with open(fs_config, 'w') as config:
+        config.write('the_cleanser=cleanser\nthe_ssh=%s\nthe_scp=%s\n' % (fs_ssh.strpath, fs_scp.strpath))
+    metadata = open(dropbox.fs_metadata).read()
+    fs_scripts = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts'))
+    env = dict(environ, PATH='%s:%s' % (fs_scripts, environ['PATH']))
+    assert call([join(fs_scripts, 'process-attachments.sh'), '-d', dropbox.fs_path, '-c', fs_config], env=env) == 0
+    assert dropbox._read_cleanser_status().startswith(u'204')
+    assert listdir(join(dropbox.fs_path, 'clean')) == listdir(join(dropbox.fs_path, 'attach'))
+    # only the attachments have been copied to the cleanser and the metadata is left alone
+    assert '/attach/' in fs_log.read()
+    assert 'metadata.json' not in fs_log.read()
+    assert open(dropbox.fs_metadata).read() == metadata
+    assert listdir(fs_home) == []
+
+
+compromised_ssh = """#!/bin/sh
+# a cleanser that ignores its job and sends back whatever is in $FAKE_SSH_HOME
+cat > /dev/null
+cd "$FAKE_SSH_HOME" && tar -cf - clean status metadata.json message
+"""
+
+
+@fixture
+def compromised_cleanser(tmpdir, monkeypatch):
+    fs_home = tmpdir.mkdir('compromised')
+    fs_home.mkdir('clean').join('attachment.txt').write('cleansed')
+    fs_home.join('status').write('204 Attachments in quarantine on actual cleanser host.\n')
+    fs_home.join('metadata.json').write('{"editor_token": "stolen"}')
+    fs_home.join('message').write('forged')
+    fs_ssh = tmpdir.join('compromised-ssh')
+    fs_ssh.write(compromised_ssh)
+    fs_ssh.chmod(0755)
+    fs_config = tmpdir.join('briefkasten.conf')
+    fs_config.write('the_cleanser=cleanser\nthe_transfer_mode=stream\nthe_ssh=%s\n' % fs_ssh.strpath)
+    monkeypatch.setenv('FAKE_SSH_HOME', fs_home.strpath)
+    return fs_home, fs_config.strpath
+
+
+def stream_to(dropbox, fs_config):
+    from os.path import abspath, dirname
+    from subprocess import call
+    fs_script = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts', 'process-attachments.sh'))
+    return call([fs_script, '-d', dropbox.fs_path, '-c', fs_config])
+
+
+def test_stream_ignores_extra_files_from_cleanser(compromised_cleanser, dropbox):
+    from os.path import exists
+    fs_home, fs_config = compromised_cleanser
+    metadata = open(dropbox.fs_metadata).read()
+    message = open(join(dropbox.fs_path, 'message')).read()
+    stream_to(dropbox, fs_config)
+    assert dropbox._read_cleanser_status().startswith(u'204')
+    assert open(join(dropbox.fs_path, 'clean', 'attachment.txt')).read() == 'cleansed'
+    assert open(dropbox.fs_metadata).read() == metadata
+    assert open(join(dropbox.fs_path, 'message')).read() == message
+    assert not exists(join(dropbox.fs_path, '.incoming'))
+
+
+def test_stream_rejects_symlinks_from_cleanser(compromised_cleanser, dropbox):
+    from os import symlink
+    from os.path import exists, islink
+    fs_home, fs_config = compromised_cleanser
+    symlink(dropbox.fs_metadata, fs_home.join('clean', 'evil').strpath)
+    stream_to(dropbox, fs_config)
+    assert dropbox._read_cleanser_status().startswith(u'506')
+    assert not islink(join(dropbox.fs_path, 'clean', 'evil'))
+    assert not exists(join(dropbox.fs_path, '.incoming'))
+
+
+def test_stream_to_unreachable_cleanser(tmpdir, dropbox):
+    from os.path import abspath, dirname
+    from subprocess import call
+    fs_config = tmpdir.join('briefkasten.conf')
+    fs_config.write('the_cleanser=cleanser\nthe_transfer_mode=stream\nthe_ssh=false\n')
+    fs_script = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts', 'process-attachments.sh'))
+    call([fs_script, '-d', dropbox.fs_path, '-c', fs_config.strpath])
+    assert dropbox._read_cleanser_status().startswith(u'504')
+
+
+def test_read_config(tmpdir):
+    from briefkasten.cleanser import read_config, remote_cleanser
+    fs_config = tmpdir.join('briefkasten.conf')
+    fs_config.write('# the cleanser\nthe_editors="a@b.c d@e.f"\nexport GNUPGHOME=/var/pgp\nthe_cleanser= # none\n')
+    config = read_config(fs_config.strpath)
+    assert config == dict(the_editors='a@b.c d@e.f', GNUPGHOME='/var/pgp', the_cleanser='')
+    assert not remote_cleanser(config)
+    fs_config.write('the_jdispatcher_dir=/var/run/jdispatch/\n')
+    assert remote_cleanser(read_config(fs_config.strpath))
+    assert read_config(tmpdir.join('missing').strpath) == {}
+
+
+def test_no_local_cleansers_with_remote_cleanser(tmpdir):
+    from briefkasten.dropbox import DropboxContainer
+    tmpdir.join('briefkasten.conf').write('the_cleanser=cleanser.example.com\n')
+    container = DropboxContainer(root=tmpdir.join('root').strpath, settings=dict(
+        fs_bin_path=tmpdir.strpath, fs_pgp_pubkeys=None, cleanser_processes=2))
+    assert container.settings['cleanser_processes'] is None
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import hashlib
+import json
 import os
 import stat
 from os.path import dirname, exists, join
@@ -28,17 +29,64 @@ def test_dropbox_status_no_message(dropbox_container):
     assert dropbox.status == u'010 created'
 
 
-def test_dropbox_status_no_file(dropbox):
-    os.remove(join(dropbox.fs_path, 'status'))
-    assert dropbox.status == u'000 no status file'
+def test_dropbox_status_no_file(dropbox_container, dropbox):
+    os.remove(join(dropbox.fs_path, 'metadata.json'))
+    assert dropbox_container.get_dropbox(dropbox.drop_id).status == u'000 no status file'
 
 
 def test_dropbox_status_manual(dropbox):
-    with open(join(dropbox.fs_path, 'status'), 'w') as status_file:
-        status_file.write(u'23 in limbo'.encode('utf-8'))
+    dropbox.status = u'23 in limbo'
     assert dropbox.status == u'23 in limbo'
 
 
+def test_dropbox_status_from_cleanser(dropbox_container, dropbox):
+    # the cleanser reports its progress in the status file...
+    with open(join(dropbox.fs_path, 'status'), 'w') as status_file:
+        status_file.write(u'203 Attachments being processed'.encode('utf-8'))
+    assert dropbox.status == u'010 created'
+    dropbox.status = u'105 processing attachments'
+    assert dropbox_container.get_dropbox(dropbox.drop_id).status == u'203 Attachments being processed'
+    # ...which is moved into the metadata once it's done
+    dropbox._import_cleanser_status()
+    assert not exists(join(dropbox.fs_path, 'status'))
+    assert dropbox_container.get_dropbox(dropbox.drop_id).status == u'203 Attachments being processed'
+
+
+def test_dropbox_metadata_is_cached(dropbox_container, dropbox):
+    refetched_dropbox = dropbox_container.get_dropbox(dropbox.drop_id)
+    assert refetched_dropbox.status == u'010 created'
+    os.remove(join(dropbox.fs_path, 'metadata.json'))
+    assert refetched_dropbox.status == u'010 created'
+    assert refetched_dropbox.editor_token == dropbox.editor_token
+
+
+def test_dropbox_metadata_updates_are_merged(dropbox_container, dropbox):
+    refetched_dropbox = dropbox_container.get_dropbox(dropbox.drop_id)
+    refetched_dropbox.add_reply(dict(message=u'Hi', author=u'Børk'))
+    dropbox.status = u'020 submitted'
+    refetched_dropbox = dropbox_container.get_dropbox(dropbox.drop_id)
+    assert refetched_dropbox.status == u'020 submitted'
+    assert refetched_dropbox.replies[0]['message'] == u'Hi'
+
+
+def test_dropbox_legacy_metadata_is_migrated(dropbox_container, dropbox):
+    os.remove(join(dropbox.fs_path, 'metadata.json'))
+    with open(join(dropbox.fs_path, 'status'), 'w') as status_file:
+        status_file.write(u'900 success')
+    with open(join(dropbox.fs_path, 'editor_token'), 'w') as token_file:
+        token_file.write(u'foobar')
+    open(join(dropbox.fs_path, 'from_watchdog'), 'w').close()
+    os.mkdir(join(dropbox.fs_path, 'replies'))
+    with open(join(dropbox.fs_path, 'replies', 'message_001.txt'), 'w') as reply_file:
+        reply_file.write(json.dumps(dict(message=u'Hi', author=u'Børk')))
+    migrated_dropbox = dropbox_container.get_dropbox(dropbox.drop_id)
+    assert migrated_dropbox.status == u'900 success'
+    assert migrated_dropbox.editor_token == u'foobar'
+    assert migrated_dropbox.from_watchdog
+    assert migrated_dropbox.replies[0]['author'] == u'Børk'
+    assert sorted(os.listdir(dropbox.fs_path)) == ['attach', 'message', 'metadata.json']
+
+
 def test_dropbox_status_initial(dropbox):
     """ the initial status of a dropbox is 'created'"""
     assert dropbox.status == u'010 created'
@@ -94,7 +142,7 @@ def test_message_permissions(dropbox):
 def test_editor_token_created(dropbox_container, dropbox):
     assert (dropbox_container.get_dropbox(
         dropbox.drop_id).editor_token ==
-        open(dropbox.paths_created[1], 'r').readline())
+        json.load(open(dropbox.paths_created[1], 'r'))['editor_token'])
     assert stat.S_IMODE(os.stat(dropbox.paths_created[1]).st_mode) == 0660
 
 
@@ -1,5 +1,5 @@
 from os import listdir, mkdir, rename
-from os.path import join
+from os.path import getsize, join
 from pytest import fixture
 import shutil
 
@@ -70,6 +70,11 @@ def test_attachment_size_one(cleansed_dropbox):
     assert cleansed_dropbox.size_attachments == 19
 
 
+def test_dirty_attachment_size(dropbox):
+    assert dropbox.size_dirty_attachments == sum([getsize(fs_attachment) for fs_attachment in dropbox.fs_dirty_attachments])
+    assert dropbox.size_dirty_attachments > 0
+
+
 @fixture
 def second_attachment(dropbox, testing):
     shutil.copy2(testing.asset_path('unicode.txt'), join(dropbox.fs_path, 'attach'))
@@ -124,3 +129,87 @@ def test_unsupported_attachments_are_sent_if_no_archive(settings, monkeypatch, m
     monkeypatch.setenv('MOCKED_STATUS_CODE', '800')
     mocked_notify_dropbox.process()
     assert mocked_notify_dropbox.send_attachments
+
+
+@fixture
+def pipelined(dropbox_container):
+    dropbox_container.settings['pipelined_processing'] = True
+    return dropbox_container
+
+
+def test_pipelined_processing_status(pipelined, dropbox):
+    assert dropbox.process() == u'900 success'
+    assert listdir(pipelined.fs_scratch) == []
+
+
+def test_pipelined_processing_creates_cleansed_archive(pipelined, dropbox, second_attachment):
+    assert dropbox.process() == u'900 success'
+    assert listdir(pipelined.fs_archive_cleansed) == ['%s.zip.pgp' % dropbox.drop_id]
+
+
+def test_pipelined_processing_unsupported_attachments(monkeypatch, pipelined, mocked_notify_dropbox):
+    monkeypatch.setenv('MOCKED_STATUS_CODE', '800')
+    mocked_notify_dropbox.process()
+    assert mocked_notify_dropbox.status_int == 800
+    assert listdir(pipelined.fs_archive_dirty) == ['%s.zip.pgp' % mocked_notify_dropbox.drop_id]
+    assert listdir(pipelined.fs_scratch) == []
+
+
+def test_pipelined_processing_cleanser_failure(monkeypatch, pipelined, mocked_notify_dropbox):
+    monkeypatch.setenv('MOCKED_STATUS_CODE', '540')
+    mocked_notify_dropbox.process()
+    assert listdir(pipelined.fs_archive_dirty) == ['%s.zip.pgp' % mocked_notify_dropbox.drop_id]
+
+
+def test_pipelined_backup_runs_while_cleansing(monkeypatch, pipelined, dropbox):
+    from threading import Event
+    from briefkasten import dropbox as dropbox_module
+    cleanser_started = Event()
+    overlapped = []
+    encrypt_zip = dropbox_module.encrypt_zip
+
+    def slow_encrypt_zip(*args):
+        # only finish the backup once the cleanser has been started
+        overlapped.append(cleanser_started.wait(5))
+        return encrypt_zip(*args)
+
+    process_attachments = dropbox._process_attachments
+
+    def started_process_attachments():
+        cleanser_started.set()
+        return process_attachments()
+
+    monkeypatch.setattr(dropbox_module, 'encrypt_zip', slow_encrypt_zip)
+    dropbox._process_attachments = started_process_attachments
+    dropbox.process()
+    assert overlapped[0]
+
+
+def test_pipelined_archive_failure(monkeypatch, pipelined, mocked_notify_dropbox, second_attachment):
+    from briefkasten import dropbox as dropbox_module
+    encrypt_zip = dropbox_module.encrypt_zip
+
+    def failing_encrypt_zip(gpg_context, members, recipients, output):
+        if output.startswith(pipelined.fs_archive_cleansed):
+            open(output, 'w').close()
+            raise IOError('disk full')
+        return encrypt_zip(gpg_context, members, recipients, output)
+    monkeypatch.setattr(dropbox_module, 'encrypt_zip', failing_encrypt_zip)
+    mocked_notify_dropbox.settings['attachment_size_threshold'] = 0
+    # the editors have been notified, but the archive is missing
+    assert mocked_notify_dropbox.process().startswith(u'615 archive error')
+    assert listdir(pipelined.fs_archive_cleansed) == []
+    assert not set(['message', 'attach', 'clean']) & set(listdir(mocked_notify_dropbox.fs_path))
+
+
+def test_pipelined_cleanser_crash(pipelined, dropbox):
+    from pytest import raises
+
+    def crash():
+        raise OSError('cleanser crashed')
+    dropbox._process_attachments = crash
+    with raises(OSError):
+        dropbox.process()
+    # neither the staged backup nor the plaintext is left behind
+    assert listdir(pipelined.fs_scratch) == []
+    assert not set(['message', 'attach', 'clean']) & set(listdir(dropbox.fs_path))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from os import listdir
+from os.path import join
+from struct import pack
+from subprocess import check_output
+from pytest import fixture, mark
+
+
+def write(tmpdir, name, data):
+    fs_file = tmpdir.join(name)
+    fs_file.write(data, mode='wb')
+    return fs_file.strpath
+
+
+def compound_document(stream_name):
+    """ a minimal compound document whose directory (in the first sector after the header)
+    contains the given stream"""
+    header = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + '\x00' * 22 + pack('<H', 9) + '\x00' * 16 + pack('<I', 0)
+    return header.ljust(512, '\x00') + stream_name.encode('utf-16le').ljust(512, '\x00')
+
+
+@mark.parametrize('name', ['attachment.txt', 'attachment.png', 'unicode.txt'])
+def test_matches_file(testing, name):
+    from briefkasten.filetypes import detect_type
+    fs_asset = testing.asset_path(name)
+    assert detect_type(fs_asset) == check_output(['file', '-bi', fs_asset]).strip()
+
+
+@mark.parametrize('data, expected', [
+    ('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n', 'application/pdf; charset=binary'),
+    ('\xff\xd8\xff\xe0\x00\x10JFIF\x00', 'image/jpeg; charset=binary'),
+    ('GIF89a\x01\x00\x01\x00\x80\x00', 'image/gif; charset=binary'),
+    ('PK\x03\x04\x14\x00\x00\x00\x00\x00' + '\x00' * 20 + 'mimetypeapplication/vnd.oasis.opendocument.text',
+        'application/vnd.oasis.opendocument.text; charset=binary'),
+    ('PK\x03\x04\x14\x00\x06\x00' + '\x00' * 22 + '[Content_Types].xml\x00\x00PK\x03\x04word/document.xml',
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document; charset=binary'),
+    (compound_document(u'WordDocument'), 'application/msword; charset=binary'),
+    (compound_document(u'Workbook'), 'application/vnd.ms-excel; charset=binary'),
+    ('Hallo Welt\n', 'text/plain; charset=us-ascii'),
+    (u'Grüße\n'.encode('utf-8'), 'text/plain; charset=utf-8'),
+    (u'Grüße\n'.encode('latin-1'), 'text/plain; charset=iso-8859-1'),
+    ('  <!DOCTYPE html>\n<html></html>\n', 'text/html; charset=us-ascii'),
+    ('<script>alert(1)</script>\n', 'text/html; charset=us-ascii'),
+    ('#!/bin/sh\nrm -rf /\n', 'text/x-shellscript; charset=us-ascii'),
+    ('\x00\x01\x02\x03' * 64, 'application/octet-stream; charset=binary'),
+    ('', 'inode/x-empty; charset=binary'),
+])
+def test_detect_type(tmpdir, data, expected):
+    from briefkasten.filetypes import detect_type
+    assert detect_type(write(tmpdir, 'attachment', data)) == expected
+
+
+def test_truncated_utf8(tmpdir, monkeypatch):
+    from briefkasten import filetypes
+    monkeypatch.setattr(filetypes, 'sniff_size', 4)
+    # the head ends in the middle of the `ü`
+    assert filetypes.detect_type(write(tmpdir, 'attachment', u'Grüße'.encode('utf-8'))) == 'text/plain; charset=utf-8'
+
+
+def test_manifest(tmpdir, testing):
+    from briefkasten.filetypes import detect_types, read_manifest, write_manifest
+    fs_manifest = tmpdir.join('.types').strpath
+    types = detect_types([testing.asset_path('attachment.png'), tmpdir.join('missing').strpath])
+    write_manifest(fs_manifest, types + [(u'Grüße.txt', 'text/plain; charset=utf-8'), ('tab\t.txt', 'text/plain')])
+    assert read_manifest(fs_manifest) == {
+        u'attachment.png': 'image/png; charset=binary',
+        u'Grüße.txt': 'text/plain; charset=utf-8'}
+    assert listdir(tmpdir.strpath) == ['.types']
+
+
+def test_missing_manifest(tmpdir):
+    from briefkasten.filetypes import read_manifest
+    assert read_manifest(tmpdir.join('.types').strpath) == {}
+
+
+@fixture
+def processed(dropbox_container, dropbox):
+    # the mocked `process-attachments.sh` moves the attachments away
+    dropbox_container.settings['cleanser_processes'] = 1
+    dropbox._process_attachments()
+    return dropbox
+
+
+def test_process_records_types(processed):
+    assert processed.attachment_types.items() == [(listdir(processed.fs_attachment_container)[0], 'text/plain; charset=utf-8')]
+    assert processed.timings.stages['types']['duration'] >= 0
+
+
+def test_notification_lists_types(processed):
+    name = processed.attachment_types.keys()[0]
+    assert u'  %s (text/plain)' % name in processed._notification_text
+
+
+def test_cleanser_uses_types(tmpdir):
+    from briefkasten.cleanser import cleanse_attachments
+    fs_attachment = write(tmpdir, 'unsupported.bin', '\x00\x01\x02\x03' * 64)
+    fs_target = tmpdir.join('clean').strpath
+    assert cleanse_attachments([fs_attachment], fs_target) == u'800 Not cleansible'
+    types = {u'unsupported.bin': 'text/plain; charset=us-ascii'}
+    assert cleanse_attachments([fs_attachment], fs_target, types=types) == u'299 Cleansed'
+
+
+def test_script_uses_manifest(dropbox):
+    from os.path import abspath, dirname
+    from subprocess import call
+    from briefkasten.filetypes import write_manifest
+    fs_script = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts', 'process-attachments.sh'))
+    name = listdir(dropbox.fs_attachment_container)[0]
+    write_manifest(dropbox.fs_types_manifest, [(name, 'application/x-unknown; charset=binary')])
+    call([fs_script, '-d', dropbox.fs_path])
+    # the attachment is plain text according to `file`
+    assert dropbox._read_cleanser_status() == u'800 Not cleansible'
+    assert listdir(join(dropbox.fs_path, 'clean')) == [name]
+
+
+@mark.parametrize('data', [
+    # binary data following a byte order mark
+    '\xff\xfe' + ''.join(map(chr, range(256))) * 4,
+    '\xff\xfe' + '\x00\xe0\x01\xe0',
+    '\xfe\xff\x00\x00\xd8\x00\x00\x41',
+    # a zip file claiming to be text
+    'PK\x03\x04\x14\x00\x00\x00\x00\x00' + '\x00' * 20 + 'mimetypetext/plainPK\x03\x04',
+])
+def test_spoofed_text_is_not_cleansible(tmpdir, data):
+    from briefkasten.cleanser import cleanse_file
+    from briefkasten.filetypes import detect_type
+    fs_attachment = write(tmpdir, 'attachment', data)
+    assert not detect_type(fs_attachment).startswith('text/')
+    assert cleanse_file(fs_attachment, tmpdir.mkdir('clean').strpath)[0] == 800
+
+
+def test_utf16_text(tmpdir):
+    from briefkasten.filetypes import detect_type
+    fs_attachment = write(tmpdir, 'attachment', u'﻿Grüße\n'.encode('utf-16le'))
+    assert detect_type(fs_attachment) == 'text/plain; charset=utf-16le'
+
+
+@mark.parametrize('shift', [200, 0xffff, 7])
+def test_malformed_compound_document(tmpdir, shift):
+    from briefkasten.filetypes import detect_types
+    data = compound_document(u'WordDocument')
+    fs_attachment = write(tmpdir, 'attachment', data[:0x1e] + pack('<H', shift) + data[0x20:])
+    assert detect_types([fs_attachment]) == [('attachment', 'application/CDFV2; charset=binary')]
+
+
+def test_unparsable_files_are_binary(tmpdir, monkeypatch):
+    from briefkasten import filetypes
+
+    def broken(fileobj, head):
+        raise KeyError('unexpected')
+    monkeypatch.setitem(filetypes.refinements, 'application/zip', broken)
+    fs_attachment = write(tmpdir, 'attachment', 'PK\x03\x04')
+    assert filetypes.detect_types([fs_attachment]) == [('attachment', 'application/octet-stream; charset=binary')]
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from os import listdir
+from os.path import join
+from struct import pack
+from zlib import crc32
+from pytest import fixture, raises
+
+
+def png_chunk(kind, data):
+    return pack('>I', len(data)) + kind + data + pack('>I', crc32(kind + data) & 0xffffffff)
+
+
+def jpeg_segment(marker, payload):
+    return pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+
+
+jfif = 'JFIF\x00\x01\x01\x00\x00\x48\x00\x48'
+tables = (
+    jpeg_segment(0xdb, '\x00' + '\x01' * 64) +
+    jpeg_segment(0xc0, '\x08\x00\x10\x00\x10\x01\x01\x11\x00') +
+    jpeg_segment(0xc4, '\x00' + '\x00' * 16))
+# the entropy coded data contains stuffed 0xff bytes and restart markers
+scan = jpeg_segment(0xda, '\x01\x01\x00\x00\x3f\x00') + '\x12\xff\x00\x34\xff\xd0\x56\xff\xd1\x78'
+
+
+@fixture
+def png(testing):
+    with open(testing.asset_path('attachment.png'), 'rb') as image:
+        return image.read()
+
+
+def test_strip_png(png):
+    from briefkasten.images import strip_png
+    header, chunks = png[:33], png[33:]
+    tagged = header + png_chunk('tEXt', 'Author\x00Jane') + png_chunk('tIME', '\x07\xe2\x01\x01\x00\x00\x00') + \
+        png_chunk('eXIf', 'MM\x00*') + chunks[:-12] + png_chunk('iTXt', 'Comment\x00\x00\x00\x00\x00secret') + chunks[-12:]
+    stripped = strip_png(tagged)
+    assert stripped == strip_png(png)
+    for kind in ['tEXt', 'tIME', 'eXIf', 'iTXt']:
+        assert kind not in stripped
+    assert stripped.startswith(header)
+    assert stripped.endswith(png_chunk('IEND', ''))
+
+
+def test_strip_png_drops_trailing_data(png):
+    from briefkasten.images import strip_png
+    assert strip_png(png + 'trailer') == strip_png(png)
+
+
+def test_invalid_png(png):
+    from briefkasten.images import InvalidImage, strip_png
+    with raises(InvalidImage):
+        strip_png('GIF89a')
+    with raises(InvalidImage):
+        strip_png(png[:-20])
+    with raises(InvalidImage):
+        # wrong checksum of the header
+        strip_png(png[:29] + '\x00\x00\x00\x00' + png[33:])
+    with raises(InvalidImage):
+        # an unknown critical chunk
+        strip_png(png[:33] + png_chunk('XXXX', '') + png[33:])
+
+
+def test_strip_jpeg():
+    from briefkasten.images import strip_jpeg
+    jpeg = ('\xff\xd8' +
+        jpeg_segment(0xe0, jfif + '\x01\x01' + 'RGB') +
+        jpeg_segment(0xe1, 'Exif\x00\x00MM\x00*') +
+        jpeg_segment(0xe1, 'http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>') +
+        jpeg_segment(0xe2, 'ICC_PROFILE\x00\x01\x01') +
+        jpeg_segment(0xed, 'Photoshop 3.0\x00') +
+        jpeg_segment(0xfe, 'a comment') +
+        tables + scan +
+        '\xff\xd9' + 'trailer')
+    assert strip_jpeg(jpeg) == ('\xff\xd8' + jpeg_segment(0xe0, jfif + '\x00\x00') + tables + scan + '\xff\xd9')
+
+
+def test_strip_progressive_jpeg():
+    from briefkasten.images import strip_jpeg
+    # segments between the scans are cleansed as well, fill bytes are dropped
+    jpeg = '\xff\xd8' + tables + scan + jpeg_segment(0xfe, 'comment') + jpeg_segment(0xc4, '\x10' * 17) + \
+        scan + '\xff\xff\xd9'
+    assert strip_jpeg(jpeg) == '\xff\xd8' + tables + scan + jpeg_segment(0xc4, '\x10' * 17) + scan + '\xff\xd9'
+
+
+def test_strip_jpeg_keeps_colour_transform():
+    from briefkasten.images import strip_jpeg
+    adobe = jpeg_segment(0xee, 'Adobe\x00\x64\x00\x00\x00\x00\x02')
+    jpeg = '\xff\xd8' + adobe + jpeg_segment(0xe0, 'JFXX\x00\x10thumbnail') + tables + scan + '\xff\xd9'
+    assert strip_jpeg(jpeg) == '\xff\xd8' + adobe + tables + scan + '\xff\xd9'
+
+
+def test_invalid_jpeg():
+    from briefkasten.images import InvalidImage, strip_jpeg
+    for jpeg in [
+            '\x89PNG',
+            '\xff\xd8' + tables,
+            '\xff\xd8' + tables + scan,
+            '\xff\xd8' + tables[:-3],
+            '\xff\xd8garbage']:
+        with raises(InvalidImage):
+            strip_jpeg(jpeg)
+
+
+def test_cleanse_natively(testing, tmpdir):
+    from briefkasten.cleanser import cleanse_attachments
+    fs_target = tmpdir.join('clean').strpath
+    # there is no image cleanser in our test setup
+    assert cleanse_attachments([testing.asset_path('attachment.png')], fs_target).startswith(u'540')
+    status = cleanse_attachments([testing.asset_path('attachment.png')], fs_target, native_types=['image/png'])
+    assert status == u'299 Cleansed'
+    assert listdir(fs_target) == ['attachment.png']
+
+
+def test_cleanse_invalid_image_natively(tmpdir):
+    from briefkasten.cleanser import cleanse_file
+    fs_image = tmpdir.join('broken.png')
+    fs_image.write('\x89PNG\r\n\x1a\n', mode='wb')
+    assert cleanse_file(fs_image.strpath, tmpdir.strpath, native_types=['image/png']) == (
+        540, u'Error while cleansing file of type image/png')
+
+
+@fixture
+def native_cleanser(dropbox_container):
+    from os.path import abspath, dirname, join
+    # the real `process-attachments.sh` cleanses the text attachment locally
+    dropbox_container.settings['fs_bin_path'] = abspath(join(dirname(__file__), '..', '..', 'middleware_scripts'))
+    dropbox_container.settings['cleanser_native_types'] = ['image/png', 'text/plain']
+    return dropbox_container
+
+
+def test_dropbox_cleanses_only_images_natively(native_cleanser, dropbox, testing, monkeypatch):
+    from shutil import copy
+    from briefkasten import cleanser
+    copy(testing.asset_path('attachment.png'), dropbox.fs_attachment_container)
+    commands = []
+    monkeypatch.setattr(cleanser, 'call', lambda command, **kwargs: commands.append(command))
+    dropbox._process_attachments()
+    assert dropbox.status == u'299 Cleansed'
+    assert len(dropbox.fs_cleansed_attachments) == 2
+    # neither the text nor the image were handed to the local cleanser scripts
+    assert commands == []
+
+
+def test_dropbox_skips_script_for_images_only(native_cleanser, dropbox_without_attachment, testing, monkeypatch):
+    from shutil import copy
+    from briefkasten import dropbox as dropbox_module
+    from os import mkdir
+    dropbox = dropbox_without_attachment
+    mkdir(dropbox.fs_attachment_container)
+    copy(testing.asset_path('attachment.png'), dropbox.fs_attachment_container)
+    monkeypatch.setattr(dropbox_module, 'call', lambda *args, **kwargs: 1 / 0)
+    dropbox._process_attachments()
+    assert dropbox.status == u'299 Cleansed'
+    assert listdir(dropbox.fs_cleansed_attachment_container) == ['attachment.png']
+
+
+def test_native_failure_takes_precedence(native_cleanser, dropbox):
+    with open(join(dropbox.fs_attachment_container, 'broken.png'), 'wb') as image:
+        image.write('\x89PNG\r\n\x1a\n')
+    dropbox._process_attachments()
+    assert dropbox.status == u'540 Error while cleansing file of type image/png'
+
+
+def test_no_native_cleansing_with_remote_cleanser(tmpdir):
+    from briefkasten.dropbox import DropboxContainer
+    tmpdir.join('briefkasten.conf').write('the_jdispatcher_dir=/var/run/jdispatch/\n')
+    container = DropboxContainer(root=tmpdir.join('root').strpath, settings=dict(
+        fs_bin_path=tmpdir.strpath, fs_pgp_pubkeys=None, cleanser_native_types='image/png'))
+    assert container.settings['cleanser_native_types'] is None
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from os import remove
+from os.path import join
+from shutil import rmtree
+from time import time
+from pytest import fixture
+
+
+@fixture
+def index(tmpdir):
+    from briefkasten.index import DropIndex
+    return DropIndex(join(tmpdir.strpath, 'drops.sqlite'))
+
+
+def test_update_and_get(index):
+    index.update('foo', dict(status=u'020 submitted', created=1.0, status_changed=2.0, size=23))
+    assert index.get('foo') == dict(
+        drop_id='foo', status_int=20, created=1.0, last_changed=2.0, from_watchdog=0, size=23)
+    assert 'foo' in index
+    assert index.get('bar') is None
+
+
+def test_expired(index):
+    index.update('old', dict(status=u'900 success', status_changed=10.0))
+    index.update('older', dict(status=u'900 success', status_changed=5.0))
+    index.update('new', dict(status=u'900 success', status_changed=30.0))
+    index.update('watchdog', dict(status=u'900 success', status_changed=5.0, from_watchdog=True))
+    assert index.expired(20.0) == ['older', 'old']
+    assert index.expired(20.0, from_watchdog=True) == ['watchdog']
+
+
+def test_remove(index):
+    index.update('foo', dict(status=u'020 submitted'))
+    index.remove('foo')
+    assert len(index) == 0
+
+
+def test_dropbox_updates_index(dropbox_container, dropbox):
+    indexed = dropbox_container.index.get(dropbox.drop_id)
+    assert indexed['status_int'] == 10
+    assert indexed['size'] == dropbox.size_dirty_attachments
+    assert indexed['created'] <= time()
+    dropbox.status = u'020 submitted'
+    assert dropbox_container.index.get(dropbox.drop_id)['status_int'] == 20
+    dropbox.destroy()
+    assert dropbox.drop_id not in dropbox_container.index
+
+
+@fixture
+def watchdog_dropbox(dropbox_container):
+    return dropbox_container.add_dropbox(u'watchdog', message=u'Hallo', from_watchdog=True)
+
+
+def test_container_iterates_over_index(dropbox_container, dropbox, watchdog_dropbox):
+    assert sorted([drop.drop_id for drop in dropbox_container]) == sorted([dropbox.drop_id, watchdog_dropbox.drop_id])
+    # drops that have been removed behind the index's back aren't resurrected
+    rmtree(dropbox.fs_path)
+    assert [drop.drop_id for drop in dropbox_container] == [watchdog_dropbox.drop_id]
+    assert dropbox.drop_id not in dropbox_container
+
+
+def test_container_rebuilds_missing_index(dropbox_container, dropbox, watchdog_dropbox):
+    from briefkasten.dropbox import DropboxContainer
+    remove(dropbox_container.index.fs_index)
+    container = DropboxContainer(root=dropbox_container.fs_root, settings=dict(
+        smtp=dropbox_container.settings['smtp'],
+        fs_bin_path=dropbox_container.settings['fs_bin_path']))
+    assert len(container.index) == 2
+    assert container.index.get(watchdog_dropbox.drop_id)['from_watchdog']
+
+
+def test_legacy_drops_without_last_change_expire(index):
+    index.update('legacy', dict(status=u'900 success', created=1.0))
+    assert index.get('legacy')['last_changed'] == 0
+    assert index.expired(20.0) == ['legacy']
+
+
+def test_index_errors_dont_break_metadata_updates(dropbox_container, dropbox, monkeypatch):
+    import sqlite3
+
+    def broken(drop_id, metadata):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(dropbox_container.index, 'update', broken)
+    dropbox.status = u'020 submitted'
+    assert dropbox._read_metadata()['status'] == u'020 submitted'
+    assert dropbox.status_int == 20
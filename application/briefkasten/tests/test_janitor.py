@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from os.path import exists
+from pytest import fixture
+
+
+@fixture
+def drops(dropbox_container):
+    return [dropbox_container.add_dropbox(u'drop%02d' % i, message=u'Hallo') for i in range(5)]
+
+
+def test_dry_run_reports_without_removing(dropbox_container, drops):
+    from briefkasten.janitor import disk_usage, sweep
+    drop_ids = [drop.drop_id for drop in drops]
+    num_removed, size_removed = sweep(dropbox_container, drop_ids, dry_run=True, batch_size=2)
+    assert num_removed == 5
+    assert size_removed == sum([disk_usage(drop.fs_path) for drop in drops])
+    assert size_removed > 0
+    assert all([exists(drop.fs_path) for drop in drops])
+    assert len(dropbox_container.index) == 5
+
+
+def test_sweep_removes_drops_and_index_entries(dropbox_container, drops):
+    from briefkasten.janitor import sweep
+    sweep(dropbox_container, [drop.drop_id for drop in drops[:3]], threads=2, batch_size=2)
+    assert [exists(drop.fs_path) for drop in drops] == [False, False, False, True, True]
+    assert sorted(dropbox_container.index) == [u'drop03', u'drop04']
+
+
+def test_sweep_ignores_missing_drops(dropbox_container, drops):
+    from briefkasten.janitor import sweep
+    drops[0].destroy()
+    dropbox_container.index.update(drops[0].drop_id, drops[0].metadata)
+    assert sweep(dropbox_container, [drops[0].drop_id]) == (1, 0)
+    assert drops[0].drop_id not in dropbox_container.index
+
+
+def test_sweep_is_rate_limited(dropbox_container, drops, monkeypatch):
+    from briefkasten import janitor
+    naps = []
+    monkeypatch.setattr(janitor, 'sleep', naps.append)
+    janitor.sweep(dropbox_container, [drop.drop_id for drop in drops], batch_size=100, max_rate=2)
+    # batches are capped at the rate, so we've paused after each of them...
+    assert len(naps) == 3
+    # ...and (since we didn't really sleep) the last pause makes up for the whole sweep
+    assert 2 < naps[-1] <= 2.5
+
+
+def test_sweep_keeps_drops_it_cannot_remove(dropbox_container, drops, monkeypatch):
+    from briefkasten import janitor
+    rmtree = janitor.shutil.rmtree
+
+    def failing_rmtree(fs_path, ignore_errors=False):
+        # pretend the first drop can't be removed (i.e. due to its permissions)
+        if fs_path != drops[0].fs_path:
+            rmtree(fs_path, ignore_errors=ignore_errors)
+    monkeypatch.setattr(janitor.shutil, 'rmtree', failing_rmtree)
+    num_removed, size_removed = janitor.sweep(dropbox_container, [drop.drop_id for drop in drops[:2]])
+    assert num_removed == 1
+    assert exists(drops[0].fs_path)
+    assert sorted(dropbox_container.index) == [u'drop00', u'drop02', u'drop03', u'drop04']
+
+
+def test_expire_abandoned_uploads(dropbox_container, drops):
+    from os import listdir, utime
+    from os.path import join
+    from time import time
+    from briefkasten.janitor import expire_uploads
+    abandoned = drops[0].create_upload(u'abandoned.txt', 100)
+    fs_abandoned = join(drops[0].fs_attachment_container, '.upload-%s' % abandoned)
+    with open(fs_abandoned, 'w') as upload:
+        upload.write('x' * 10)
+    utime(fs_abandoned, (time() - 7200, time() - 7200))
+    active = drops[1].create_upload(u'active.txt', 100)
+    assert expire_uploads(dropbox_container, 3600, dry_run=True) == (1, 10)
+    assert exists(fs_abandoned)
+    assert expire_uploads(dropbox_container, 3600) == (1, 10)
+    assert listdir(drops[0].fs_attachment_container) == []
+    assert drops[0]._read_metadata()['uploads'] == {}
+    assert list(drops[1]._read_metadata()['uploads']) == [active]
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import socket
+from os.path import exists, join
+from threading import Thread
+from time import sleep, time
+from pytest import fixture
+
+
+@fixture
+def leases(jdispatch):
+    from briefkasten.leases import LeaseManager
+    return LeaseManager(jdispatch, poll_interval=0.05)
+
+
+def acquire_in_background(leases, results, timeout=5):
+    thread = Thread(target=lambda: results.append(leases.acquire(timeout=timeout)))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=5):
+    deadline = time() + timeout
+    while not condition() and time() < deadline:
+        sleep(0.01)
+    assert condition()
+
+
+def test_acquire_claims_jail(leases, jdispatch):
+    lease = leases.acquire()
+    assert lease.name == 'cleanser_01'
+    assert lease.address == ('127.0.0.1', 2201)
+    assert exists(join(jdispatch, 'cleanser_01', 'token', 'taken'))
+    assert leases.acquire().name == 'cleanser_02'
+
+
+def test_acquire_times_out(leases):
+    leases.acquire()
+    leases.acquire()
+    assert leases.acquire(timeout=0.1) is None
+    assert leases.timeouts == 1
+    assert leases.wait_times.stages['wait']['count'] == 3
+
+
+def test_release_frees_jail(leases, jdispatch):
+    lease = leases.acquire()
+    leases.release(lease)
+    assert not exists(join(jdispatch, 'cleanser_01', 'token', 'taken'))
+    assert leases.leases == {}
+
+
+def test_release_after_cleanser_released_jail(leases, jdispatch):
+    from subprocess import call
+    lease = leases.acquire()
+    # process-attachments.sh releases the jail itself, after which jdispatch recycles it
+    open(join(jdispatch, 'cleanser_01', 'token', 'done'), 'w').close()
+    leases.release(lease)
+    assert exists(join(jdispatch, 'cleanser_01', 'token', 'taken'))
+    call([join(jdispatch, 'cleanser_01', 'release')])
+    assert leases.acquire(timeout=0).name == 'cleanser_01'
+
+
+def test_waiters_are_served_in_order(leases):
+    held = [leases.acquire(), leases.acquire()]
+    results = []
+    first = acquire_in_background(leases, results)
+    wait_for(lambda: leases.num_waiting == 1)
+    second = acquire_in_background(leases, results)
+    wait_for(lambda: leases.num_waiting == 2)
+    leases.release(held[0])
+    first.join(5)
+    assert len(results) == 1
+    assert leases.num_waiting == 1
+    leases.release(held[1])
+    second.join(5)
+    assert [lease.name for lease in results] == ['cleanser_01', 'cleanser_02']
+
+
+def test_release_hands_over_immediately(jdispatch):
+    from briefkasten.leases import LeaseManager
+    leases = LeaseManager(jdispatch, poll_interval=30)
+    held = [leases.acquire(), leases.acquire()]
+    results = []
+    waiter = acquire_in_background(leases, results)
+    wait_for(lambda: leases.num_waiting == 1)
+    started = time()
+    leases.release(held[1])
+    waiter.join(5)
+    assert results[0].name == 'cleanser_02'
+    assert time() - started < 5
+
+
+def test_leases_expire(jdispatch):
+    from briefkasten.leases import LeaseManager
+    leases = LeaseManager(jdispatch, lease_timeout=0.05)
+    leases.acquire()
+    sleep(0.1)
+    leases.expire()
+    assert leases.leases == {}
+    assert leases.expired == 1
+
+
+def test_health_check(tmpdir):
+    from briefkasten.leases import LeaseManager
+    from briefkasten.testing import make_jdispatch
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    try:
+        fs_dispatcher = make_jdispatch(tmpdir.join('jdispatch').strpath, [
+            '127.0.0.1:%d' % closed.getsockname()[1],
+            '127.0.0.1:%d' % listener.getsockname()[1]])
+        leases = LeaseManager(fs_dispatcher, health_check=True, health_timeout=1)
+        # the first jail isn't listening, so it's released again
+        assert leases.acquire(timeout=0).name == 'cleanser_02'
+        assert leases.unhealthy == 1
+        assert not exists(join(fs_dispatcher, 'cleanser_01', 'token', 'taken'))
+        assert leases.acquire(timeout=0) is None
+    finally:
+        listener.close()
+        closed.close()
+
+
+def test_jails_without_address_are_skipped(leases, jdispatch):
+    from os import remove
+    # jdispatch removes the address of a jail while recycling it
+    remove(join(jdispatch, 'cleanser_01', 'ip'))
+    assert leases.jails() == [join(jdispatch, 'cleanser_02')]
+    assert leases.acquire(timeout=0).name == 'cleanser_02'
+    assert not exists(join(jdispatch, 'cleanser_01', 'token', 'taken'))
+
+
+def test_missing_dispatcher(tmpdir):
+    from briefkasten.leases import LeaseManager
+    leases = LeaseManager(tmpdir.join('missing').strpath)
+    assert leases.jails() == []
+    assert leases.acquire(timeout=0) is None
+
+
+def test_dispatcher_is_passed_to_cleanser(monkeypatch, dropbox, jdispatch):
+    from briefkasten import dropbox as dropbox_module
+    environments = []
+    monkeypatch.setattr(dropbox_module, 'call', lambda *args, **kwargs: environments.append(kwargs['env']))
+    dropbox._process_attachments()
+    assert 'the_dispatcher' not in environments[0]
+    dropbox.cleanser_dispatcher = join(jdispatch, 'cleanser_01')
+    dropbox._process_attachments()
+    assert environments[1]['the_dispatcher'] == join(jdispatch, 'cleanser_01')
+
+
+def test_lease_metrics(dropbox_container, leases):
+    from briefkasten.metrics import WorkerMetrics
+    from briefkasten.scheduler import Scheduler
+    leases.acquire()
+    metrics = WorkerMetrics(dropbox_container, Scheduler(dropbox_container.fs_submission_queue), leases=leases).render()
+    assert 'briefkasten_cleanser_jails 2\n' in metrics
+    assert 'briefkasten_cleanser_leases 1\n' in metrics
+    assert 'briefkasten_cleanser_lease_waiters 0\n' in metrics
+    assert 'briefkasten_cleanser_lease_wait_seconds_count 1\n' in metrics
+    assert 'briefkasten_cleanser_lease_wait_seconds_bucket{le="0.1"} 1\n' in metrics
+
+
+def test_claiming_does_not_hold_the_lock(leases, monkeypatch):
+    from threading import Event
+    held = leases.acquire()
+    claiming, proceed = Event(), Event()
+    claim = leases._claim
+
+    def slow_claim():
+        claiming.set()
+        proceed.wait(5)
+        return claim()
+    monkeypatch.setattr(leases, '_claim', slow_claim)
+    results = []
+    waiter = acquire_in_background(leases, results)
+    assert claiming.wait(5)
+    # leases can be released while another caller is claiming a jail
+    releaser = Thread(target=leases.release, args=(held,))
+    releaser.daemon = True
+    releaser.start()
+    releaser.join(1)
+    assert not releaser.is_alive()
+    assert leases.leases == {}
+    proceed.set()
+    waiter.join(5)
+    assert results[0] is not None
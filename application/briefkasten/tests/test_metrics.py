@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from pytest import fixture
+from time import time
+
+
+@fixture
+def timings(dropbox_container, dropbox):
+    dropbox.process()
+    return dropbox_container.get_dropbox(dropbox.drop_id).metadata['timings']
+
+
+def test_process_records_stages(dropbox, timings):
+    assert set(timings['stages']) >= set(['backup', 'cleanser', 'notification'])
+    for stage in timings['stages'].values():
+        assert timings['started'] <= stage['started'] <= stage['finished'] <= timings['finished']
+        assert stage['duration'] >= 0
+    assert timings['stages']['backup']['size'] > 0
+    assert timings['duration'] == timings['finished'] - timings['started']
+
+
+def test_process_counts_gpg_and_smtp_calls(timings):
+    # the backup, the text and the attachment for the only editor
+    assert timings['counts'] == dict(gpg=3, smtp=1)
+
+
+def test_process_restores_gpg_context(dropbox_container, dropbox):
+    dropbox.process()
+    assert dropbox.gpg_context is dropbox_container.gpg_context
+
+
+def test_pipelined_processing_records_stages(dropbox_container, dropbox):
+    dropbox_container.settings['pipelined_processing'] = True
+    dropbox.process()
+    stages = dropbox.metadata['timings']['stages']
+    assert stages['backup']['finished'] is not None
+    # the backup is created while cleansing
+    assert stages['backup']['started'] <= stages['cleanser']['started']
+
+
+def test_stage_is_finished_only_once():
+    from briefkasten.metrics import DropTimings
+    timings = DropTimings()
+    with timings.stage('backup', size=10):
+        pass
+    finished = timings.stages['backup']['finished']
+    timings.finish('backup')
+    timings.finish('unknown')
+    assert timings.stages['backup']['finished'] == finished
+    assert 'unknown' not in timings.stages
+
+
+def test_histograms():
+    from briefkasten.metrics import StageHistograms
+    histograms = StageHistograms(buckets=[1, 10])
+    histograms.observe(dict(duration=5, stages=dict(backup=dict(duration=0.5, size=100)), counts=dict(gpg=2, smtp=1)))
+    histograms.observe(dict(duration=20, stages=dict(backup=dict(duration=2, size=50)), counts=dict(gpg=3, smtp=1)))
+    histograms.observe(dict(duration=None, stages=dict(backup=dict(duration=None))))
+    assert histograms.stages['backup'] == dict(buckets=[1, 2], count=2, sum=2.5, size=150)
+    assert histograms.stages['total'] == dict(buckets=[0, 1], count=2, sum=25.0, size=0)
+    assert histograms.counts == dict(gpg=5, smtp=2)
+
+
+@fixture
+def worker_metrics(dropbox_container):
+    from briefkasten.metrics import WorkerMetrics
+    from briefkasten.scheduler import Scheduler
+    scheduler = Scheduler(dropbox_container.fs_submission_queue, classify=lambda drop_id: 'small', classes=['text', 'small'])
+    return WorkerMetrics(dropbox_container, scheduler, slots=2)
+
+
+def test_worker_records_completions(dropbox_container, dropbox, timings, worker_metrics):
+    from briefkasten.commands import record_completion
+    assert record_completion(dropbox_container, worker_metrics, dropbox.drop_id) == timings
+    assert worker_metrics.completions == {900: 1}
+    assert worker_metrics.histograms.stages['total']['count'] == 1
+    assert worker_metrics.histograms.counts['smtp'] == 1
+    assert worker_metrics.throughput() > 0
+
+
+def test_throughput_window(worker_metrics):
+    worker_metrics.started -= 3600
+    worker_metrics.recent.extend([worker_metrics.started, time() - 120, time() - 60])
+    # only the completions of the last 15 minutes count
+    assert worker_metrics.throughput() == 2 * 60.0 / 900
+    assert len(worker_metrics.recent) == 2
+
+
+def test_metrics_exposition(dropbox_container, dropbox, drop_id, timings, worker_metrics):
+    dropbox.submit()
+    worker_metrics.completed(dropbox)
+    worker_metrics.scheduler.add(drop_id)
+    metrics = worker_metrics.render()
+    assert 'briefkasten_submission_queue_depth 1\n' in metrics
+    assert 'briefkasten_scratch_depth 0\n' in metrics
+    assert 'briefkasten_worker_pending{class="small"} 1\n' in metrics
+    assert 'briefkasten_worker_in_flight{class="small"} 0\n' in metrics
+    assert 'briefkasten_worker_slots 2\n' in metrics
+    assert 'briefkasten_worker_drops_completed_total{status="20"} 1\n' in metrics
+    assert 'briefkasten_worker_drops_failed_total 0\n' in metrics
+    assert 'briefkasten_drop_stage_duration_seconds_bucket{le="+Inf",stage="backup"} 1\n' in metrics
+    assert 'briefkasten_drop_stage_duration_seconds_count{stage="total"} 1\n' in metrics
+    assert 'briefkasten_drop_calls_total{service="gpg"} 3\n' in metrics
+    assert '# TYPE briefkasten_drop_stage_duration_seconds histogram\n' in metrics
+
+
+def test_metrics_are_replaced_atomically(worker_metrics, tmpdir):
+    fs_metrics = tmpdir.join('briefkasten.prom')
+    fs_metrics.write('stale')
+    worker_metrics.write(fs_metrics.strpath)
+    assert fs_metrics.read().startswith('# HELP briefkasten_submission_queue_depth')
+    assert [name for name in tmpdir.listdir() if name.basename.startswith('.metrics')] == []
+
+
+def test_failed_metrics_leave_no_temporary_file(worker_metrics, tmpdir, monkeypatch):
+    from pytest import raises
+    fs_metrics = tmpdir.join('briefkasten.prom')
+    # the metrics can't be moved onto a directory...
+    fs_metrics.mkdir()
+    with raises(OSError):
+        worker_metrics.write(fs_metrics.strpath)
+
+    def broken():
+        raise ValueError('oops')
+    # ...or rendering them fails
+    monkeypatch.setattr(worker_metrics, 'render', broken)
+    with raises(ValueError):
+        worker_metrics.write(tmpdir.join('other.prom').strpath)
+    assert [name for name in tmpdir.listdir() if name.basename.startswith('.metrics')] == []
+    assert not tmpdir.join('other.prom').exists()
+
+
+def test_format_timings():
+    from briefkasten.metrics import format_timings
+    assert format_timings(dict(
+        duration=3.5,
+        stages=dict(
+            notification=dict(started=2, duration=0.5),
+            backup=dict(started=1, duration=1)),
+        counts=dict(gpg=3, smtp=1))) == '3.50s (backup 1.00s, notification 0.50s; 3 gpg, 1 smtp)'
+
+
+def test_scratch_depth_ignores_staged_backups(dropbox_container, drop_id, worker_metrics):
+    from os import mkdir
+    from os.path import join
+    mkdir(join(dropbox_container.fs_scratch, drop_id))
+    open(join(dropbox_container.fs_scratch, '%s.zip.pgp' % drop_id), 'w').close()
+    assert 'briefkasten_scratch_depth 1\n' in worker_metrics.render()
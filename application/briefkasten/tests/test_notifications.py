@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from os import utime
+from os.path import getmtime, join
+from pytest import fixture
+
+
+@fixture
+def keyring(dropbox_container):
+    from mock import MagicMock
+    keyring = dropbox_container.keyring
+    keyring.gpg_context.list_keys = MagicMock(wraps=keyring.gpg_context.list_keys)
+    return keyring
+
+
+def test_parse_email():
+    from briefkasten.notifications import parse_email
+    assert parse_email(u'Jane Doe <Jane@Example.com>') == u'jane@example.com'
+    assert parse_email(u'<jane@example.com>') == u'jane@example.com'
+    assert parse_email(u'jane@example.com') == u'jane@example.com'
+
+
+def test_keyring_lookup_by_email(keyring):
+    keys = keyring.lookup(u'editor@briefkasten.dtfh.de')
+    assert len(keys) == 1
+    assert keys[0]['fingerprint'] == u'7CF4CB8B824A0DADF42F9FF09121BE9F1C808975'
+
+
+def test_keyring_lookup_by_uid(keyring):
+    assert len(keyring.lookup(u'<admin@briefkasten.dtfh.de>')) == 1
+
+
+def test_keyring_lookup_unknown(keyring):
+    assert keyring.lookup(u'nobody@briefkasten.dtfh.de') == []
+    assert not keyring.is_valid(u'nobody@briefkasten.dtfh.de')
+
+
+def test_keyring_lists_keys_only_once(keyring):
+    for i in range(5):
+        assert keyring.is_valid(u'<editor@briefkasten.dtfh.de>')
+    assert keyring.gpg_context.list_keys.call_count == 1
+
+
+def test_keyring_is_refreshed_when_pubring_changes(keyring):
+    keyring.lookup(u'editor@briefkasten.dtfh.de')
+    fs_pubring = join(keyring.gpg_context.gnupghome, 'pubring.gpg')
+    mtime = getmtime(fs_pubring) + 10
+    utime(fs_pubring, (mtime, mtime))
+    keyring.lookup(u'editor@briefkasten.dtfh.de')
+    assert keyring.gpg_context.list_keys.call_count == 2
+
+
+def test_check_recipient_accepts_gpg_context(dropbox_container):
+    from briefkasten.notifications import checkRecipient
+    assert checkRecipient(dropbox_container.gpg_context, u'<editor@briefkasten.dtfh.de>')
+
+
+def test_dropbox_shares_container_keyring(dropbox, dropbox_container):
+    assert dropbox.keyring is dropbox_container.keyring
+
+
+@fixture
+def counting_gpg(dropbox_container):
+    from mock import MagicMock
+    gpg_context = dropbox_container.gpg_context
+    gpg_context.encrypt = MagicMock(wraps=gpg_context.encrypt)
+    gpg_context.encrypt_file = MagicMock(wraps=gpg_context.encrypt_file)
+    return gpg_context
+
+
+@fixture
+def editors():
+    return [u'editor@briefkasten.dtfh.de', u'admin@briefkasten.dtfh.de', u'nobody@briefkasten.dtfh.de']
+
+
+def send(dropbox_container, counting_gpg, editors, attachments, **kw):
+    from briefkasten.notifications import sendMultiPart
+    return sendMultiPart(
+        dropbox_container.settings['smtp'],
+        counting_gpg,
+        u'noreply@briefkasten',
+        editors,
+        u'Drop foo',
+        u'Schönen guten Tag!',
+        attachments,
+        keyring=dropbox_container.keyring,
+        **kw)
+
+
+def test_send_multipart_encrypts_per_recipient(dropbox_container, counting_gpg, editors, testing):
+    assert send(dropbox_container, counting_gpg, editors, [testing.asset_path('attachment.txt')]) == 2
+    assert counting_gpg.encrypt.call_count == 2
+    # `encrypt` is implemented via `encrypt_file`, so each recipient costs two calls:
+    assert counting_gpg.encrypt_file.call_count == 4
+    assert dropbox_container.settings['smtp'].sendmail.call_count == 2
+
+
+def test_send_multipart_encrypt_once(dropbox_container, counting_gpg, editors, testing):
+    assert send(dropbox_container, counting_gpg, editors, [testing.asset_path('attachment.txt')], encrypt_once=True) == 2
+    assert counting_gpg.encrypt.call_count == 1
+    assert counting_gpg.encrypt_file.call_count == 2
+    assert counting_gpg.encrypt.call_args[0][1] == [u'<editor@briefkasten.dtfh.de>', u'<admin@briefkasten.dtfh.de>']
+    sendmail = dropbox_container.settings['smtp'].sendmail
+    assert [c[0][1] for c in sendmail.call_args_list] == editors[:2]
+
+
+def test_send_multipart_encrypt_once_without_valid_recipients(dropbox_container, counting_gpg, testing):
+    assert send(dropbox_container, counting_gpg, [u'nobody@briefkasten.dtfh.de'], [], encrypt_once=True) == 0
+    assert counting_gpg.encrypt.call_count == 0
+
+
+def test_notify_editors_encrypt_once(dropbox, dropbox_container, counting_gpg):
+    dropbox.settings['mail.encrypt_once'] = True
+    dropbox.editors = [u'editor@briefkasten.dtfh.de', u'admin@briefkasten.dtfh.de']
+    assert dropbox._notify_editors() == 2
+    assert counting_gpg.encrypt.call_count == 1
+
+
+@fixture
+def pooled_smtp(monkeypatch):
+    from mock import MagicMock
+    from smtplib import SMTP
+    from briefkasten.notifications import setup_smtp_factory
+    for name, value in [('connect', (220, 'hi')), ('noop', (250, 'ok')), ('sendmail', {}),
+            ('starttls', (220, 'go ahead')), ('login', (235, 'ok')), ('quit', (221, 'bye'))]:
+        monkeypatch.setattr(SMTP, name, MagicMock(return_value=value))
+    return setup_smtp_factory(**{'mail.persistent': True, 'mail.user': 'bob', 'mail.password': 'secret'})
+
+
+def test_smtp_factory_defaults_to_custom_smtp():
+    from briefkasten.notifications import CustomSMTP, PooledSMTP, setup_smtp_factory
+    smtp = setup_smtp_factory()
+    assert isinstance(smtp, CustomSMTP)
+    assert not isinstance(smtp, PooledSMTP)
+
+
+def test_pooled_smtp_reuses_session(pooled_smtp):
+    from smtplib import SMTP
+    for i in range(3):
+        pooled_smtp.begin()
+        pooled_smtp.sendmail('noreply@briefkasten', 'editor@briefkasten.dtfh.de', 'hi')
+        pooled_smtp.quit()
+    assert SMTP.connect.call_count == 1
+    assert SMTP.login.call_count == 1
+    assert SMTP.quit.call_count == 0
+    assert SMTP.noop.call_count == 2
+
+
+def test_pooled_smtp_reconnects_after_failed_health_check(pooled_smtp):
+    from smtplib import SMTP, SMTPServerDisconnected
+    pooled_smtp.begin()
+    SMTP.noop.side_effect = SMTPServerDisconnected()
+    pooled_smtp.begin()
+    assert SMTP.connect.call_count == 2
+
+
+def test_pooled_smtp_resends_after_disconnect(pooled_smtp):
+    from smtplib import SMTP, SMTPServerDisconnected
+    pooled_smtp.begin()
+    SMTP.sendmail.side_effect = [SMTPServerDisconnected(), {}]
+    pooled_smtp.sendmail('noreply@briefkasten', 'editor@briefkasten.dtfh.de', 'hi')
+    assert SMTP.sendmail.call_count == 2
+    assert SMTP.connect.call_count == 2
+
+
+def test_pooled_smtp_shutdown(pooled_smtp):
+    from smtplib import SMTP
+    pooled_smtp.begin()
+    pooled_smtp.shutdown()
+    assert SMTP.quit.call_count == 1
+
+
+def test_pooled_smtp_reconnects_with_starttls(monkeypatch):
+    from mock import MagicMock
+    from smtplib import SMTP, SMTPServerDisconnected
+    import smtplib
+    from briefkasten.notifications import setup_smtp_factory
+    greetings = []
+
+    def connect(self, host, port):
+        self.sock = MagicMock()
+        self.tls = False
+        return (220, 'hi')
+
+    def ehlo(self, name=''):
+        # the server only offers STARTTLS before and AUTH after the TLS negotiation
+        greetings.append(self.tls)
+        self.ehlo_resp = 'hi'
+        self.does_esmtp = 1
+        self.esmtp_features = {'auth': 'PLAIN'} if self.tls else {'starttls': ''}
+        return (250, 'hi')
+
+    def docmd(self, cmd, args=''):
+        if cmd == 'STARTTLS':
+            self.tls = True
+            return (220, 'go ahead')
+        return (235, 'authenticated')
+    monkeypatch.setattr(SMTP, 'connect', connect)
+    monkeypatch.setattr(SMTP, 'ehlo', ehlo)
+    monkeypatch.setattr(SMTP, 'docmd', docmd)
+    monkeypatch.setattr(SMTP, 'noop', MagicMock(side_effect=SMTPServerDisconnected()))
+    monkeypatch.setattr(smtplib.ssl, 'wrap_socket', lambda sock, *args: sock)
+    smtp = setup_smtp_factory(**{'mail.persistent': True, 'mail.user': 'bob', 'mail.password': 'secret'})
+    smtp.begin()
+    # the session has been dropped by the server in the meantime
+    smtp.begin()
+    assert greetings == [False, True, False, True]
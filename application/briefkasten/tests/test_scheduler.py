@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from os.path import join
+from pytest import fixture
+
+
+@fixture
+def fs_queue(tmpdir):
+    return tmpdir.mkdir('submissions').strpath
+
+
+def submit(fs_queue, *drop_ids):
+    for drop_id in drop_ids:
+        open(join(fs_queue, drop_id), 'w').close()
+
+
+@fixture
+def scheduler(fs_queue):
+    from briefkasten.scheduler import Scheduler
+    return Scheduler(fs_queue)
+
+
+def test_add_is_deduplicated(scheduler):
+    assert scheduler.add('foo')
+    assert not scheduler.add('foo')
+    assert scheduler.num_pending == 1
+
+
+def test_drops_are_handed_out_in_order(scheduler):
+    scheduler.add('foo')
+    scheduler.add('bar')
+    assert scheduler.next(timeout=0) == ('foo', 'default')
+    assert scheduler.next(timeout=0) == ('bar', 'default')
+    assert scheduler.next(timeout=0) == (None, None)
+
+
+def test_in_flight_drops_are_not_added_again(scheduler):
+    scheduler.add('foo')
+    scheduler.next(timeout=0)
+    assert not scheduler.add('foo')
+    scheduler.done('foo')
+    assert scheduler.add('foo')
+
+
+def test_reconcile(scheduler, fs_queue):
+    submit(fs_queue, 'foo', 'bar')
+    assert scheduler.reconcile() == 2
+    scheduler.next(timeout=0)
+    submit(fs_queue, 'baz')
+    assert scheduler.reconcile() == 1
+    assert scheduler.num_pending == 2
+
+
+def test_limits_bound_concurrency(fs_queue):
+    from briefkasten.scheduler import Scheduler
+    scheduler = Scheduler(
+        fs_queue,
+        classify=lambda drop_id: drop_id.split('-')[0],
+        classes=['text', 'attachments'],
+        limits=dict(attachments=1))
+    for drop_id in ['attachments-1', 'attachments-2', 'text-1']:
+        scheduler.add(drop_id)
+    assert scheduler.next(timeout=0) == ('text-1', 'text')
+    assert scheduler.next(timeout=0) == ('attachments-1', 'attachments')
+    assert scheduler.next(timeout=0) == (None, None)
+    scheduler.done('attachments-1')
+    assert scheduler.next(timeout=0) == ('attachments-2', 'attachments')
+
+
+@fixture
+def priority_scheduler(fs_queue):
+    from briefkasten.scheduler import Scheduler
+    return Scheduler(
+        fs_queue,
+        classify=lambda drop_id: drop_id.split('-')[0],
+        classes=['text', 'small', 'large', 'watchdog'],
+        limits=dict(small=2, large=1, watchdog=1),
+        max_in_flight=2,
+        promote_after=60)
+
+
+def test_classes_are_served_by_priority(priority_scheduler):
+    for drop_id in ['watchdog-1', 'large-1', 'small-1', 'text-1', 'small-2']:
+        priority_scheduler.add(drop_id)
+    assert priority_scheduler.next(timeout=0) == ('text-1', 'text')
+    assert priority_scheduler.next(timeout=0) == ('small-1', 'small')
+    assert priority_scheduler.next(timeout=0) == ('small-2', 'small')
+    # all workers are busy now
+    assert priority_scheduler.next(timeout=0) == (None, None)
+    priority_scheduler.done('small-1')
+    assert priority_scheduler.next(timeout=0) == ('large-1', 'large')
+
+
+def test_text_drops_are_not_bound_by_max_in_flight(priority_scheduler):
+    for drop_id in ['small-1', 'small-2', 'small-3']:
+        priority_scheduler.add(drop_id)
+    priority_scheduler.next(timeout=0)
+    priority_scheduler.next(timeout=0)
+    priority_scheduler.add('text-1')
+    assert priority_scheduler.next(timeout=0) == ('text-1', 'text')
+    assert priority_scheduler.next(timeout=0) == (None, None)
+
+
+def test_waiting_drops_are_promoted(priority_scheduler):
+    for drop_id in ['large-1', 'small-1', 'watchdog-1']:
+        priority_scheduler.add(drop_id)
+    # the watchdog drop has been waiting long enough to rank with (and, being older,
+    # before) the large one...
+    priority_scheduler.pending['watchdog']['watchdog-1'] -= 61
+    assert priority_scheduler.next(timeout=0) == ('small-1', 'small')
+    assert priority_scheduler.next(timeout=0) == ('watchdog-1', 'watchdog')
+    priority_scheduler.done('small-1')
+    priority_scheduler.done('watchdog-1')
+    # ...and a large drop waiting for a minute ranks with small drops
+    priority_scheduler.add('small-2')
+    priority_scheduler.pending['large']['large-1'] -= 60
+    assert priority_scheduler.next(timeout=0) == ('large-1', 'large')
+
+
+def test_next_is_woken_up_by_add(scheduler):
+    from threading import Timer
+    Timer(0.05, scheduler.add, ['foo']).start()
+    assert scheduler.next(timeout=5) == ('foo', 'default')
+
+
+def test_submission_handler(scheduler, fs_queue):
+    from briefkasten.commands import SubmissionHandler
+    from watchdog.events import FileCreatedEvent, FileMovedEvent, DirCreatedEvent
+    handler = SubmissionHandler(scheduler)
+    handler.on_created(FileCreatedEvent(join(fs_queue, 'foo')))
+    handler.on_created(DirCreatedEvent(join(fs_queue, 'bar')))
+    handler.on_moved(FileMovedEvent(join(fs_queue, '.tmp'), join(fs_queue, 'baz')))
+    assert scheduler.next(timeout=0)[0] == 'foo'
+    assert scheduler.next(timeout=0)[0] == 'baz'
+    assert scheduler.num_pending == 0
+
+
+def test_process_scheduled_drop_returns_drop_id_on_failure(dropbox):
+    from briefkasten.commands import process_scheduled_drop
+    dropbox.submit()
+
+    def broken():
+        raise ValueError('oops')
+    dropbox.process = broken
+    assert process_scheduled_drop(dropbox) == dropbox.drop_id
+
+
+def test_process_drop_id_uses_worker_container(dropbox, dropbox_container, monkeypatch, testing):
+    from briefkasten import commands
+    monkeypatch.setattr(commands, 'worker_container', None)
+    commands.init_worker(dropbox_container.fs_root, settings=dict(
+        smtp=dropbox_container.settings['smtp'],
+        fs_bin_path=testing.asset_path('bin')))
+    worker_container = commands.worker_container
+    assert worker_container is not dropbox_container
+    dropbox.submit()
+    assert commands.process_drop_id(dropbox.drop_id) == dropbox.drop_id
+    assert dropbox_container.get_dropbox(dropbox.drop_id).status == u'900 success'
+    # the container is kept for subsequent drops
+    commands.process_drop_id(dropbox.drop_id)
+    assert commands.worker_container is worker_container
+
+
+def test_process_drop_id_returns_drop_id_on_failure(dropbox_container, monkeypatch):
+    from briefkasten import commands
+    monkeypatch.setattr(commands, 'worker_container', dropbox_container)
+
+    def broken(drop_id):
+        raise ValueError('oops')
+    monkeypatch.setattr(dropbox_container, 'get_dropbox', broken)
+    assert commands.process_drop_id('foo') == 'foo'
+
+
+def test_scheduler_limits_reserve_a_worker_for_small_drops():
+    from briefkasten.commands import scheduler_limits
+    assert scheduler_limits(4) == dict(small=4, large=3, watchdog=1)
+    assert scheduler_limits(2)['large'] == 1
+    # a single worker can't be reserved
+    assert scheduler_limits(1)['large'] == 1
+    assert scheduler_limits(4, dict(large=2))['large'] == 2
+
+
+def test_submitted_drops_have_their_status_when_queued(dropbox_container, dropbox, monkeypatch):
+    from briefkasten import dropbox as dropbox_module
+    statuses = []
+
+    def recording_open(fs_path, *args):
+        # the worker may look at the drop as soon as it is queued
+        if fs_path.startswith(dropbox_container.fs_submission_queue):
+            statuses.append(dropbox_container.get_dropbox(dropbox.drop_id).status_int)
+        return open(fs_path, *args)
+    monkeypatch.setattr(dropbox_module, 'open', recording_open, raising=False)
+    dropbox.submit()
+    assert statuses == [20]
+
+
+def test_init_worker_ends_persistent_smtp_session_on_exit(dropbox_container, monkeypatch, testing):
+    from mock import MagicMock
+    from briefkasten import commands
+    smtp = MagicMock()
+    finalize = MagicMock()
+    monkeypatch.setattr(commands, 'worker_container', None)
+    monkeypatch.setattr(commands, 'Finalize', finalize)
+    commands.init_worker(dropbox_container.fs_root, settings=dict(smtp=smtp, fs_bin_path=testing.asset_path('bin')))
+    assert finalize.call_args[0] == (commands.worker_container, smtp.shutdown)
+    assert finalize.call_args[1] == dict(exitpriority=10)
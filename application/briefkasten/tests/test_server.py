@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+""" a small load test of the serving profile: many slow clients uploading attachments at
+the same time mustn't keep the (few) worker threads from serving others."""
+import socket
+from httplib import HTTPConnection
+from threading import Thread
+from time import time
+from urlparse import urlparse
+from pytest import fixture
+
+
+def serve(app, **settings):
+    from briefkasten.server import create_server
+    server = create_server(app, host='127.0.0.1', port=0, **settings)
+    thread = Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@fixture
+def server(request, app):
+    server = serve(app, threads=2, connection_limit=100)
+    request.addfinalizer(server.close)
+    return server
+
+
+@fixture
+def stream_path(testing, post_token):
+    return urlparse(testing.route_url('dropbox_fileupload_stream', token=post_token, filename='attachment.txt')).path
+
+
+def slow_upload(server, path, length=1024, sent=16):
+    """ starts uploading an attachment, but only sends the first few bytes of it"""
+    client = socket.create_connection(('127.0.0.1', server.effective_port))
+    client.sendall(
+        'PUT %s HTTP/1.1\r\nHost: example.com\r\nContent-Type: text/plain\r\n'
+        'Content-Length: %d\r\n\r\n' % (path, length))
+    client.sendall('x' * sent)
+    return client
+
+
+def get(server, path, timeout=5):
+    connection = HTTPConnection('127.0.0.1', server.effective_port, timeout=timeout)
+    connection.request('GET', path, headers=dict(Host='example.com'))
+    return connection.getresponse()
+
+
+def test_slow_uploads_dont_block_workers(server, stream_path, dropbox_container):
+    clients = [slow_upload(server, stream_path) for i in range(50)]
+    try:
+        started = time()
+        response = get(server, '/briefkasten/')
+        assert response.status == 200
+        # the form is served right away even though there are many more uploads than threads
+        assert time() - started < 2
+        # and the uploads are still alive
+        clients[0].sendall('x' * (1024 - 16))
+        assert clients[0].recv(1024).startswith('HTTP/1.1 200')
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_connection_limit(app, request, stream_path):
+    server = serve(app, threads=2, connection_limit=5)
+    request.addfinalizer(server.close)
+    clients = [slow_upload(server, stream_path) for i in range(5)]
+    try:
+        # all connections are taken, so further clients have to wait...
+        try:
+            get(server, '/briefkasten/', timeout=0.5)
+            assert False, 'request should have been blocked'
+        except socket.timeout:
+            pass
+    finally:
+        for client in clients:
+            client.close()
+    # ...until some of them are gone
+    assert get(server, '/briefkasten/').status == 200
@@ -22,3 +22,14 @@ def test_attachment_size_threshold_humanfriendly(sizes, tmpdir):
             fs_pgp_pubkeys=None)
     )
     assert (dropbox_container.settings['attachment_size_threshold'] == byte_size)
+
+
+def test_cleanser_native_types(tmpdir):
+    from briefkasten.dropbox import DropboxContainer
+    dropbox_container = DropboxContainer(
+        root=tmpdir.strpath,
+        settings=dict(
+            cleanser_native_types='image/jpeg image/png',
+            fs_pgp_pubkeys=None)
+    )
+    assert dropbox_container.settings['cleanser_native_types'] == ['image/jpeg', 'image/png']
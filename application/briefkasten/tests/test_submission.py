@@ -36,8 +36,7 @@ def test_submission_without_attachment_post(testing, dropbox_container, form):
     form.submit()
     assert len(listdir(dropbox_container.fs_path)) == 1
     created_drop_id = listdir(dropbox_container.fs_path)[0]
-    fs_dropbox_status = join(dropbox_container.fs_path, created_drop_id, 'status')
-    assert open(fs_dropbox_status).read().decode('utf-8') == u'020 submitted'
+    assert dropbox_container.get_dropbox(created_drop_id).status == u'020 submitted'
     fs_dropbox_submission = join(dropbox_container.fs_root, 'submissions', created_drop_id)
     assert exists(fs_dropbox_submission)
 
@@ -55,8 +54,7 @@ def test_submission_with_one_attachment_post(testing, dropbox_container, form):
     form['message'] = 'Hello there'
     form.submit()
     assert len(listdir(dropbox_container.fs_path)) == 1
-    fs_dropbox_status = join(dropbox_container.fs_path, listdir(dropbox_container.fs_path)[0], 'status')
-    assert open(fs_dropbox_status).read().decode('utf-8') == u'020 submitted'
+    assert dropbox_container.get_dropbox(listdir(dropbox_container.fs_path)[0]).status == u'020 submitted'
 
 
 def test_upload_attachment_directly(testing, dropbox_container, browser, upload_url, submit_url):
@@ -122,3 +120,150 @@ def test_submission_with_multiple_attachments(dropbox_container, form):
         index=0)
     form['message'] = 'Hello there'
     form.submit()
+
+
+@fixture
+def stream_url(testing, post_token):
+    return testing.route_url('dropbox_fileupload_stream', token=post_token, filename='attachment.txt')
+
+
+def test_upload_attachment_stream(testing, browser, stream_url, post_token_dropbox):
+    from hashlib import sha256
+    body = open(testing.asset_path('attachment.txt'), 'rb').read()
+    response = browser.put(stream_url, params=body, content_type='text/plain')
+    attached = response.json['files'][0]['name']
+    assert attached.endswith('.txt')
+    assert open(join(post_token_dropbox.fs_attachment_container, attached), 'rb').read() == body
+    metadata = post_token_dropbox._read_metadata()
+    assert metadata['size'] == len(body)
+    assert metadata['attachments'][attached] == dict(size=len(body), sha256=sha256(body).hexdigest())
+
+
+def test_truncated_upload_stream_is_rejected(browser, stream_url, post_token_dropbox):
+    from io import BytesIO
+    from webob import Request
+    request = Request.blank(stream_url, method='PUT', content_type='text/plain', environ={
+        'HTTP_HOST': 'example.com', 'wsgi.input': BytesIO(b'x' * 10)})
+    # the client announces more than it sends
+    request.environ['CONTENT_LENGTH'] = '100'
+    assert request.get_response(browser.app).status_int == 400
+    assert post_token_dropbox.num_attachments == 0
+
+
+@fixture
+def limited_browser(dropbox_container, config):
+    """ a browser for an application whose drops may only contain 64 bytes of attachments"""
+    from briefkasten import configure
+    from webtest import TestApp
+    with open(join(dropbox_container.fs_root, 'settings.yaml'), 'a') as fs_settings:
+        fs_settings.write('\nmax_drop_size: 64b\n')
+    app = configure({}, **config.registry.settings).make_wsgi_app()
+    return TestApp(app, extra_environ=dict(HTTP_HOST='example.com'))
+
+
+def test_upload_stream_exceeding_quota_is_rejected_upfront(limited_browser, stream_url, post_token_dropbox):
+    limited_browser.put(stream_url, params=b'x' * 65, content_type='text/plain', status=413)
+    assert post_token_dropbox.num_attachments == 0
+
+
+def test_upload_stream_quota_includes_earlier_attachments(limited_browser, stream_url, post_token_dropbox):
+    limited_browser.put(stream_url, params=b'x' * 60, content_type='text/plain')
+    limited_browser.put(stream_url, params=b'x' * 10, content_type='text/plain', status=413)
+    assert post_token_dropbox.num_attachments == 1
+
+
+def test_upload_exceeding_quota_is_rejected(limited_browser, upload_url, post_token_dropbox):
+    limited_browser.post(
+        upload_url,
+        params=dict(attachment=Upload('attachment.txt', b'x' * 65, 'text/plain')),
+        status=413)
+    assert post_token_dropbox.num_attachments == 0
+
+
+def test_add_attachment_stream_enforces_quota_while_reading(dropbox_container, dropbox):
+    from StringIO import StringIO
+    from briefkasten.dropbox import QuotaExceeded
+    from pytest import raises
+    dropbox_container.settings['max_attachment_size'] = 64
+    num_attachments = dropbox.num_attachments
+    with raises(QuotaExceeded):
+        dropbox.add_attachment_stream(StringIO(b'x' * 100), 'attachment.txt')
+    assert dropbox.num_attachments == num_attachments
+
+
+def test_resumable_upload(testing, browser, upload_url, post_token_dropbox):
+    body = open(testing.asset_path('attachment.txt'), 'rb').read()
+    response = browser.post(
+        upload_url,
+        headers={'Upload-Length': str(len(body)), 'Upload-Filename': 'attachment.txt', 'Accept': 'application/json'},
+        status=201)
+    location = response.headers['Location']
+    assert response.json['offset'] == 0
+    browser.patch(
+        location, params=body[:10], headers={'Upload-Offset': '0'},
+        content_type='application/offset+octet-stream', status=204)
+    # the partial upload isn't an attachment yet
+    assert post_token_dropbox.num_attachments == 0
+    # after an interruption the client asks where to resume
+    assert browser.head(location).headers['Upload-Offset'] == '10'
+    browser.patch(
+        location, params=body[5:], headers={'Upload-Offset': '5'},
+        content_type='application/offset+octet-stream', status=409)
+    response = browser.patch(
+        location, params=body[10:], headers={'Upload-Offset': '10'},
+        content_type='application/offset+octet-stream')
+    attached = response.json['files'][0]['name']
+    assert attached.endswith('.txt')
+    assert listdir(post_token_dropbox.fs_attachment_container) == [attached]
+    assert open(join(post_token_dropbox.fs_attachment_container, attached), 'rb').read() == body
+    assert post_token_dropbox._read_metadata()['attachments'][attached]['size'] == len(body)
+    # the upload is gone now
+    browser.head(location, status=404)
+
+
+def test_resumable_upload_respects_quota(limited_browser, upload_url, post_token_dropbox):
+    limited_browser.post(
+        upload_url,
+        headers={'Upload-Length': '65', 'Accept': 'application/json'},
+        status=413)
+    assert listdir(post_token_dropbox.fs_path) == ['metadata.json']
+
+
+def test_token_endpoint(testing, browser):
+    response = browser.get(testing.route_url('dropbox_token'))
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert response.json['action'].endswith('/submit')
+    assert response.json['fileupload_url'].endswith('/upload')
+    # the urls can be used right away
+    browser.post(response.json['action'], params=dict(message=u'hey'), status=302)
+
+
+def test_static_form(app):
+    from briefkasten.commands import render_static_form
+    page = render_static_form(app, 'http://example.com/briefkasten/')
+    assert 'action=""' in page
+    assert "request.open('GET', 'http://example.com/briefkasten/token')" in page
+    assert '/submit' not in page
+
+
+def test_static_form_setting(testing, config):
+    from briefkasten import configure
+    from webtest import TestApp
+    app = configure({}, static_form='true', **config.registry.settings).make_wsgi_app()
+    response = TestApp(app, extra_environ=dict(HTTP_HOST='example.com')).get(testing.route_url('dropbox_form'))
+    assert response.headers['Cache-Control'] == 'public, max-age=3600'
+    assert response.forms[0].action == ''
+    # visitors without javascript get a form with a token
+    noscript = response.html.find('noscript').find('a')['href']
+    assert noscript == testing.route_url('dropbox_form', _query=dict(noscript=1))
+    response = TestApp(app, extra_environ=dict(HTTP_HOST='example.com')).get(noscript)
+    assert 'public' not in response.headers.get('Cache-Control', '')
+    assert response.forms[0].action.endswith('/submit')
+    assert response.html.find('noscript') is None
+
+
+def test_static_form_reports_token_errors(app):
+    from briefkasten.commands import render_static_form
+    page = render_static_form(app, 'http://example.com/briefkasten/')
+    assert 'request.onerror = failed;' in page
+    assert 'id="briefkasten-token-error" hidden="hidden"' in page
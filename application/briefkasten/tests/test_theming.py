@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from os.path import dirname, join
+from pytest import fixture
+
+
+fs_rules = join(dirname(__file__), '..', '..', 'themes', 'fileuploader', 'rules.xml')
+
+
+def themed_app(config, **settings):
+    from briefkasten import configure
+    from webtest import TestApp
+    settings.update(config.registry.settings)
+    app = configure({}, **settings).make_wsgi_app()
+    return TestApp(app, extra_environ=dict(HTTP_HOST='example.com'))
+
+
+@fixture
+def themed_browser(config):
+    return themed_app(config, theme_rules=fs_rules)
+
+
+@fixture
+def theme(themed_browser):
+    return themed_browser.app.registry['briefkasten.theme']
+
+
+def test_form_is_themed(testing, themed_browser):
+    response = themed_browser.get(testing.route_url('dropbox_form'))
+    # the form comes from the theme...
+    assert 'custom-fileupload' in response
+    # ...but its urls come from the application
+    assert response.forms['briefkasten-form'].action.endswith('/submit')
+    assert response.html.find(id='briefkasten-form')['data-fileupload_url'].endswith('/upload')
+
+
+def test_theming_matches_diazo_filter(testing, config):
+    from diazo.wsgi import DiazoMiddleware
+    from webtest import TestApp
+    from briefkasten import configure
+    app = configure({}, static_form='true', **config.registry.settings).make_wsgi_app()
+    filtered = TestApp(DiazoMiddleware(app, {}, rules=fs_rules), extra_environ=dict(HTTP_HOST='example.com'))
+    themed = themed_app(config, theme_rules=fs_rules, static_form='true')
+    url = testing.route_url('dropbox_form')
+    assert themed.get(url).body == filtered.get(url).body
+    # the fallbacks of the static form are kept
+    form = themed.get(url).html.find(id='briefkasten-form')
+    assert form.find('noscript').find('a')['href'].endswith('?noscript=1')
+    assert form.find(id='briefkasten-token-error') is not None
+
+
+def test_public_pages_are_cached(testing, config):
+    browser = themed_app(config, theme_rules=fs_rules, static_form='true')
+    theme = browser.app.registry['briefkasten.theme']
+    page = browser.get(testing.route_url('dropbox_form')).body
+    assert len(theme.cache.data) == 1
+    assert browser.get(testing.route_url('dropbox_form')).body == page
+
+
+def test_personalised_pages_are_not_cached(testing, themed_browser, theme):
+    first = themed_browser.get(testing.route_url('dropbox_form')).forms['briefkasten-form'].action
+    second = themed_browser.get(testing.route_url('dropbox_form')).forms['briefkasten-form'].action
+    assert first != second
+    assert len(theme.cache.data) == 0
+
+
+def test_precompiled_theme(testing, config, tmpdir):
+    from diazo.compiler import compile_theme
+    fs_xsl = tmpdir.join('theme.xsl').strpath
+    compile_theme(fs_rules).write(fs_xsl)
+    browser = themed_app(config, theme_rules=fs_xsl)
+    assert 'custom-fileupload' in browser.get(testing.route_url('dropbox_form'))
+
+
+def test_unthemed_without_rules(testing, browser):
+    assert 'custom-fileupload' not in browser.get(testing.route_url('dropbox_form'))
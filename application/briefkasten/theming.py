@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+""" applies the diazo theme inside the application instead of in a wsgi filter.
+
+the rules are compiled into an XSLT transform only once (at startup, or even at build time
+using diazo's own `diazocompiler` -- `theme_rules` may point to the resulting `.xsl` file)
+and applied to the output of the page templates directly, so the rendered pages don't
+have to be buffered, re-parsed and re-serialized by the middleware.
+
+themed pages that are the same for all visitors (i.e. the static form, which is marked
+as publicly cacheable) are additionally kept in memory per template and url.
+
+to enable it configure the rules instead of the `egg:diazo` filter::
+
+    [app:briefkasten]
+    use = egg:briefkasten
+    theme_rules = %(here)s/themes/fileuploader/rules.xml
+"""
+from diazo.compiler import compile_theme as compile_rules
+from lxml import etree
+from pyramid.settings import asbool
+from pyramid_chameleon.zpt import renderer_factory
+from repoze.lru import LRUCache
+
+
+def compile_theme(fs_rules, read_network=False):
+    """ returns the XSLT transform for the given rules (or an already compiled theme)"""
+    access_control = etree.XSLTAccessControl(
+        read_file=True, write_file=False, create_dir=False,
+        read_network=read_network, write_network=False)
+    if fs_rules.endswith('.xsl'):
+        tree = etree.parse(fs_rules)
+    else:
+        tree = compile_rules(fs_rules, access_control=access_control, read_network=read_network)
+    return etree.XSLT(tree, access_control=access_control)
+
+
+def apply_theme(transform, html):
+    """ returns the themed version of the given page"""
+    if isinstance(html, unicode):
+        html = html.encode('utf-8')
+    document = etree.fromstring(html, etree.HTMLParser(encoding='utf-8'))
+    return str(transform(document))
+
+
+class Theme(object):
+    """ the compiled theme of an application along with its cache of themed pages"""
+
+    def __init__(self, settings):
+        self.fs_rules = settings['theme_rules']
+        self.read_network = asbool(settings.get('theme_read_network', False))
+        # with reloading templates the theme is recompiled (and nothing is cached) as well
+        self.reload = asbool(settings.get('pyramid.reload_templates', False))
+        self.cache = LRUCache(int(settings.get('theme_cache_size', 100)))
+        self._transform = None
+
+    @property
+    def transform(self):
+        if self._transform is None or self.reload:
+            self._transform = compile_theme(self.fs_rules, read_network=self.read_network)
+        return self._transform
+
+    def __call__(self, html):
+        return apply_theme(self.transform, html)
+
+
+def cache_key(info, request):
+    """ returns the key of the themed page if it can be shared between visitors"""
+    if request is None or not request.response.cache_control.public:
+        return None
+    return (info.name, request.url)
+
+
+class ThemedRenderer(object):
+    """ wraps the chameleon renderer, so its output gets themed"""
+
+    def __init__(self, info):
+        self.info = info
+        self.renderer = renderer_factory(info)
+
+    def implementation(self):
+        return self.renderer.implementation()
+
+    def __call__(self, value, system):
+        theme = self.info.registry.get('briefkasten.theme')
+        if theme is None:
+            return self.renderer(value, system)
+        key = None if theme.reload else cache_key(self.info, system.get('request'))
+        if key is not None:
+            themed = theme.cache.get(key)
+            if themed is not None:
+                return themed
+        themed = theme(self.renderer(value, system))
+        if key is not None:
+            theme.cache.put(key, themed)
+        return themed
+
+
+def includeme(config):
+    settings = config.registry.settings
+    if settings.get('theme_rules'):
+        theme = config.registry['briefkasten.theme'] = Theme(settings)
+        # compile the rules right away, so errors in them surface at startup
+        theme.transform
+    config.add_renderer('.pt', ThemedRenderer)
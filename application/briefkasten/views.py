@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 import pkg_resources
 import colander
-from pyramid.httpexceptions import HTTPFound
+from humanfriendly import format_size
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPConflict,
+    HTTPFound,
+    HTTPLengthRequired,
+    HTTPNotFound,
+    HTTPRequestEntityTooLarge,
+)
 from pyramid.renderers import get_renderer
+from pyramid.settings import asbool
 from pyramid.view import view_config
+from repoze.lru import LRUCache
+from time import time
 from briefkasten import _, is_equal
+from .dropbox import QuotaExceeded, UploadConflict
 
 title = "ZEIT ONLINE Briefkasten"
 version = pkg_resources.get_distribution("briefkasten").version
@@ -36,19 +48,70 @@ dropbox_schema = DropboxSchema()
 
 
 def defaults(request):
+    """ returns the values every page template needs.
+
+    the master macro and the static url (per application url, i.e. host name) are
+    computed only once per process, unless templates are reloaded anyway."""
+    if asbool(request.registry.settings.get('pyramid.reload_templates', False)):
+        master = master_macro()
+        static_url = request.static_url('briefkasten:static/')
+    else:
+        cache = request.registry.get('briefkasten.defaults')
+        if cache is None:
+            cache = request.registry['briefkasten.defaults'] = dict(
+                master=master_macro(),
+                static_urls=LRUCache(100))
+        master = cache['master']
+        static_url = cache['static_urls'].get(request.application_url)
+        if static_url is None:
+            static_url = request.static_url('briefkasten:static/')
+            cache['static_urls'].put(request.application_url, static_url)
     return dict(
-        static_url=request.static_url('briefkasten:static/'),
-        master=get_renderer('templates/master.pt').implementation().macros['master'],
+        static_url=static_url,
+        master=master,
         version=version,
         title=title)
 
 
+def master_macro():
+    return get_renderer('templates/master.pt').implementation().macros['master']
+
+
 @view_config(
     route_name='dropbox_form',
     request_method='GET',
     renderer='briefkasten:templates/dropbox_form.pt')
 def dropbox_form(request):
-    """ generates a dropbox uid and renders the submission form with a signed version of that id"""
+    """ generates a dropbox uid and renders the submission form with a signed version of that id.
+
+    in static mode the form is rendered without a token, which is fetched by the client
+    from `dropbox_token` instead. the form is the same for all visitors then and can be
+    rendered once (see `commands.render_form`) or at least cached. visitors without
+    javascript (or whose token request fails) are pointed to `noscript_url`, which always
+    renders the form with a token."""
+    if is_static_form(request):
+        request.response.cache_control = 'public, max-age=3600'
+        return dict(
+            action='',
+            fileupload_url='',
+            token_url=request.route_url('dropbox_token'),
+            noscript_url=request.route_url('dropbox_form', _query=dict(noscript=1)),
+            **defaults(request))
+    return dict(token_url=None, noscript_url=None, **post_urls(request))
+
+
+@view_config(
+    route_name='dropbox_token',
+    request_method='GET',
+    renderer='json')
+def dropbox_token(request):
+    """ returns the urls for submitting the form and uploading files for a new dropbox"""
+    request.response.cache_control = 'no-store'
+    urls = post_urls(request)
+    return dict(action=urls['action'], fileupload_url=urls['fileupload_url'])
+
+
+def post_urls(request):
     from briefkasten import generate_post_token
     token = generate_post_token(secret=request.registry.settings['post_secret'])
     return dict(
@@ -57,6 +120,12 @@ def dropbox_form(request):
         **defaults(request))
 
 
+def is_static_form(request):
+    if request.environ.get('briefkasten.static_form', False):
+        return True
+    return asbool(request.registry.settings.get('static_form', False)) and 'noscript' not in request.GET
+
+
 @view_config(
     route_name='dropbox_fileupload',
     accept='application/json',
@@ -64,8 +133,13 @@ def dropbox_form(request):
     request_method='POST')
 def dropbox_fileupload(dropbox, request):
     """ accepts a single file upload and adds it to the dropbox as attachment"""
+    # reject uploads that are obviously too large before reading them
+    check_quota(dropbox, request.content_length)
     attachment = request.POST['attachment']
-    attached = dropbox.add_attachment(attachment)
+    try:
+        attached = dropbox.add_attachment(attachment)
+    except QuotaExceeded as exc:
+        raise HTTPRequestEntityTooLarge(exc.message)
     return dict(
         files=[dict(
             name=attached,
@@ -74,11 +148,138 @@ def dropbox_fileupload(dropbox, request):
     )
 
 
+@view_config(
+    route_name='dropbox_fileupload_stream',
+    renderer='json',
+    request_method='PUT')
+def dropbox_fileupload_stream(dropbox, request):
+    """ accepts a single file as request body and streams it into the dropbox as attachment
+    without buffering it first"""
+    if request.content_length is None:
+        raise HTTPLengthRequired()
+    started = time()
+    try:
+        attached = dropbox.add_attachment_stream(
+            request.body_file_raw,
+            request.matchdict['filename'],
+            length=request.content_length)
+    except QuotaExceeded as exc:
+        raise HTTPRequestEntityTooLarge(exc.message)
+    except IOError:
+        # the client sent less than it announced (or went away)
+        raise HTTPBadRequest('incomplete upload')
+    duration = max(time() - started, 0.001)
+    print("Received %s in %.3f seconds (%s/s)" % (
+        format_size(request.content_length),
+        duration,
+        format_size(request.content_length / duration)))
+    return dict(
+        files=[dict(
+            name=attached,
+            type=request.content_type,
+        )]
+    )
+
+
+@view_config(
+    route_name='dropbox_fileupload',
+    accept='application/json',
+    renderer='json',
+    request_method='POST',
+    header='Upload-Length')
+def dropbox_fileupload_create(dropbox, request):
+    """ starts a resumable upload of a single file.
+
+    the client announces the size of the file in the `Upload-Length` header (and optionally
+    its name in `Upload-Filename`) and then sends its contents in chunks via `PATCH`"""
+    try:
+        length = int(request.headers['Upload-Length'])
+    except ValueError:
+        raise HTTPBadRequest('invalid upload length')
+    try:
+        upload_id = dropbox.create_upload(request.headers.get('Upload-Filename', u''), length)
+    except QuotaExceeded as exc:
+        raise HTTPRequestEntityTooLarge(exc.message)
+    request.response.status = 201
+    request.response.headers['Location'] = request.current_route_url(_query=dict(upload=upload_id))
+    request.response.headers['Upload-Offset'] = '0'
+    return dict(upload=upload_id, offset=0)
+
+
+@view_config(
+    route_name='dropbox_fileupload',
+    request_method='HEAD',
+    request_param='upload')
+def dropbox_fileupload_offset(dropbox, request):
+    """ tells the client where to resume an interrupted upload"""
+    try:
+        offset, length = dropbox.upload_offset(request.GET['upload'])
+    except KeyError:
+        raise HTTPNotFound('no such upload')
+    request.response.headers['Upload-Offset'] = str(offset)
+    request.response.headers['Upload-Length'] = str(length)
+    request.response.cache_control = 'no-store'
+    return request.response
+
+
+@view_config(
+    route_name='dropbox_fileupload',
+    renderer='json',
+    request_method='PATCH',
+    request_param='upload')
+def dropbox_fileupload_append(dropbox, request):
+    """ appends the request body (which mustn't be form encoded, i.e. should be sent as
+    `application/offset+octet-stream`) to a resumable upload at the offset given in the
+    `Upload-Offset` header. once the upload is complete it is added to the dropbox."""
+    if request.content_length is None:
+        raise HTTPLengthRequired()
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        raise HTTPBadRequest('invalid upload offset')
+    try:
+        offset, attached = dropbox.append_upload(
+            request.GET['upload'],
+            request.body_file_raw,
+            offset,
+            request.content_length)
+    except KeyError:
+        raise HTTPNotFound('no such upload')
+    except UploadConflict as exc:
+        raise HTTPConflict(exc.message)
+    except QuotaExceeded as exc:
+        raise HTTPRequestEntityTooLarge(exc.message)
+    except IOError:
+        raise HTTPBadRequest('incomplete chunk')
+    request.response.headers['Upload-Offset'] = str(offset)
+    if attached is None:
+        request.response.status = 204
+        return request.response
+    return dict(
+        files=[dict(
+            name=attached,
+        )]
+    )
+
+
+def check_quota(dropbox, content_length):
+    """ raises `HTTPRequestEntityTooLarge` if a request body of the given length can't
+    be added to the dropbox. the length includes the encoding overhead of the form data,
+    which is negligible compared to any sensible quota, though."""
+    if content_length is None:
+        return
+    try:
+        dropbox.check_quota(content_length)
+    except QuotaExceeded as exc:
+        raise HTTPRequestEntityTooLarge(exc.message)
+
+
 @view_config(
     route_name='dropbox_form_submit',
     request_method='POST')
 def dropbox_submission(dropbox, request):
     """ handles the form submission, redirects to the dropbox's status page."""
+    check_quota(dropbox, request.content_length)
     try:
         data = dropbox_schema.deserialize(request.POST)
     except Exception:
@@ -95,7 +296,10 @@ def dropbox_submission(dropbox, request):
 
     # a non-js client might have uploaded an attachment via the form's fileupload field:
     if data.get('upload') is not None:
-        dropbox.add_attachment(data['upload'])
+        try:
+            dropbox.add_attachment(data['upload'])
+        except QuotaExceeded as exc:
+            raise HTTPRequestEntityTooLarge(exc.message)
 
     # now we can call the process method
     dropbox.submit()
@@ -24,8 +24,15 @@ process_single_file () {
   the_file=$1
   the_destination=$2
 
-  # First determine the file type
-  the_type=`file -bi "${the_file}"`
+  # First determine the file type, preferably from the manifest the worker
+  # created with one "name<TAB>type" line per attachment
+  unset the_type
+  if [ -r "${the_types}" ]; then
+    while IFS="	" read -r the_name the_entry; do
+      [ "${the_name}" = "${the_file##*/}" ] && the_type="${the_entry}" && break
+    done < "${the_types}"
+  fi
+  [ "${the_type}" ] || the_type=`file -bi "${the_file}"`
 
   case ${the_type%;*} in
   text/plain)          cp                "${the_file}" "${the_destination}";;
@@ -78,7 +85,12 @@ esac; done; shift $(( ${OPTIND} - 1 ))
 [ "${the_config}" -a -r "${the_config}" ] && . "${the_config}"
 
 unset my_dispatcher
-if [ "${the_jdispatcher_dir}" ]; then
+if [ "${the_dispatcher}" ]; then
+
+  # The worker has already claimed a cleanser for us
+  my_dispatcher="${the_dispatcher}"
+
+elif [ "${the_jdispatcher_dir}" ]; then
 
   # Try to grab a cleanser
   # This normally should not fail, because there's
@@ -96,7 +108,9 @@ if [ "${the_jdispatcher_dir}" ]; then
   # If we can not allocate a dispatcher here, return an error
   # TODO: report, what went wrong, maybe wait
   [ "${my_dispatcher}" ] || exnerr 502 "No remote cleanser available"
+fi
 
+if [ "${my_dispatcher}" ]; then
   read cleanser_ippport < "${my_dispatcher}"/ip
   [ "${cleanser_ippport}" ] || exnerr 503 "Cleanser config error"
 
@@ -113,25 +127,74 @@ fi
 
 # If we have a remote cleanser host, clean the attachments there
 if [ "${the_cleanser}" ]; then
+  : ${the_ssh:=ssh}
+  : ${the_scp:=scp}
   the_ssh_conf="${the_ssh_conf} -o PasswordAuthentication=no"
   [ "${the_cleanser_ssh_conf}" ] && the_ssh_conf="-F ${the_cleanser_ssh_conf} ${the_ssh_conf}"
+  # share a single (master) connection between all ssh sessions to the cleanser
+  [ "${the_ssh_control_path}" ] && the_ssh_conf="${the_ssh_conf} -o ControlMaster=auto
+    -o ControlPath=${the_ssh_control_path} -o ControlPersist=${the_ssh_control_persist:-60}"
   the_remote_dir=`basename "${the_dropdir}"`
 
   [ "${my_dispatcher}" ] || printf "202 Using static remote cleanser: %s.\n\nCopying data.\n" "${the_cleanser}" > "${the_dropdir}"/status
 
-  # copy over the attachments
-  scp ${the_ssh_conf} -r ${the_dropdir} ${the_cleanser}:${the_remote_dir}
-  [ $? -eq 0 ] || exnerr 504 "Could not copy dropdir to cleanser."
-
-  printf "203 Attachments being processed by actual cleanser\n" > "${the_dropdir}"/status
-
-  # execute remote cleanser job
-  ssh ${the_ssh_conf} ${the_cleanser} process-attachments.sh -d ${the_remote_dir}
-  the_return_code=$?
+  if [ "${the_transfer_mode}" = "stream" ]; then
+    printf "203 Attachments being processed by actual cleanser\n" > "${the_dropdir}"/status
+
+    # stream only the attachments (and those already cleansed) to the cleanser as a tar archive,
+    # process them and stream back only the cleansed attachments and the status, all in a single
+    # ssh session
+    the_remote_job="mkdir ${the_remote_dir} && tar -xf - -C ${the_remote_dir} &&
+      { process-attachments.sh -d ${the_remote_dir} > /dev/null 2>&1; the_return_code=\$?;
+        tar -cf - -C ${the_remote_dir} clean status 2> /dev/null; rm -rf ${the_remote_dir}; exit \$the_return_code; }"
+    rm -f "${the_dropdir}"/.transfer
+    the_transfer="attach"
+    [ -d "${the_dropdir}"/clean ] && the_transfer="attach clean"
+    # the cleanser handles untrusted files, so don't trust what it sends back either: only
+    # the cleansed attachments and the status are unpacked, into a directory of their own
+    the_incoming="${the_dropdir}"/.incoming
+    rm -rf "${the_incoming}" && mkdir "${the_incoming}" || exnerr 504 "Could not transfer attachments to cleanser."
+    tar -cf - -C "${the_dropdir}" ${the_transfer} | {
+      ${the_ssh} ${the_ssh_conf} ${the_cleanser} "${the_remote_job}"
+      echo $? > "${the_dropdir}"/.transfer
+    } | tar -xf - --no-same-owner -C "${the_incoming}" clean status 2> /dev/null
+    read the_return_code < "${the_dropdir}"/.transfer
+    rm -f "${the_dropdir}"/.transfer
+
+    # anything but plain files and directories (i.e. symlinks) is rejected
+    if [ "`find "${the_incoming}" ! -type f ! -type d`" ]; then
+      rm -rf "${the_incoming}"
+      exnerr 506 "Cleanser sent back unexpected files."
+    fi
+    if [ -d "${the_incoming}"/clean ]; then
+      rm -rf "${the_dropdir}"/clean
+      mv "${the_incoming}"/clean "${the_dropdir}"/clean
+    fi
+    [ -f "${the_incoming}"/status ] && mv -f "${the_incoming}"/status "${the_dropdir}"/status
+    rm -rf "${the_incoming}"
 
-  # get back the result (and error code in status file)
-  scp ${the_ssh_conf} -r ${the_cleanser}:${the_remote_dir} `dirname ${the_dropdir}`
-  [ $? -eq 0 ] || exnerr 505 "Could not copy back dropdir from cleanser."
+    # the cleanser always reports a new status, unless the transfer failed
+    grep -q "^203 " "${the_dropdir}"/status && exnerr 504 "Could not transfer attachments to cleanser."
+  else
+    # copy over only the attachments (and those already cleansed), the metadata of the drop
+    # never leaves the worker
+    the_transfer="${the_dropdir}/attach"
+    [ -d "${the_dropdir}"/clean ] && the_transfer="${the_transfer} ${the_dropdir}/clean"
+    ${the_ssh} ${the_ssh_conf} ${the_cleanser} mkdir "${the_remote_dir}" &&
+      ${the_scp} ${the_ssh_conf} -r ${the_transfer} ${the_cleanser}:${the_remote_dir}
+    [ $? -eq 0 ] || exnerr 504 "Could not copy dropdir to cleanser."
+
+    printf "203 Attachments being processed by actual cleanser\n" > "${the_dropdir}"/status
+
+    # execute remote cleanser job
+    ${the_ssh} ${the_ssh_conf} ${the_cleanser} process-attachments.sh -d ${the_remote_dir}
+    the_return_code=$?
+
+    # get back only the cleansed attachments and the status file (with the error code), so
+    # concurrent changes of the drop's metadata aren't overwritten
+    ${the_scp} ${the_ssh_conf} -r ${the_cleanser}:${the_remote_dir}/clean ${the_cleanser}:${the_remote_dir}/status "${the_dropdir}"
+    [ $? -eq 0 ] || exnerr 505 "Could not copy back dropdir from cleanser."
+  fi
 
   # remove remote dir or release jail to jdispatcher
   if [ "${my_dispatcher}" ]; then
@@ -140,8 +203,8 @@ if [ "${the_cleanser}" ]; then
 
     ${my_dispatcher}/release
   else
-    # ignore errors
-    ssh ${the_ssh_conf} ${the_cleanser} rm -r "${the_remote_dir}"
+    # ignore errors, the remote dir is already gone when streaming
+    [ "${the_transfer_mode}" = "stream" ] || ${the_ssh} ${the_ssh_conf} ${the_cleanser} rm -r "${the_remote_dir}"
   fi
 
   # leave status file as reported by cleanser
@@ -153,8 +216,11 @@ fi
 printf "204 Attachments in quarantine on actual cleanser host.\n" > "${the_dropdir}"/status
 
 mkdir -p "${the_dropdir}"/clean
+the_types="${the_dropdir}"/attach/.types
 for the_attachment in "${the_dropdir}"/attach/*; do
   [ -f "${the_attachment}" ] || continue
+  # the worker may already have cleansed some attachments itself
+  [ -e "${the_dropdir}/clean/${the_attachment##*/}" ] && continue
   process_single_file "${the_attachment}" ${the_dropdir}/clean || return 1
 done
 
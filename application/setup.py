@@ -40,8 +40,10 @@ setup(
         'itsdangerous',
         'jinja2',
         'python-gnupg',
+        'repoze.lru',
         'repoze.xmliter',
         'Paste',
+        'waitress',
         'watchdog',
         'PyYAML',
     ],
@@ -53,12 +55,15 @@ setup(
     entry_points="""
         [paste.app_factory]
         main = briefkasten:main
+        [paste.server_runner]
+        waitress = briefkasten.server:server_runner
         [pytest11]
         briefkasten = briefkasten.testing
         [console_scripts]
         debug = briefkasten.commands:debug
         worker = briefkasten.commands:worker
         janitor = briefkasten.commands:janitor
+        render_form = briefkasten.commands:render_form
     """,
     message_extractors={'briefkasten': [
         ('**.py', 'lingua_python', None),